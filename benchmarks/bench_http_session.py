@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Per-call latency of provider requests, with and without the pooled
+keep-alive session, against a local stand-in HTTP server.
+
+    python benchmarks/bench_http_session.py [number of calls]
+"""
+
+import sys
+import time
+
+import requests
+
+from ckanext.doi.api import transport
+from ckanext.doi.tests.stand_in import StandInServer
+
+
+def _time_calls(call, url, n):
+    timings = []
+    for i in range(n):
+        start = time.time()
+        call(url).raise_for_status()
+        timings.append(time.time() - start)
+    return timings
+
+
+def _report(label, timings):
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    print '%-24s mean %.3f ms   p50 %.3f ms   p99 %.3f ms' % (
+        label, mean * 1000, timings[len(timings) // 2] * 1000,
+        timings[int(len(timings) * 0.99)] * 1000)
+    return mean
+
+
+def main(n=1000):
+    with StandInServer() as server:
+        url = server.url + '/id/doi:10.5072/FK2000001'
+        # Warm up both paths
+        _time_calls(requests.get, url, 10)
+        _time_calls(lambda u: transport.request('get', u), url, 10)
+
+        new_connection = _report('requests.get', _time_calls(requests.get, url, n))
+        pooled = _report('pooled session', _time_calls(lambda u: transport.request('get', u), url, n))
+        transport.reset_session()
+
+    print 'Pooled session is %.1fx faster per call' % (new_connection / pooled)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Per-call cost of finding the license title for build_metadata, scanning the
+license options (as build_metadata used to) against the license id index.
+
+    python benchmarks/bench_license_lookup.py [number of datasets]
+"""
+
+import sys
+import time
+
+import ckan.model as model
+
+from ckanext.doi.lib import get_license_title
+
+
+def _scan_license_options(license_id):
+    for license_title, option_id in model.Package.get_license_options():
+        if option_id == license_id:
+            return license_title
+
+
+def _time_lookups(lookup, license_ids):
+    start = time.time()
+    for license_id in license_ids:
+        lookup(license_id)
+    return time.time() - start
+
+
+def main(n=10000):
+    options = model.Package.get_license_options()
+    # Datasets spread across every license, and some unknown ones
+    license_ids = [options[i % len(options)][1] if i % 10 else 'unknown'
+                   for i in range(n)]
+    assert all(_scan_license_options(i) == get_license_title(i)
+               for i in license_ids[:len(options) * 2])
+
+    scan = _time_lookups(_scan_license_options, license_ids)
+    index = _time_lookups(get_license_title, license_ids)
+    print '%d datasets, %d licenses' % (n, len(options))
+    print '%-24s total %.1f ms   per call %.2f us' % (
+        'scan license options', scan * 1000, scan / n * 1e6)
+    print '%-24s total %.1f ms   per call %.2f us' % (
+        'license title index', index * 1000, index / n * 1e6)
+    print 'Index is %.1fx faster per call' % (scan / index)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Per-dataset cost of each step of the DOI metadata pipeline, over synthetic
+corpora of small, typical and pathological datasets (see corpus.py):
+
+    package_get_year, build_metadata, validate_metadata, metadata_to_xml,
+    and encoding the EZID request body as ANVL
+
+Reports throughput, and memory allocated per dataset - with tracemalloc
+where it's available, otherwise the number of new garbage collected
+objects.
+
+    python benchmarks/bench_metadata_pipeline.py [number of datasets]
+
+There are a hundredth as many pathological datasets.
+"""
+
+import gc
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from ckanext.doi.model.doi import DOI
+from ckanext.doi.helpers import package_get_year
+from ckanext.doi.lib import build_metadata, validate_metadata
+from ckanext.doi.api.ezid_api import DOIEzidAPI, to_anvl
+
+import corpus
+
+_DOI = DOI(package_id='example', identifier='10.5072/FK2000001')
+
+
+def _build_metadata(pkg_dict):
+    return build_metadata(pkg_dict, _DOI)
+
+
+def _metadata_to_xml(metadata_dict):
+    return DOIEzidAPI.metadata_to_xml(**metadata_dict)
+
+
+def _anvl(xml):
+    return to_anvl({'datacite': xml,
+                    '_target': 'http://localhost/dataset/example'})
+
+
+def _measure(step, inputs):
+    '''
+    Run step over the inputs
+    @return: (outputs, seconds, allocated per input)
+    '''
+    gc.collect()
+    gc.disable()
+    try:
+        if tracemalloc:
+            tracemalloc.start()
+        else:
+            objects_before = len(gc.get_objects())
+        start = time.time()
+        outputs = [step(i) for i in inputs]
+        elapsed = time.time() - start
+        if tracemalloc:
+            allocated = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            allocated = len(gc.get_objects()) - objects_before
+    finally:
+        gc.enable()
+    return outputs, elapsed, float(allocated) / len(inputs)
+
+
+def run(kind, n):
+    # The pipeline changes the package dicts, so steps that take them each
+    # get a fresh corpus
+    steps = [
+        ('package_get_year', package_get_year, lambda: corpus.make_corpus(kind, n)),
+        ('build_metadata', _build_metadata, lambda: corpus.make_corpus(kind, n)),
+        ('validate_metadata', validate_metadata, lambda: metadata_dicts),
+        ('metadata_to_xml', _metadata_to_xml, lambda: metadata_dicts),
+        ('anvl', _anvl, lambda: xmls),
+    ]
+    metadata_dicts = xmls = None
+    results = []
+    for label, step, make_inputs in steps:
+        outputs, elapsed, allocated = _measure(step, make_inputs())
+        if label == 'build_metadata':
+            metadata_dicts = outputs
+        elif label == 'metadata_to_xml':
+            xmls = outputs
+        results.append((label, elapsed, allocated))
+    return results
+
+
+def main(n=1000):
+    unit = 'KB' if tracemalloc else 'objects'
+    for kind, count in (('small', n), ('typical', n),
+                        ('pathological', max(1, n // 100))):
+        print '%s (%d datasets)' % (kind, count)
+        for label, elapsed, allocated in run(kind, count):
+            if tracemalloc:
+                allocated /= 1024
+            print '  %-20s %10.0f datasets/s %10.1f us each %10.1f %s each' % (
+                label, count / elapsed, elapsed / count * 1e6, allocated, unit)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
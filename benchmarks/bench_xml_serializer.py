@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Throughput of serializing DataCite metadata XML, with xmltodict (pretty
+printed, as metadata_to_xml used to) and with the xml_writer serializer.
+
+    python benchmarks/bench_xml_serializer.py [number of records]
+"""
+
+import sys
+import time
+
+import xmltodict
+
+from ckanext.doi.api import xml_writer
+from ckanext.doi.api.mixins import MetadataToDataCiteXmlMixin
+
+
+def _make_xml_dicts(n):
+    xml_dicts = []
+    for i in range(n):
+        xml_dicts.append(MetadataToDataCiteXmlMixin.metadata_to_xml_dict(
+            '10.5072/FK2{0:07}'.format(i), u'Dataset {0} & <friends>'.format(i),
+            ['Author {0}'.format(j) for j in range(i % 5 + 1)],
+            'Natural History Museum', 2000 + i % 20,
+            description=u'A description of dataset {0}\n'.format(i) * 20,
+            subject=['tag{0}'.format(j) for j in range(i % 10)],
+            format='CSV, JSON', version='1.0', rights='CC-BY',
+            geo_point='51.5 -0.17'))
+    return xml_dicts
+
+
+def _time(serialize, xml_dicts):
+    start = time.time()
+    for xml_dict in xml_dicts:
+        serialize(xml_dict)
+    return time.time() - start
+
+
+def main(n=10000):
+    xml_dicts = _make_xml_dicts(n)
+    for xml_dict in xml_dicts[:100]:
+        assert xml_writer.unparse(xml_dict) == \
+            xmltodict.unparse(xml_dict, full_document=False)
+
+    pretty = _time(lambda d: xmltodict.unparse(d, pretty=True,
+                                                full_document=False),
+                   xml_dicts)
+    compact = _time(lambda d: xmltodict.unparse(d, full_document=False),
+                    xml_dicts)
+    writer = _time(xml_writer.unparse, xml_dicts)
+
+    print '%d records' % n
+    for label, elapsed in (('xmltodict, pretty', pretty),
+                           ('xmltodict', compact),
+                           ('xml_writer', writer)):
+        print '%-20s %8.0f records/s   %.1f us per record' % (
+            label, n / elapsed, elapsed / n * 1e6)
+    print 'xml_writer is %.1fx faster than xmltodict, pretty' % (
+        pretty / writer)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
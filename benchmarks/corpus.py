@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Synthetic package dicts for the benchmarks, shaped like the output of
+package_show.
+
+    small        - just the fields DataCite requires
+    typical      - a few tags, resources and a paragraph of notes
+    pathological - thousands of tags, huge notes and a large polygon
+"""
+
+import json
+import math
+import random
+
+LICENSE_IDS = ['cc-by', 'cc-by-sa', 'cc-zero', 'odc-by', 'notspecified']
+
+
+def _polygon(points):
+    '''Closed polygon of `points` points, as GeoJSON'''
+    coordinates = [[round(math.cos(2 * math.pi * i / points) * 10, 6),
+                    round(math.sin(2 * math.pi * i / points) * 10, 6)]
+                   for i in range(points)]
+    coordinates.append(coordinates[0])
+    return json.dumps({'type': 'Polygon', 'coordinates': [coordinates]})
+
+
+def small(i):
+    return {
+        'id': 'small-{0}'.format(i),
+        'title': 'Dataset {0}'.format(i),
+        'author': 'Author {0}'.format(i),
+        'notes': '',
+        'metadata_created': '2015-06-{0:02}T12:00:00.000000'.format(i % 28 + 1),
+    }
+
+
+def typical(i, rand=random):
+    pkg_dict = small(i)
+    pkg_dict.update({
+        'id': 'typical-{0}'.format(i),
+        'title': u'Specimen records: {0} & related collections'.format(i),
+        'notes': u'Records of specimens collected between 1850 and 1950, '
+                 u'with locality data: 50% georeferenced.\n' * 5,
+        'license_id': rand.choice(LICENSE_IDS),
+        'version': '1.{0}'.format(i % 10),
+        'tags': [{'name': 'tag{0}'.format(rand.randint(0, 200))}
+                 for j in range(rand.randint(1, 10))],
+        'res_format': ['CSV', 'JSON', ''][:rand.randint(1, 3)],
+        'extras_spatial': json.dumps({'type': 'Point',
+                                      'coordinates': [-0.17, 51.5]}),
+    })
+    return pkg_dict
+
+
+def pathological(i, rand=random):
+    pkg_dict = typical(i, rand)
+    pkg_dict.update({
+        'id': 'pathological-{0}'.format(i),
+        'title': u'Titre: données de l\'expédition <{0}> & "autres"\r\n'
+                 .format(i) * 10,
+        'notes': u'Lots of notes, with structural characters % : \r\n & <>. '
+                 * 20000,
+        'tags': [{'name': 'tag{0}'.format(j)} for j in range(5000)],
+        'res_format': ['CSV', ''] * 500,
+        'extras_spatial': _polygon(5000),
+    })
+    return pkg_dict
+
+
+KINDS = {
+    'small': small,
+    'typical': typical,
+    'pathological': pathological,
+}
+
+
+def make_corpus(kind, n, seed=0):
+    '''
+    List of n package dicts of a kind. The same seed gives the same corpus.
+    '''
+    rand = random.Random(seed)
+    if kind == 'small':
+        return [small(i) for i in range(n)]
+    return [KINDS[kind](i, rand) for i in range(n)]
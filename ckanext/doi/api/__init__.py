@@ -2,6 +2,7 @@ from pylons import config
 from paste.deploy.converters import asbool
 
 from ckanext.doi.api import ezid_api
+from ckanext.doi.api import datacite_rest_api
 from ckanext.doi.exc import DOIAPITypeNotKnownError
 
 
@@ -41,6 +42,7 @@ def _get_api_interface_from_list(apis):
 def get_doi_api():
     '''Return the appropriate api interface class for the passed api type.'''
     apis = {
-        'ezid': ezid_api.DOIEzidAPI
+        'ezid': ezid_api.DOIEzidAPI,
+        'datacite': datacite_rest_api.DOIDataCiteRESTAPI,
     }
     return _get_api_interface_from_list(apis)
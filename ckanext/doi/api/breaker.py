@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Circuit breaker for provider calls.
+
+After ckanext.doi.breaker_threshold calls in a row fail (connection errors,
+timeouts, 5xx or 429 responses) the breaker opens, and calls fail straight
+away with DOIProviderUnavailableError for ckanext.doi.breaker_cooldown
+seconds, rather than each waiting for the provider to time out. Then one
+trial call is let through: if it succeeds the breaker closes, otherwise it
+opens for another cool-down.
+
+Each process has its own breaker.
+"""
+
+import time
+import threading
+from logging import getLogger
+
+from pylons import config
+from paste.deploy.converters import asint
+
+from ckanext.doi.exc import DOIProviderUnavailableError
+
+log = getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def get_threshold():
+    '''Failures in a row that open the breaker. 0 disables it.'''
+    return asint(config.get('ckanext.doi.breaker_threshold', 5))
+
+
+def get_cooldown():
+    '''Seconds the breaker stays open'''
+    return float(config.get('ckanext.doi.breaker_cooldown', 60))
+
+
+def is_failure(response):
+    '''Whether a response means the provider is unavailable or overloaded'''
+    return response.status_code >= 500 or response.status_code == 429
+
+
+class CircuitBreaker(object):
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        '''
+        Check a call can be made
+        @raise DOIProviderUnavailableError: if the breaker is open
+        '''
+        threshold = get_threshold()
+        if not threshold:
+            return
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and \
+               time.time() >= self.opened + get_cooldown():
+                # Let this call through as a trial
+                self.state = HALF_OPEN
+                return
+            raise DOIProviderUnavailableError(
+                'DOI provider unavailable after {0} failures: {1}'
+                .format(self.failures, self.last_error))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                log.info('DOI provider available again - closing breaker')
+            self.state = CLOSED
+            self.failures = 0
+            self.opened = None
+            self.last_error = None
+
+    def record_failure(self, error):
+        threshold = get_threshold()
+        with self._lock:
+            self.failures += 1
+            self.last_error = unicode(error)
+            if threshold and (self.state == HALF_OPEN or
+                              self.failures >= threshold):
+                if self.state != OPEN:
+                    log.warning('DOI provider failed {0} times - opening '
+                                'breaker: {1}'.format(self.failures, error))
+                self.state = OPEN
+                self.opened = time.time()
+
+    def release(self):
+        '''The call failed without reaching the provider - if it was the
+        trial call, let another call through instead'''
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def get_status(self):
+        '''
+        Breaker state, for monitoring
+        @return: dict
+        '''
+        with self._lock:
+            status = {
+                'state': self.state,
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'opened': None,
+                'retry_at': None,
+            }
+            if self.opened is not None:
+                status['opened'] = self.opened
+                status['retry_at'] = self.opened + get_cooldown()
+            return status
+
+    def reset(self):
+        self.record_success()
+
+
+breaker = CircuitBreaker()
@@ -9,10 +9,10 @@ import os
 import abc
 from logging import getLogger
 
-import requests
 from pylons import config
 
 import ckanext.doi.api
+from ckanext.doi.api import transport
 from ckanext.doi.api.mixins import MetadataToDataCiteXmlMixin
 
 log = getLogger(__name__)
@@ -59,7 +59,7 @@ class DataCiteAPI(object):
 
         log.info("Calling %s:%s - %s", endpoint, method, kwargs)
 
-        r = getattr(requests, method)(endpoint, **kwargs)
+        r = transport.request(method, endpoint, **kwargs)
         r.raise_for_status()
         # Return the result
         return r
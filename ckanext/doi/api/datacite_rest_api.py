@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Client for the DataCite REST API (https://support.datacite.org/docs/api).
+
+Unlike the MDS API, which needs one call to store the metadata and another
+to mint the DOI, a single PUT to /dois/{doi} creates or updates a DOI, its
+URL and its metadata, and makes it findable.
+"""
+
+import json
+import base64
+from logging import getLogger
+
+from pylons import config
+
+import ckanext.doi.api
+from ckanext.doi.api import transport
+from ckanext.doi.api.mixins import MetadataToDataCiteXmlMixin
+
+log = getLogger(__name__)
+
+
+ENDPOINT = 'https://api.datacite.org'
+TEST_ENDPOINT = 'https://api.test.datacite.org'
+
+CONTENT_TYPE = 'application/vnd.api+json'
+
+
+def get_endpoint():
+    """
+    Get the DataCite REST API endpoint, from ckanext.doi.datacite_endpoint if
+    set
+    @return: test endpoint if we're in test mode
+    """
+    endpoint = config.get('ckanext.doi.datacite_endpoint')
+    if endpoint:
+        return endpoint.rstrip('/')
+    return TEST_ENDPOINT if ckanext.doi.api.get_test_mode() else ENDPOINT
+
+
+class DOIDataCiteRESTAPI(MetadataToDataCiteXmlMixin):
+    '''
+    Calls to the DataCite REST API
+    '''
+    # Has iter_dois
+    supports_listing = True
+
+    def _call(self, method, path, attributes=None, **kwargs):
+        account_name = config.get("ckanext.doi.account_name")
+        account_password = config.get("ckanext.doi.account_password")
+
+        kwargs['auth'] = (account_name, account_password)
+        kwargs['headers'] = {'Content-Type': CONTENT_TYPE,
+                             'Accept': CONTENT_TYPE}
+        if attributes is not None:
+            kwargs['data'] = json.dumps({
+                'data': {
+                    'type': 'dois',
+                    'attributes': attributes,
+                }
+            })
+
+        # Pagination links are absolute URLs
+        url = path if path.startswith('http') else get_endpoint() + path
+        r = transport.request(method, url, **kwargs)
+        r.raise_for_status()
+        return r
+
+    def _attributes(self, identifier, title, creator, publisher,
+                    publisher_year, **kwargs):
+        xml = self.metadata_to_xml(identifier, title, creator, publisher,
+                                   publisher_year, **kwargs)
+        return {
+            'doi': identifier,
+            'xml': base64.b64encode(xml.encode('utf-8')),
+        }
+
+    def get(self, doi):
+        '''
+        URI: https://api.datacite.org/dois/{doi}
+        @param doi: DOI
+        @return: response with the DOI's attributes as JSON
+        '''
+        return self._call('get', '/dois/{0}'.format(doi))
+
+    def get_url(self, doi):
+        '''
+        The URL a DOI points to
+        @param doi: DOI
+        @return: URL, or None if it hasn't got one
+        '''
+        return self.get(doi).json()['data']['attributes'].get('url')
+
+    def iter_dois(self, page_size=1000):
+        '''
+        URI: https://api.datacite.org/dois?client-id={account}
+        Yield every DOI of the account, a page at a time (cursor pagination,
+        so each page costs the same however far through we are). There is
+        no guaranteed order.
+        @param page_size: DOIs per request, at most 1000
+        '''
+        account_name = config.get('ckanext.doi.account_name') or ''
+        path = '/dois?client-id={0}&page[size]={1}&page[cursor]=1' \
+            .format(account_name.lower(), page_size)
+        while path:
+            page = self._call('get', path).json()
+            for record in page.get('data', []):
+                yield record['id']
+            path = page.get('links', {}).get('next')
+
+    def create(self, url, identifier, title, creator, publisher,
+               publisher_year, **kwargs):
+        '''
+        Mint and publish a DOI, with its URL and metadata, in one call. If
+        the DOI already exists it's updated, with a 200 response rather than
+        201.
+        '''
+        attributes = self._attributes(identifier, title, creator, publisher,
+                                      publisher_year, **kwargs)
+        attributes.update({
+            'event': 'publish',
+            'url': url,
+        })
+        return self._call('put', '/dois/{0}'.format(identifier), attributes)
+
+    def update(self, identifier, title, creator, publisher, publisher_year,
+               **kwargs):
+        '''
+        Update the metadata of a DOI
+        '''
+        attributes = self._attributes(identifier, title, creator, publisher,
+                                      publisher_year, **kwargs)
+        return self._call('put', '/dois/{0}'.format(identifier), attributes)
+
+    def delete(self, doi):
+        '''
+        Findable DOIs can't be deleted, so this hides the DOI: it still
+        resolves, but is no longer in DataCite search
+        @param doi: DOI
+        @return: response
+        '''
+        return self._call('put', '/dois/{0}'.format(doi), {'event': 'hide'})
@@ -2,12 +2,13 @@ import re
 import os
 import abc
 import random
+import urllib
 import logging
 
-import requests
 from pylons import config
 
 import ckanext.doi.api
+from ckanext.doi.api import transport
 from ckanext.doi.api.mixins import MetadataToDataCiteXmlMixin
 
 
@@ -15,6 +16,44 @@ log = logging.getLogger(__name__)
 
 ENDPOINT = 'https://ezid.cdlib.org'
 
+# Structural characters in ANVL, which have to be percent-encoded
+ANVL_ESCAPE_RE = re.compile('[%:\r\n]')
+
+
+def escape(s):
+    '''
+    Percent-encode the ANVL structural characters in a name or value
+    @param s: string
+    @return: escaped string
+    '''
+    return ANVL_ESCAPE_RE.sub(lambda c: '%%%02X' % ord(c.group(0)), s)
+
+
+def to_anvl(data):
+    '''
+    Encode a dict as ANVL, one "name: value" line per item
+    @param data: dict
+    @return: UTF-8 encoded ANVL
+    '''
+    return '\n'.join('%s: %s' % (escape(name), escape(value))
+                     for name, value in data.items()).encode('UTF-8')
+
+
+def from_anvl(text):
+    '''
+    Decode ANVL, as returned by EZID
+    @param text: UTF-8 encoded ANVL
+    @return: dict
+    '''
+    data = {}
+    for line in text.splitlines():
+        if ':' not in line:
+            continue
+        name, value = line.split(':', 1)
+        data[urllib.unquote(name.strip()).decode('UTF-8')] = \
+            urllib.unquote(value.strip()).decode('UTF-8')
+    return data
+
 
 class EzidAPI(object):
 
@@ -43,7 +82,7 @@ class EzidAPI(object):
         # Add authorisation to request
         kwargs['auth'] = (account_name, account_password)
 
-        r = getattr(requests, method)(endpoint, **kwargs)
+        r = transport.request(method, endpoint, **kwargs)
         r.raise_for_status()
         # Return the result
         return r
@@ -60,6 +99,9 @@ class DOIEzidAPI(EzidAPI, MetadataToDataCiteXmlMixin):
     Calls to EZID DOI API
     '''
     path = 'id'
+    # EZID has no API for listing an account's identifiers (there's a batch
+    # download instead), so it can't be reconciled
+    supports_listing = False
 
     def get(self, doi):
         '''
@@ -71,6 +113,14 @@ class DOIEzidAPI(EzidAPI, MetadataToDataCiteXmlMixin):
         '''
         return self._call(path_extra='doi:{0}'.format(doi))
 
+    def get_url(self, doi):
+        '''
+        The URL a DOI points to
+        @param doi: DOI
+        @return: URL, or None if it hasn't got one
+        '''
+        return from_anvl(self.get(doi).content).get('_target')
+
     # def list(self):
     #     '''
     #     list all DOIs
@@ -123,9 +173,6 @@ class DOIEzidAPI(EzidAPI, MetadataToDataCiteXmlMixin):
             encoding as the escaping mechanism, and thus percent signs ("%",
             U+0025) must be escaped as well.
         '''
-        def escape(s):
-            return re.sub("[%:\r\n]", lambda c: "%%%02X" % ord(c.group(0)), s)
-
         metadata_xml = self.metadata_to_xml(identifier, title, creator,
                                             publisher, publisher_year,
                                             **kwargs)
@@ -137,11 +184,9 @@ class DOIEzidAPI(EzidAPI, MetadataToDataCiteXmlMixin):
             data.update({'_target': url})
 
         # data in anvl format requires escaping
-        anvl = "\n".join("%s: %s" % (escape(name), escape(value))
-                         for name, value in data.items()).encode("UTF-8")
-
         r = self._call(path_extra='doi:{0}'.format(identifier), method=method,
-                       data=anvl, headers={'Content-Type': 'text/plain'})
+                       data=to_anvl(data),
+                       headers={'Content-Type': 'text/plain'})
         return r
 
     def create(self, url, identifier, title, creator, publisher,
@@ -162,9 +207,12 @@ class DOIEzidAPI(EzidAPI, MetadataToDataCiteXmlMixin):
 
     def delete(self, doi):
         '''
-        URI: https://test.datacite.org/mds/metadata/{doi} where {doi} is a specific DOI.
-        This request marks a dataset as 'inactive'.
+        URI: https://ezid.cdlib.org/id/doi:{doi} where {doi} is a specific DOI.
+        Public identifiers can't be deleted from EZID, so this marks it
+        unavailable - the DOI still resolves, to an EZID tombstone page.
         @param doi: DOI
         @return: Response code
         '''
-        return self._call(path_extra=doi, method='delete')
+        return self._call(path_extra='doi:{0}'.format(doi), method='post',
+                          data=to_anvl({'_status': 'unavailable | withdrawn'}),
+                          headers={'Content-Type': 'text/plain'})
@@ -1,8 +1,6 @@
-from xmltodict import unparse
-
-import ckan.plugins as p
-
-from ckanext.doi.interfaces import IDoi
+from ckanext.doi import metrics
+from ckanext.doi import plugin_timing
+from ckanext.doi.api import xml_writer
 
 
 class MetadataToDataCiteXmlMixin(object):
@@ -11,11 +9,24 @@ class MetadataToDataCiteXmlMixin(object):
     adheres to the DataCite Metadata Scheme schema.'''
 
     @staticmethod
+    @metrics.timed('metadata_to_xml')
     def metadata_to_xml(identifier, title, creator, publisher, publisher_year,
                         **kwargs):
         '''
         Pass in variables and return XML in the format ready to send to
-        DataCite API
+        DataCite API. See metadata_to_xml_dict for param information.
+        @return: unicode XML, without an XML declaration
+        '''
+        xml_dict = MetadataToDataCiteXmlMixin.metadata_to_xml_dict(
+            identifier, title, creator, publisher, publisher_year, **kwargs)
+        return xml_writer.unparse(xml_dict)
+
+    @staticmethod
+    def metadata_to_xml_dict(identifier, title, creator, publisher,
+                             publisher_year, **kwargs):
+        '''
+        Build the XML dict for the metadata, in xmltodict format, and pass it
+        through the IDoi.metadata_to_xml hooks
 
         @param identifier: DOI
         @param title: A descriptive name for the resource
@@ -27,7 +38,7 @@ class MetadataToDataCiteXmlMixin(object):
         @param publisher_year: The year when the data was (or will be) made
             publicly available.
         @param kwargs: optional metadata
-        @return:
+        @return: XML dict
         '''
 
         # Make sure a var is a list so we can easily loop through it
@@ -126,7 +137,4 @@ class MetadataToDataCiteXmlMixin(object):
                 }
             }
 
-        for plugin in p.PluginImplementations(IDoi):
-            xml_dict = plugin.metadata_to_xml(xml_dict, kwargs)
-
-        return unparse(xml_dict, pretty=True, full_document=False)
+        return plugin_timing.call_metadata_to_xml(xml_dict, kwargs)
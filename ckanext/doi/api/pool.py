@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Concurrent provider client for bulk operations.
+
+Wraps a provider API (eg. DOIEzidAPI) so that many calls are in flight at
+once from a pool of threads - the provider calls spend nearly all their time
+waiting on the network, so threads are enough to keep it busy from one
+process. Calls still go through the shared transport, so they share its
+connection pool, rate limiter and circuit breaker: with
+ckanext.doi.rate_limit set, a bulk job runs at the provider's allowed rate.
+
+    with ConcurrentDOIAPI(get_doi_api(), concurrency=50) as api:
+        for job, result, error in api.imap_unordered(send, jobs):
+            ...
+
+The get, create, update and delete methods wait for their call to finish,
+like the wrapped API.
+"""
+
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+
+from pylons import config
+from requests.exceptions import RequestException
+
+from ckanext.doi.api import transport
+
+log = getLogger(__name__)
+
+
+def get_request_timeout():
+    '''Seconds bulk provider calls wait to connect and for each read (a
+    requests timeout, not a deadline for the whole call), default the
+    transport's connect and read timeouts'''
+    timeout = config.get('ckanext.doi.bulk_request_timeout')
+    return float(timeout) if timeout else None
+
+
+class ConcurrentDOIAPI(object):
+    '''
+    Makes calls to a provider API from a pool of `concurrency` threads, each
+    with a requests timeout (connect and read) of `timeout` seconds
+    '''
+
+    def __init__(self, api, concurrency, timeout=None):
+        self.api = api
+        self.concurrency = concurrency
+        self.timeout = timeout if timeout is not None \
+            else get_request_timeout()
+        if concurrency > transport.get_pool_size():
+            log.warning('Concurrency {0} is more than '
+                        'ckanext.doi.api_pool_size {1} - extra connections '
+                        'won\'t be reused'.format(concurrency,
+                                                  transport.get_pool_size()))
+        self._pool = ThreadPool(concurrency)
+
+    def _run(self, func, args, kwargs):
+        with transport.timeout(self.timeout):
+            return func(*args, **kwargs)
+
+    def submit(self, method, *args, **kwargs):
+        '''
+        Start a call
+        @param method: name of the API method, eg. create
+        @return: multiprocessing AsyncResult - get() returns the response
+        '''
+        return self._pool.apply_async(
+            self._run, (getattr(self.api, method), args, kwargs))
+
+    def _call_job(self, job):
+        func, item = job
+        try:
+            return item, self._run(func, (self.api, item), {}), None
+        except RequestException as e:
+            return item, None, e
+        except Exception as e:
+            # Anything else (eg. building the metadata XML) would be raised
+            # by imap_unordered, ending the caller's loop over the batch
+            log.exception('Bulk DOI call for {0!r} failed'.format(item))
+            return item, None, e
+
+    def imap_unordered(self, func, items):
+        '''
+        Call func(api, item) for each item, concurrently
+        @param func: makes the provider calls for an item
+        @param items: iterable
+        @return: iterator of (item, result, error) in the order they finish.
+            error is the exception raised, if any.
+        '''
+        return self._pool.imap_unordered(self._call_job,
+                                         ((func, item) for item in items))
+
+    def get(self, *args, **kwargs):
+        return self.submit('get', *args, **kwargs).get()
+
+    def create(self, *args, **kwargs):
+        return self.submit('create', *args, **kwargs).get()
+
+    def update(self, *args, **kwargs):
+        return self.submit('update', *args, **kwargs).get()
+
+    def delete(self, *args, **kwargs):
+        return self.submit('delete', *args, **kwargs).get()
+
+    def close(self):
+        '''Wait for the calls in flight, and stop the threads'''
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Token bucket rate limiter for provider calls, shared by every process on
+the host.
+
+Each provider account has a bucket holding up to `burst` tokens, refilled
+at `rate` tokens a second. A call takes a token, waiting for one if the
+bucket is empty. The bucket is a small file, locked with flock while it's
+read and updated, so all the web and worker processes using the same
+directory draw from the same bucket.
+"""
+
+import os
+import re
+import time
+import fcntl
+import tempfile
+from logging import getLogger
+
+from pylons import config
+
+log = getLogger(__name__)
+
+
+def get_rate():
+    '''Provider calls a second, per account. 0 (the default) disables rate
+    limiting.'''
+    return float(config.get('ckanext.doi.rate_limit', 0))
+
+
+def get_burst():
+    '''Calls that can be made at once after a quiet spell, default the rate
+    (at least 1)'''
+    return float(config.get('ckanext.doi.rate_limit_burst',
+                            max(1, get_rate())))
+
+
+def get_directory():
+    '''Directory holding the bucket files'''
+    return config.get('ckanext.doi.rate_limit_dir') or \
+        os.path.join(tempfile.gettempdir(), 'ckanext-doi-rate-limit')
+
+
+def _bucket_path(directory, account):
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', account or 'anonymous')
+    return os.path.join(directory, name + '.bucket')
+
+
+def take_token(account, rate, burst, directory):
+    '''
+    Take a token from the account's bucket. If the bucket is empty the token
+    is taken anyway, leaving the bucket in debt, so later callers queue
+    behind this one.
+    @return: seconds to wait before making the call
+    '''
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process made it first
+            if not os.path.isdir(directory):
+                raise
+    fd = os.open(_bucket_path(directory, account), os.O_RDWR | os.O_CREAT,
+                 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        now = time.time()
+        try:
+            tokens, updated = [float(v) for v in os.read(fd, 64).split()]
+        except ValueError:
+            # New or unreadable bucket - start full
+            tokens, updated = burst, now
+        tokens = min(burst, tokens + max(0, now - updated) * rate) - 1
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, '{0!r} {1!r}'.format(tokens, now))
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
+    return -tokens / rate if tokens < 0 else 0
+
+
+def wait(account):
+    '''
+    Wait until a call can be made for the account, if rate limiting is
+    enabled
+    @param account: provider account name
+    '''
+    rate = get_rate()
+    if rate <= 0:
+        return
+    delay = take_token(account, rate, get_burst(), get_directory())
+    if delay:
+        log.debug('Rate limited: waiting %.2fs to call the provider', delay)
+        time.sleep(delay)
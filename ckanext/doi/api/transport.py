@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+HTTP transport shared by the DOI provider APIs.
+
+All provider calls go through a single requests.Session per process, so
+connections are kept alive and reused rather than opening a new TCP and TLS
+connection for every call, and through the shared rate limiter and the
+circuit breaker.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from logging import getLogger
+
+import requests
+from requests.adapters import HTTPAdapter
+from pylons import config
+from paste.deploy.converters import asint
+
+from ckanext.doi import metrics
+from ckanext.doi.api import rate_limit
+from ckanext.doi.api.breaker import breaker, is_failure
+
+log = getLogger(__name__)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+# Per thread timeout override, see timeout()
+_local = threading.local()
+
+
+def get_pool_size():
+    '''Maximum number of connections kept open to each provider host'''
+    return asint(config.get('ckanext.doi.api_pool_size', 10))
+
+
+def get_timeout():
+    '''
+    Get the (connect, read) timeout for provider calls, in seconds
+    @return: tuple
+    '''
+    return (float(config.get('ckanext.doi.api_connect_timeout', 5)),
+            float(config.get('ckanext.doi.api_read_timeout', 30)))
+
+
+@contextmanager
+def timeout(seconds):
+    '''
+    Use a different timeout for provider calls made by this thread in the
+    block
+    @param seconds: float, (connect, read) tuple, or None for the default
+    '''
+    previous = getattr(_local, 'timeout', None)
+    _local.timeout = seconds
+    try:
+        yield
+    finally:
+        _local.timeout = previous
+
+
+def _create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=get_pool_size())
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    '''
+    Get the requests session for this process. A new one is created after a
+    fork, as connections can't be shared between processes.
+    @return: requests.Session
+    '''
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _create_session()
+                _session_pid = pid
+    return _session
+
+
+def reset_session():
+    '''Close the session, so the next call creates a new one with the
+    current config'''
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def request(method, url, **kwargs):
+    '''
+    Make an HTTP request to the provider, waiting first if the account is
+    over its rate limit
+    @param method: HTTP method, eg. get, put
+    @param url:
+    @param kwargs: passed to requests
+    @return: requests.Response
+    @raise DOIProviderUnavailableError: if the circuit breaker is open
+    '''
+    breaker.before_call()
+    try:
+        auth = kwargs.get('auth')
+        rate_limit.wait(auth[0] if auth else None)
+        kwargs.setdefault('timeout',
+                          getattr(_local, 'timeout', None) or get_timeout())
+        with metrics.timer('provider.call', method=method.upper()) as timer:
+            try:
+                r = get_session().request(method, url, **kwargs)
+            except requests.RequestException as e:
+                breaker.record_failure(e)
+                timer.tags['status'] = 'error'
+                raise
+            timer.tags['status'] = r.status_code
+    except requests.RequestException:
+        raise
+    except Exception:
+        # No response either way, so if this was the breaker's trial call
+        # let the next call be the trial
+        breaker.release()
+        raise
+    if is_failure(r):
+        breaker.record_failure('{0} {1}'.format(r.status_code, r.reason))
+    else:
+        breaker.record_success()
+    return r
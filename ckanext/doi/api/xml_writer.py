@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Serializer for the XML dicts built by MetadataToDataCiteXmlMixin.
+
+Takes the same dicts as xmltodict.unparse - keys starting with @ are
+attributes, #text is the element text, lists are repeated elements - and
+gives exactly the same output as xmltodict.unparse(xml_dict,
+full_document=False), but writes the string pieces straight into a list
+rather than going through a SAX XMLGenerator and a text stream for every
+element.
+"""
+
+ATTR_PREFIX = '@'
+CDATA_KEY = '#text'
+ENCODING = 'utf-8'
+
+
+def escape(data):
+    '''Escape &, < and > (as xml.sax.saxutils.escape)'''
+    if '&' in data:
+        data = data.replace('&', '&amp;')
+    if '>' in data:
+        data = data.replace('>', '&gt;')
+    if '<' in data:
+        data = data.replace('<', '&lt;')
+    return data
+
+
+def quoteattr(data):
+    '''Escape and quote an attribute value (as xml.sax.saxutils.quoteattr)'''
+    data = escape(data)
+    if '\n' in data:
+        data = data.replace('\n', '&#10;')
+    if '\r' in data:
+        data = data.replace('\r', '&#13;')
+    if '\t' in data:
+        data = data.replace('\t', '&#9;')
+    if '"' in data:
+        if "'" in data:
+            return '"%s"' % data.replace('"', '&quot;')
+        return "'%s'" % data
+    return '"%s"' % data
+
+
+def _to_unicode(value):
+    '''Text as the XMLGenerator writes it - byte strings are utf-8'''
+    if isinstance(value, unicode):
+        return value
+    return unicode(value, ENCODING)
+
+
+def _write_element(key, value, out, depth=0):
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    if depth == 0 and len(value) > 1:
+        raise ValueError('document with multiple roots')
+    for v in value:
+        if v is None:
+            out.append(u'<%s></%s>' % (key, key))
+            continue
+        if not isinstance(v, dict):
+            out.append(u'<%s>%s</%s>' % (key, escape(unicode(v)), key))
+            continue
+        cdata = None
+        attrs = []
+        children = []
+        for child_key, child_value in v.items():
+            if child_key == CDATA_KEY:
+                cdata = child_value
+            elif child_key.startswith(ATTR_PREFIX):
+                attrs.append(u' %s=%s' % (child_key[len(ATTR_PREFIX):],
+                                          quoteattr(child_value)))
+            else:
+                children.append((child_key, child_value))
+        out.append(u'<' + key)
+        out.extend(attrs)
+        out.append(u'>')
+        for child_key, child_value in children:
+            _write_element(child_key, child_value, out, depth + 1)
+        if cdata is not None:
+            out.append(escape(_to_unicode(cdata)))
+        out.append(u'</%s>' % key)
+
+
+def unparse(xml_dict):
+    '''
+    Serialize an XML dict, without an XML declaration
+    @param xml_dict: dict with a single root element
+    @return: unicode XML
+    '''
+    ((key, value),) = xml_dict.items()
+    out = []
+    _write_element(key, value, out)
+    return u''.join(out)
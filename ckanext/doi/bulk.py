@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Bulk publishing of DOIs, for paster doi publish-all and paster doi sync, and
+bulk deletion of test DOIs, for paster doi delete-tests.
+
+Packages are read in batches ordered by id (keyset pagination, so each batch
+is a cheap index range scan however far through we are), and the provider
+calls for each batch are made concurrently with api.pool.ConcurrentDOIAPI.
+Database work stays in the main thread.
+"""
+
+import os
+import time
+from logging import getLogger
+
+from pylons import config
+from paste.deploy.converters import asint
+from requests.exceptions import RequestException
+
+import ckan.model as model
+from ckan.model import Session
+import ckan.plugins.toolkit as toolkit
+from ckan.lib import search
+
+from ckanext.doi.api import get_doi_api, TEST_PREFIX
+from ckanext.doi.api.pool import ConcurrentDOIAPI
+from ckanext.doi.model.doi import DOI
+from ckanext.doi.exc import DOIMetadataException, DOIIdentifierError
+from ckanext.doi.lib import (get_dois, build_metadata, validate_metadata,
+                             create_at_provider, mark_published, metadata_hash,
+                             metadata_changed, with_prefix, get_prefix_stats,
+                             withdraw_doi)
+from ckanext.doi.reservations import create_reserved_identifier
+
+log = getLogger(__name__)
+
+PUBLISHED = 'published'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+
+
+def get_concurrency():
+    '''Number of provider calls to make at once in bulk operations'''
+    return asint(config.get('ckanext.doi.bulk_concurrency', 4))
+
+
+def iter_package_id_batches(batch_size, after_id=None,
+                            include_published=False):
+    '''
+    Yield lists of ids of active, public packages with auto_doi_identifier
+    set, in id order
+    @param batch_size:
+    @param after_id: start after this package id
+    @param include_published: include packages whose DOI is already published
+    '''
+    while True:
+        q = Session.query(model.Package.id) \
+            .join(model.PackageExtra,
+                  model.PackageExtra.package_id == model.Package.id) \
+            .filter(model.PackageExtra.key == 'auto_doi_identifier') \
+            .filter(model.PackageExtra.value.in_(['True', 'true'])) \
+            .filter(model.PackageExtra.state == 'active') \
+            .filter(model.Package.state == 'active') \
+            .filter(model.Package.private == False)
+        if not include_published:
+            q = q.outerjoin(DOI, DOI.package_id == model.Package.id) \
+                 .filter(DOI.published == None)
+        if after_id is not None:
+            q = q.filter(model.Package.id > after_id)
+        package_ids = [row[0] for row in
+                       q.order_by(model.Package.id).limit(batch_size)]
+        if not package_ids:
+            return
+        yield package_ids
+        after_id = package_ids[-1]
+
+
+def _prepare(package_ids, counts, failed):
+    '''
+    Build the metadata for a batch of packages, creating DOIs where needed.
+    Published DOIs whose metadata hasn't changed are skipped.
+    @param failed: set the ids of packages which can't be sent are added to
+    @return: list of (package_id, published, metadata_dict)
+    '''
+    # Patch as the site user - the doi_requester validator would otherwise
+    # keep the old doi_identifier when ckanext.doi.doi_request_only_in_orgs
+    # is set
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    context = {'model': model, 'session': Session, 'ignore_auth': True,
+               'user': site_user['name']}
+    dois = get_dois(package_ids)
+    jobs = []
+    for package_id in package_ids:
+        # A failure only undoes this package's new DOI
+        savepoint = Session.begin_nested()
+        try:
+            pkg_dict = toolkit.get_action('package_show')(dict(context),
+                                                          {'id': package_id})
+            doi = dois.get(package_id)
+            if doi is None:
+                doi = create_reserved_identifier(package_id,
+                                                 pkg_dict.get('doi_prefix'))
+            if pkg_dict.get('doi_identifier') != doi.identifier:
+                toolkit.get_action('package_patch')(
+                    dict(context, no_after_update=True),
+                    {'id': package_id, 'doi_identifier': doi.identifier})
+                pkg_dict['doi_identifier'] = doi.identifier
+            metadata_dict = build_metadata(pkg_dict, doi)
+            validate_metadata(metadata_dict)
+            savepoint.commit()
+        # RequestException includes DOIProviderUnavailableError, from
+        # checking a new identifier with the provider
+        except (DOIMetadataException, DOIIdentifierError, RequestException,
+                toolkit.ObjectNotFound, toolkit.ValidationError) as e:
+            savepoint.rollback()
+            log.error('Skipping package {0}: {1}'.format(package_id, e))
+            counts[FAILED] += 1
+            failed.add(package_id)
+            continue
+        if doi.published and not metadata_changed(doi, metadata_dict):
+            counts[UNCHANGED] += 1
+            continue
+        jobs.append((package_id, bool(doi.published), metadata_dict))
+    return jobs
+
+
+def _send(doi_api, job):
+    '''
+    Make the provider call for one package - run in the thread pool
+    @return: outcome
+    '''
+    package_id, published, metadata_dict = job
+    if published:
+        doi_api.update(**metadata_dict)
+        return UPDATED
+    # A DOI minted by an earlier run which crashed before recording it is
+    # updated instead
+    create_at_provider(package_id, metadata_dict, doi_api)
+    return PUBLISHED
+
+
+def read_checkpoint(path):
+    '''Last package id processed, from a checkpoint file'''
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return f.read().strip() or None
+
+
+def _last_succeeded(package_ids, failed):
+    '''The last package id before the first failure, or None'''
+    last = None
+    for package_id in package_ids:
+        if package_id in failed:
+            break
+        last = package_id
+    return last
+
+
+def write_checkpoint(path, package_id):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(package_id)
+    os.rename(tmp_path, path)
+
+
+def publish_all(batch_size=100, concurrency=None, checkpoint=None,
+                include_published=False, progress=None):
+    '''
+    Publish the DOIs of all eligible packages
+    @param batch_size: packages per batch
+    @param concurrency: provider calls at once, defaults to
+        ckanext.doi.bulk_concurrency
+    @param checkpoint: path of a file recording the last package id
+        processed, so an interrupted run can carry on where it left off. It
+        doesn't move past a package which failed, so a rerun retries it.
+    @param include_published: also update the metadata of published DOIs
+    @param progress: callable, passed a dict of counts after each batch
+    @return: dict of counts
+    '''
+    counts = {PUBLISHED: 0, UPDATED: 0, UNCHANGED: 0, FAILED: 0,
+              'packages': 0}
+    started = time.time()
+    # Set once a package has failed, to stop the checkpoint there
+    checkpoint_held = False
+    pool = ConcurrentDOIAPI(get_doi_api(), concurrency or get_concurrency())
+    try:
+        for package_ids in iter_package_id_batches(
+                batch_size, read_checkpoint(checkpoint), include_published):
+            failed = set()
+            published_ids = []
+            jobs = _prepare(package_ids, counts, failed)
+            for (package_id, published, metadata_dict), outcome, error in \
+                    pool.imap_unordered(_send, jobs):
+                if error is not None:
+                    outcome = FAILED
+                counts[outcome] += 1
+                identifier = metadata_dict['identifier']
+                if outcome == PUBLISHED:
+                    mark_published(package_id, identifier,
+                                   metadata_hash(metadata_dict))
+                    published_ids.append(package_id)
+                elif outcome == UPDATED:
+                    Session.query(DOI).filter(DOI.identifier == identifier) \
+                        .update({'metadata_hash': metadata_hash(metadata_dict)})
+                else:
+                    log.error('DOI {0} for package {1} failed: {2}'
+                              .format(identifier, package_id, error))
+                    failed.add(package_id)
+            Session.commit()
+            # Search results hold doi_status from when the package was
+            # indexed
+            for package_id in published_ids:
+                search.rebuild(package_id)
+            counts['packages'] += len(package_ids)
+            if checkpoint and not checkpoint_held:
+                last = _last_succeeded(package_ids, failed)
+                if last is not None:
+                    write_checkpoint(checkpoint, last)
+                checkpoint_held = bool(failed)
+            if progress:
+                progress(dict(counts, elapsed=time.time() - started))
+    finally:
+        pool.close()
+    return counts
+
+
+def backfill_metadata_hashes(batch_size=100, progress=None):
+    '''
+    Store the metadata hash of published DOIs which don't have one, from the
+    current package metadata. This assumes the provider has the current
+    metadata - use sync to send it if not.
+    @return: number of DOIs updated
+    '''
+    context = {'model': model, 'session': Session, 'ignore_auth': True}
+    after = None
+    updated = 0
+    while True:
+        q = Session.query(DOI).filter(DOI.published != None) \
+                   .filter(DOI.metadata_hash == None)
+        if after is not None:
+            q = q.filter(DOI.identifier > after)
+        dois = q.order_by(DOI.identifier).limit(batch_size).all()
+        if not dois:
+            return updated
+        for doi in dois:
+            try:
+                pkg_dict = toolkit.get_action('package_show')(
+                    dict(context), {'id': doi.package_id})
+            except toolkit.ObjectNotFound:
+                continue
+            doi.metadata_hash = metadata_hash(build_metadata(pkg_dict, doi))
+            updated += 1
+        Session.commit()
+        after = dois[-1].identifier
+        if progress:
+            progress(updated)
+
+
+def _withdraw(doi_api, identifier):
+    '''Withdraw one DOI from the provider - run in the thread pool'''
+    withdraw_doi(identifier, doi_api)
+
+
+def delete_test_dois(batch_size=1000, provider=False, concurrency=None,
+                     dry_run=False, progress=None):
+    '''
+    Delete the DOIs with the test prefix, a batch at a time, committing
+    after each batch so locks are only held briefly
+    @param batch_size: DOIs per batch
+    @param provider: also withdraw published DOIs from the provider. If
+        that fails the local DOI is kept, so a rerun tries again.
+    @param concurrency: provider calls at once, defaults to
+        ckanext.doi.bulk_concurrency
+    @param dry_run: only count the DOIs which would be deleted
+    @param progress: callable, passed a dict of counts after each batch
+    @return: dict of counts - total, published, deleted, withdrawn, failed
+    '''
+    stats = get_prefix_stats(TEST_PREFIX)
+    counts = {'total': stats['total'], 'published': stats['published'],
+              'deleted': 0, 'withdrawn': 0, 'failed': 0}
+    if dry_run:
+        return counts
+
+    pool = ConcurrentDOIAPI(get_doi_api(), concurrency or get_concurrency()) \
+        if provider else None
+    after = None
+    try:
+        while True:
+            q = Session.query(DOI.identifier, DOI.published) \
+                       .filter(with_prefix(DOI.identifier, TEST_PREFIX))
+            if after is not None:
+                q = q.filter(DOI.identifier > after)
+            rows = q.order_by(DOI.identifier).limit(batch_size).all()
+            if not rows:
+                break
+            after = rows[-1][0]
+            identifiers = [identifier for identifier, published in rows]
+            if pool is not None:
+                published = [identifier for identifier, published in rows
+                             if published]
+                for identifier, result, error in \
+                        pool.imap_unordered(_withdraw, published):
+                    if error is None:
+                        counts['withdrawn'] += 1
+                        continue
+                    log.error('Withdrawing test DOI {0} failed: {1}'
+                              .format(identifier, error))
+                    counts['failed'] += 1
+                    identifiers.remove(identifier)
+            if identifiers:
+                Session.query(DOI) \
+                       .filter(DOI.identifier.in_(identifiers)) \
+                       .delete(synchronize_session=False)
+            Session.commit()
+            counts['deleted'] += len(identifiers)
+            if progress:
+                progress(counts)
+    finally:
+        if pool is not None:
+            pool.close()
+    return counts
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Small in-process caches.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+# Returned by LRUCache.get for missing or expired keys, as None can be cached
+MISSING = object()
+
+
+class LRUCache(object):
+    '''
+    Thread safe cache of at most `size` items, each kept for at most `ttl`
+    seconds. When full, the least recently used item is dropped. A size of 0
+    disables the cache.
+    '''
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # Move to the most recently used end
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
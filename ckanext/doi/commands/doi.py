@@ -1,27 +1,99 @@
 
+import time
 import logging
 from ckan.lib.cli import CkanCommand
-from ckanext.doi.model.doi import DOI
 from ckanext.doi.model.repo import Repository
-from ckanext.doi.config import TEST_PREFIX
-from ckan.model import Session, meta
+from ckanext.doi.lib import get_prefix_stats
+from ckanext.doi.operations import process_queue
+from ckanext.doi.reservations import top_up
+from ckanext.doi.helpers import get_prefixes
+from ckanext.doi.bulk import (publish_all, backfill_metadata_hashes,
+                              delete_test_dois)
+from ckanext.doi.reconcile import reconcile, provider_supports_listing
+from ckan.model import meta
 
 log = logging.getLogger(__name__)
 
 class DOICommand(CkanCommand):
     """
 
-    Delete all test DOIs
+    Delete all test DOIs, in batches, optionally also withdrawing them from
+    the provider, or with --dry-run just count them
 
-    paster doi delete-tests -c /etc/ckan/default/development.ini
+    paster doi delete-tests [--batch-size=N] [--provider] [--concurrency=N] [--dry-run] -c /etc/ckan/default/development.ini
     paster doi upgrade-db -c /etc/ckan/default/development.ini
 
+    Send the DOI operations waiting in the outbox to the provider
+
+    paster doi process-queue [--limit=N] [--batch-size=N] [--loop] -c /etc/ckan/default/development.ini
+
+    Top up the pool of reserved identifiers for each prefix
+    (ckanext.doi.reservation_pool_size)
+
+    paster doi reserve [--size=N] [--loop] -c /etc/ckan/default/development.ini
+
+    Publish the DOIs of all active, public datasets with auto_doi_identifier
+    set, or with sync also update the metadata of published DOIs
+
+    paster doi publish-all [--batch-size=N] [--concurrency=N] [--checkpoint=FILE] -c /etc/ckan/default/development.ini
+    paster doi sync [--batch-size=N] [--concurrency=N] [--checkpoint=FILE] -c /etc/ckan/default/development.ini
+
+    Store the metadata hash of published DOIs which don't have one (after
+    upgrading the database to version 3)
+
+    paster doi backfill-hashes [--batch-size=N] -c /etc/ckan/default/development.ini
+
+    Compare the doi table with the DOIs the provider has, and with --fix
+    re-queue DOIs missing from the provider and mark those it has published
+
+    paster doi reconcile [--fix] -c /etc/ckan/default/development.ini
+
+    Number of DOIs, published and unpublished, for each prefix (or the
+    prefix given)
+
+    paster doi stats [PREFIX] -c /etc/ckan/default/development.ini
+
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
     max_args = 2
     min_args = 1
 
+    def __init__(self, name):
+        super(DOICommand, self).__init__(name)
+        self.parser.add_option('--limit', dest='limit', type='int',
+                               default=None,
+                               help='Maximum number of items to process')
+        self.parser.add_option('--size', dest='size', type='int',
+                               default=None,
+                               help='Number of identifiers to reserve')
+        self.parser.add_option('--batch-size', dest='batch_size', type='int',
+                               default=100,
+                               help='Number of datasets per batch')
+        self.parser.add_option('--concurrency', dest='concurrency',
+                               type='int', default=None,
+                               help='Number of provider calls to make at once')
+        self.parser.add_option('--checkpoint', dest='checkpoint',
+                               default=None,
+                               help='File to record progress in, to resume '
+                                    'an interrupted run')
+        self.parser.add_option('--fix', dest='fix', action='store_true',
+                               default=False,
+                               help='Fix the problems found')
+        self.parser.add_option('--provider', dest='provider',
+                               action='store_true', default=False,
+                               help='Also withdraw DOIs from the provider')
+        self.parser.add_option('--dry-run', dest='dry_run',
+                               action='store_true', default=False,
+                               help='Report what would be done, without '
+                                    'changing anything')
+        self.parser.add_option('--loop', dest='loop', action='store_true',
+                               default=False,
+                               help='Keep running, checking every interval')
+        self.parser.add_option('--interval', dest='interval', type='int',
+                               default=10,
+                               help='Seconds between checks when looping')
+
     def command(self):
 
         if not self.args or self.args[0] in ['--help', '-h', 'help']:
@@ -36,14 +108,40 @@ class DOICommand(CkanCommand):
             self.delete_tests()
         elif cmd == 'upgrade-db':
             self.upgrade_db()
+        elif cmd == 'process-queue':
+            self.process_queue()
+        elif cmd == 'reserve':
+            self.reserve()
+        elif cmd == 'publish-all':
+            self.publish_all()
+        elif cmd == 'sync':
+            self.publish_all(include_published=True)
+        elif cmd == 'backfill-hashes':
+            self.backfill_hashes()
+        elif cmd == 'reconcile':
+            self.reconcile()
+        elif cmd == 'stats':
+            self.stats()
         else:
             print 'Command %s not recognized' % cmd
 
     def delete_tests(self):
+        """
+        Delete the test DOIs in batches
+        @return:
+        """
+        def progress(counts):
+            print 'Deleted %(deleted)s of %(total)s test DOIs (%(withdrawn)s withdrawn, %(failed)s failed)' % counts
 
-        print 'Deleting all test DOIs'
-        Session.query(DOI).filter(DOI.identifier.like('%' + TEST_PREFIX + '%')).delete(synchronize_session=False)
-        Session.commit()
+        counts = delete_test_dois(batch_size=self.options.batch_size,
+                                  provider=self.options.provider,
+                                  concurrency=self.options.concurrency,
+                                  dry_run=self.options.dry_run,
+                                  progress=progress)
+        if self.options.dry_run:
+            print 'Would delete %(total)s test DOIs (%(published)s published)' % counts
+        else:
+            print 'Finished: deleted %(deleted)s test DOIs, %(withdrawn)s withdrawn, %(failed)s failed' % counts
 
     def upgrade_db(self):
         """
@@ -56,4 +154,88 @@ class DOICommand(CkanCommand):
         if len(self.args) > 1:
             repo.upgrade(self.args[1])
         else:
-            repo.upgrade()
\ No newline at end of file
+            repo.upgrade()
+
+    def process_queue(self):
+        """
+        Drain the outbox of DOI operations, optionally polling for new ones
+        @return:
+        """
+        while True:
+            succeeded, failed = process_queue(self.options.limit,
+                                             self.options.batch_size)
+            if succeeded or failed:
+                print 'Processed %s DOI operations (%s failed)' % (succeeded + failed, failed)
+            if not self.options.loop:
+                break
+            time.sleep(self.options.interval)
+
+    def reserve(self):
+        """
+        Keep the pool of reserved identifiers topped up for every prefix
+        @return:
+        """
+        while True:
+            for prefix in get_prefixes():
+                if not prefix['value']:
+                    continue
+                added = top_up(prefix['value'], self.options.size)
+                if added:
+                    print 'Reserved %s identifiers for %s' % (added, prefix['value'])
+            if not self.options.loop:
+                break
+            time.sleep(self.options.interval)
+
+    def publish_all(self, include_published=False):
+        """
+        Publish (and for sync, update) the DOIs of all eligible datasets
+        @param include_published: update published DOIs
+        @return:
+        """
+        def progress(counts):
+            print '%(packages)s datasets: %(published)s published, %(updated)s updated, %(unchanged)s unchanged, %(failed)s failed (%(elapsed).0fs)' % counts
+
+        counts = publish_all(batch_size=self.options.batch_size,
+                             concurrency=self.options.concurrency,
+                             checkpoint=self.options.checkpoint,
+                             include_published=include_published,
+                             progress=progress)
+        print 'Finished: %(packages)s datasets, %(published)s published, %(updated)s updated, %(unchanged)s unchanged, %(failed)s failed' % counts
+
+    def backfill_hashes(self):
+        """
+        Store metadata hashes for published DOIs
+        @return:
+        """
+        def progress(updated):
+            print 'Stored %s metadata hashes' % updated
+
+        updated = backfill_metadata_hashes(self.options.batch_size, progress)
+        print 'Finished: stored %s metadata hashes' % updated
+
+    def reconcile(self):
+        """
+        Report (and with --fix, fix) differences between the doi table and
+        the provider
+        @return:
+        """
+        def report(problem, identifier, package_id):
+            print '%s\t%s\t%s' % (problem, identifier, package_id or '')
+
+        if not provider_supports_listing():
+            print 'Cannot reconcile: the DOI provider can\'t list its identifiers'
+            return
+        counts = reconcile(apply_fixes=self.options.fix, report=report)
+        print 'Finished: %(missing)s missing, %(unpublished)s unpublished, %(orphaned)s orphaned, %(fixed)s fixed' % counts
+
+    def stats(self):
+        """
+        Print the number of DOIs for each prefix
+        @return:
+        """
+        if len(self.args) > 1:
+            prefixes = [self.args[1]]
+        else:
+            prefixes = [p['value'] for p in get_prefixes() if p['value']]
+        for prefix in prefixes:
+            print '%(prefix)s: %(total)s DOIs, %(published)s published, %(unpublished)s unpublished' % get_prefix_stats(prefix)
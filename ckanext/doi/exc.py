@@ -5,6 +5,8 @@ Created by 'bens3' on 2013-06-21.
 Copyright (c) 2013 'bens3'. All rights reserved.
 """
 
+from requests.exceptions import ConnectionError
+
 
 class DOIMetadataException(Exception):
     """
@@ -17,3 +19,16 @@ class DOIAPITypeNotKnownError(Exception):
     '''Exception when ckanext.doi.api_provider has been set to a value not known
     by the api.get_*_api methods'''
     pass
+
+
+class DOIIdentifierError(Exception):
+    '''Exception when a unique identifier can't be created - an unknown
+    ckanext.doi.identifier_generator, or the generator has run out of
+    identifiers'''
+    pass
+
+
+class DOIProviderUnavailableError(ConnectionError):
+    '''Exception when the circuit breaker is open, after repeated provider
+    failures, so the call wasn't made'''
+    pass
@@ -8,10 +8,15 @@ Copyright (c) 2013 'bens3'. All rights reserved.
 from pylons import config
 from datetime import datetime
 import dateutil.parser as parser
+import sqlalchemy as sa
+from paste.deploy.converters import asint
 
+import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 import ckan.authz as authz
 
+from ckanext.doi.cache import LRUCache, MISSING
+
 import logging
 log = logging.getLogger(__name__)
 
@@ -41,6 +46,105 @@ def now():
     return datetime.now()
 
 
+# (package id, metadata_modified, doi status, resource id) -> citation
+_citation_cache = None
+
+
+def get_citation_cache():
+    '''Cache of citations, sized by ckanext.doi.citation_cache_size'''
+    global _citation_cache
+    if _citation_cache is None:
+        _citation_cache = LRUCache(
+            asint(config.get('ckanext.doi.citation_cache_size', 1000)))
+    return _citation_cache
+
+
+def doi_citation(pkg_dict, res=None):
+    '''
+    The citation text for a package or resource, before the DOI link, eg.
+    "Ben (2016). Dataset: Birds. Resource: Sightings. NHM Data Portal."
+    Cached until the package is modified, so landing pages don't parse the
+    dates again on every view.
+    @param pkg_dict:
+    @param res: resource dict, for a resource citation
+    @return: unicode
+    '''
+    cache = get_citation_cache()
+    key = (pkg_dict['id'], pkg_dict.get('metadata_modified'),
+           pkg_dict.get('doi_status'), res['id'] if res else None)
+    citation = cache.get(key)
+    if citation is MISSING:
+        citation = u'{0} ({1}). Dataset: {2}.'.format(
+            pkg_dict['author'], package_get_year(pkg_dict),
+            pkg_dict['title'])
+        if res:
+            citation += u' Resource: {0}.'.format(res['name'])
+        site_title = get_site_title()
+        if site_title:
+            citation += u' {0}.'.format(site_title)
+        cache.set(key, citation)
+    return citation
+
+
+def get_request_org_id(data):
+    '''
+    The organization a DOI is being requested in
+    @param data: package dict, or flattened package data in validators
+    @return: org id or name, or None
+    '''
+    return data.get('owner_org') or data.get('group_id') \
+        or data.get(('owner_org',), None)
+
+
+# (user, org, roles) -> whether the user can request DOIs in the org
+_permission_cache = None
+
+
+def get_permission_cache():
+    '''
+    Cache of DOI request permissions, sized by
+    ckanext.doi.permission_cache_size and kept for
+    ckanext.doi.permission_cache_ttl seconds
+    '''
+    global _permission_cache
+    if _permission_cache is None:
+        _permission_cache = LRUCache(
+            asint(config.get('ckanext.doi.permission_cache_size', 1000)),
+            asint(config.get('ckanext.doi.permission_cache_ttl', 60)))
+    return _permission_cache
+
+
+def clear_permission_cache(*args):
+    '''Forget cached permissions - used as an SQLAlchemy event listener'''
+    if _permission_cache is not None:
+        _permission_cache.clear()
+
+
+def listen_for_permission_changes():
+    '''
+    Clear the permission cache when this process changes a user or a
+    membership. Changes made by other processes show after the TTL.
+    '''
+    for mapped_class in (model.Member, model.User):
+        for event in ('after_insert', 'after_update', 'after_delete'):
+            if not sa.event.contains(mapped_class, event,
+                                     clear_permission_cache):
+                sa.event.listen(mapped_class, event, clear_permission_cache)
+
+
+def _user_can_request_doi(user, org_id, roles):
+    # Sysadmins can do anything
+    if authz.is_sysadmin(user):
+        return True
+
+    # ckanext.doi.doi_request_only_in_orgs must be True, so we need an org
+    if not org_id:
+        return False
+
+    # Is the user's role in the allowed roles list?
+    return authz.users_role_for_group_or_org(org_id, user) in roles.split()
+
+
 def can_request_doi(user, data):
     '''
     Determine whether the user can request a doi for a package.
@@ -51,32 +155,21 @@ def can_request_doi(user, data):
        is False:
         return True
 
-    if user:
-        user_obj = toolkit.get_action('user_show')(
-            data_dict={'id': user})
-        # Sysadmins can do anything
-        if user_obj['sysadmin']:
-            return True
-
-    org_id = data.get('owner_org') or data.get('group_id') \
-        or data.get(('owner_org',), None)
-
-    # ckanext.doi.doi_request_only_in_orgs must be True, so we need a user and
-    # an org
-    if not user or not org_id:
+    if not user:
         return False
 
     # Roles authorized if ckanext.doi.doi_request_roles_in_orgs if not defined
     # in config.
-    default_roles = "admin editor"
-
-    # Is the user's role in the allowed roles list?
-    user_role = authz.users_role_for_group_or_org(org_id, user)
-    if user_role in config.get("ckanext.doi.doi_request_roles_in_orgs",
-                               default_roles).split():
-        return True
-
-    return False
+    roles = config.get('ckanext.doi.doi_request_roles_in_orgs',
+                       'admin editor')
+
+    cache = get_permission_cache()
+    key = (user, get_request_org_id(data), roles)
+    allowed = cache.get(key)
+    if allowed is MISSING:
+        allowed = _user_can_request_doi(user, key[1], roles)
+        cache.set(key, allowed)
+    return allowed
 
 
 def get_prefixes():
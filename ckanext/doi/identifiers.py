@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Generators for the identifier part of new DOIs (the part after the prefix).
+
+The generator is set with ckanext.doi.identifier_generator, or per prefix
+with a "generator" key in the ckanext.doi.prefix_choices file:
+
+    random   - random 7 digit number, checked against the doi table and the
+               provider before use (the default)
+    sequence - a database sequence number, shuffled with a keyed permutation
+               into a fixed length decimal number
+    base32   - a shuffled sequence number in Crockford base32, with a check
+               character
+
+The sequence and base32 generators can't produce the same identifier twice,
+so their identifiers don't need checking against the provider. Sequence
+identifiers never start with 0 and base32 identifiers have a different
+length, so neither can clash with ones made by the random generator.
+"""
+
+import hmac
+import random
+import hashlib
+
+import sqlalchemy as sa
+from pylons import config
+from paste.deploy.converters import asint
+
+from ckan.model import Session
+
+from ckanext.doi.api import get_doi_api
+from ckanext.doi.exc import DOIIdentifierError
+from ckanext.doi.model.doi import doi_identifier_seq
+
+# Crockford base32 - no I, L, O or U
+BASE32_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+FEISTEL_ROUNDS = 6
+
+
+def permute(value, domain_size, key):
+    '''
+    Keyed permutation of the integers 0 to domain_size - 1, so every value
+    maps to a different one. A Feistel network over the smallest even number
+    of bits that covers the domain, applied until the result is in the
+    domain.
+    @param value: integer, 0 <= value < domain_size
+    @param domain_size:
+    @param key: secret string
+    @return: integer, 0 <= result < domain_size
+    '''
+    half_bits = max(1, ((domain_size - 1).bit_length() + 1) // 2)
+    mask = (1 << half_bits) - 1
+    while True:
+        left, right = value >> half_bits, value & mask
+        for round_number in range(FEISTEL_ROUNDS):
+            digest = hmac.new(key, '{0}:{1}'.format(round_number, right),
+                              hashlib.sha256).hexdigest()
+            left, right = right, left ^ (int(digest[:16], 16) & mask)
+        value = (left << half_bits) | right
+        if value < domain_size:
+            return value
+
+
+def base32_check_character(s):
+    '''Luhn mod 32 check character for a base32 string'''
+    total = 0
+    factor = 2
+    for char in reversed(s):
+        addend = factor * BASE32_ALPHABET.index(char)
+        total += addend // 32 + addend % 32
+        factor = 1 if factor == 2 else 2
+    return BASE32_ALPHABET[-total % 32]
+
+
+def is_valid_base32_identifier(identifier_id):
+    '''Check the last character of a base32 identifier is its check
+    character'''
+    identifier_id = identifier_id.upper()
+    if len(identifier_id) < 2 or \
+       any(c not in BASE32_ALPHABET for c in identifier_id):
+        return False
+    return base32_check_character(identifier_id[:-1]) == identifier_id[-1]
+
+
+class IdentifierGenerator(object):
+    '''
+    Base class for identifier generators
+    '''
+
+    # True if the generator can never repeat an identifier, so there's no need
+    # to check new identifiers against the doi table or the provider
+    collision_free = False
+    default_length = None
+
+    def __init__(self, length=None, key=''):
+        self.length = length or self.default_length
+        self.key = key.encode('utf-8') if isinstance(key, unicode) else key
+
+    def make_identifier_id(self):
+        raise NotImplementedError
+
+
+class RandomIdentifierGenerator(IdentifierGenerator):
+    '''
+    Random 7 digit number, eg. 0044634. The api provider may have its own
+    make_identifier_id method, which is used instead.
+    '''
+
+    def make_identifier_id(self):
+        try:
+            return get_doi_api().make_identifier_id()
+        except AttributeError:
+            return '{0:07}'.format(random.randint(1, 100000))
+
+
+class SequenceIdentifierGenerator(IdentifierGenerator):
+    '''
+    Next value of the doi_identifier_seq database sequence, shuffled into a
+    decimal number of `length` digits (default 7), which never starts with 0.
+    '''
+
+    collision_free = True
+    default_length = 7
+
+    @property
+    def domain_size(self):
+        return 9 * 10 ** (self.length - 1)
+
+    def _next_index(self):
+        '''Index into the domain from the database sequence, starting at 0'''
+        index = Session.execute(
+            sa.select([doi_identifier_seq.next_value()])).scalar() - 1
+        if index >= self.domain_size:
+            raise DOIIdentifierError('Identifier generator has run out of '
+                                     '{0} character identifiers'
+                                     .format(self.length))
+        return index
+
+    def format(self, value):
+        return str(10 ** (self.length - 1) + value)
+
+    def make_identifier_id(self):
+        value = permute(self._next_index(), self.domain_size, self.key)
+        return self.format(value)
+
+
+class Base32IdentifierGenerator(SequenceIdentifierGenerator):
+    '''
+    Shuffled sequence number as `length` (default 8) Crockford base32
+    characters, followed by a check character, eg. 3WQ8K0ZHJ.
+    '''
+
+    default_length = 8
+
+    @property
+    def domain_size(self):
+        return 32 ** self.length
+
+    def format(self, value):
+        chars = []
+        for i in range(self.length):
+            value, remainder = divmod(value, 32)
+            chars.append(BASE32_ALPHABET[remainder])
+        identifier_id = ''.join(reversed(chars))
+        return identifier_id + base32_check_character(identifier_id)
+
+
+GENERATORS = {
+    'random': RandomIdentifierGenerator,
+    'sequence': SequenceIdentifierGenerator,
+    'base32': Base32IdentifierGenerator,
+}
+
+
+def _get_prefix_options(prefix):
+    '''Options for the prefix from the ckanext.doi.prefix_choices file'''
+    from ckanext.doi.helpers import _get_multiple_prefixes
+    for choice in _get_multiple_prefixes() or []:
+        choice_prefix = '{0}/{1}'.format(choice['prefix'],
+                                         choice.get('shoulder', ''))
+        if choice_prefix.rstrip('/') == prefix.rstrip('/'):
+            return choice
+    return {}
+
+
+def get_identifier_generator(prefix):
+    '''
+    Get the identifier generator for a prefix
+    @param prefix: prefix and shoulder, eg. 10.5072/FK2
+    @return: IdentifierGenerator
+    '''
+    options = _get_prefix_options(prefix)
+    name = options.get('generator') or \
+        config.get('ckanext.doi.identifier_generator', 'random')
+    length = options.get('length') or \
+        config.get('ckanext.doi.identifier_length')
+    try:
+        generator_class = GENERATORS[name]
+    except KeyError:
+        raise DOIIdentifierError('No known identifier generator: {0}'
+                                 .format(name))
+    return generator_class(length=asint(length) if length else None,
+                           key=config.get('ckanext.doi.identifier_key', ''))
@@ -6,28 +6,42 @@ Copyright (c) 2013 'bens3'. All rights reserved.
 """
 
 import os
-import random
+import json
+import hashlib
 import datetime
 import itertools
 from logging import getLogger
 
+import sqlalchemy as sa
 from pylons import config
+from paste.deploy.converters import asbool, asint
 from requests.exceptions import HTTPError
 
 from ckan.model import Session
 import ckan.model as model
 from ckan.lib import helpers as h
-import ckan.plugins as p
 
 from ckanext.doi.api import get_doi_api, get_prefix
-from ckanext.doi.model.doi import DOI
-from ckanext.doi.interfaces import IDoi
-from ckanext.doi.exc import DOIMetadataException
+from ckanext.doi.model.doi import DOI, doi_table
+from ckanext.doi.model.reservation import DOIReservation
+from ckanext.doi.identifiers import get_identifier_generator
+from ckanext.doi.exc import DOIMetadataException, DOIIdentifierError
 from ckanext.doi.helpers import package_get_year
+from ckanext.doi import metrics
+from ckanext.doi import plugin_timing
 
 log = getLogger(__name__)
 
 
+# Claim an identifier in one statement (PostgreSQL 9.5+)
+INSERT_IDENTIFIER_SQL = '''
+    INSERT INTO doi (identifier, package_id)
+    VALUES (:identifier, :package_id)
+    ON CONFLICT (identifier) DO NOTHING
+    RETURNING identifier
+'''
+
+
 def _prepare_prefix(prefix):
     '''Ensure prefix has at least one '/' '''
     if prefix.count('/') == 0:
@@ -35,22 +49,61 @@ def _prepare_prefix(prefix):
     return prefix
 
 
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%') \
+                .replace('_', '\\_')
+
+
+def with_prefix(column, prefix):
+    '''
+    Filter for identifiers starting with a prefix. The LIKE pattern is
+    anchored, so it can use the ix_doi_identifier_pattern index.
+    @param column: eg. DOI.identifier
+    @param prefix: eg. 10.5072 or 10.5072/FK2
+    '''
+    return column.like(_escape_like(_prepare_prefix(prefix)) + u'%',
+                       escape='\\')
+
+
+def get_prefix_stats(prefix):
+    '''
+    Number of DOIs with a prefix
+    @return: dict with prefix, total, published and unpublished
+    '''
+    total, published = Session.query(sa.func.count(DOI.identifier),
+                                     sa.func.count(DOI.published)) \
+                              .filter(with_prefix(DOI.identifier, prefix)) \
+                              .one()
+    return {'prefix': prefix, 'total': total, 'published': published,
+            'unpublished': total - published}
+
+
 def create_doi_from_identifier(package_id, identifier):
     '''Can be called when an identifier has already been created elsewhere.
-    Does not ensure the identifier is unique'''
+    Does not ensure the identifier is unique. This doesn't commit - the DOI
+    is saved in the same transaction as the dataset change.'''
     doi = DOI(package_id=package_id, identifier=identifier)
     Session.add(doi)
-    Session.commit()
+    Session.flush()
     return doi
 
 
-def create_unique_identifier(package_id, prefix):
+def get_max_attempts():
+    '''Number of identifiers to try before giving up on making a unique one,
+    at least 1'''
+    return max(1, asint(config.get('ckanext.doi.identifier_max_attempts',
+                                   100)))
+
+
+def _new_identifiers(prefix):
     '''
-    Create a unique identifier, using the prefix and a random number:
+    Generate new identifiers, using the prefix and an identifier from the
+    prefix's identifier generator (by default a random number):
     10.5072/0044634
 
-    Check the random number doesn't exist in the table or the datacite
-    repository
+    Unless the generator can't repeat identifiers, skip any which have been
+    reserved or exist in the datacite repository. Raises DOIIdentifierError
+    after ckanext.doi.identifier_max_attempts.
     '''
     doi_api = get_doi_api()
 
@@ -61,19 +114,18 @@ def create_unique_identifier(package_id, prefix):
     # If prefix doesn't have at least one `/`, add one to the end
     prefix = _prepare_prefix(prefix)
 
-    while True:
-        # the api provider may have a make_identifier_id method, try it first,
-        # then fall back to default.
-        try:
-            identifier_id = doi_api.make_identifier_id()
-        except AttributeError:
-            identifier_id = '{0:07}'.format(random.randint(1, 100000))
+    generator = get_identifier_generator(prefix)
 
+    for attempt in range(get_max_attempts()):
         # identifier = os.path.join(get_prefix(), identifier_id)
-        identifier = prefix + identifier_id
+        identifier = prefix + generator.make_identifier_id()
+
+        if not generator.collision_free:
+            # Check this identifier hasn't been reserved
+            if Session.query(DOIReservation) \
+                      .filter(DOIReservation.identifier == identifier).count():
+                continue
 
-        # Check this identifier doesn't exist in the table
-        if not Session.query(DOI).filter(DOI.identifier == identifier).count():
             # And check against the api service
             try:
                 doi = doi_api.get(identifier)
@@ -83,9 +135,98 @@ def create_unique_identifier(package_id, prefix):
                 if doi.text:
                     continue
 
-        doi = create_doi_from_identifier(package_id, identifier)
+        yield identifier
+
+    raise DOIIdentifierError('Could not make a unique identifier for prefix '
+                             '{0} in {1} attempts'
+                             .format(prefix, get_max_attempts()))
 
-        return doi
+
+def make_unique_identifier(prefix):
+    '''
+    Make a new identifier that isn't in the doi table, the reserved
+    identifiers or the datacite repository
+    @return: identifier
+    '''
+    for identifier in _new_identifiers(prefix):
+        # Check this identifier doesn't exist in the table
+        if not Session.query(DOI).filter(DOI.identifier == identifier).count():
+            return identifier
+
+
+def _get_dialect(executor):
+    try:
+        return executor.dialect
+    except AttributeError:
+        return executor.get_bind().dialect
+
+
+def supports_skip_locked(executor=Session):
+    '''
+    Whether the database can skip rows other transactions have locked, with
+    SELECT ... FOR UPDATE SKIP LOCKED (PostgreSQL 9.5+)
+    @param executor: Session or Connection
+    '''
+    dialect = _get_dialect(executor)
+    return dialect.name == 'postgresql' and \
+        (dialect.server_version_info or ()) >= (9, 5)
+
+
+def insert_identifier(executor, package_id, identifier):
+    '''
+    Insert a DOI row for the identifier, unless the identifier is already
+    used. This is a single atomic step, so if two processes insert the same
+    identifier at the same time only one succeeds.
+    @param executor: Session or Connection
+    @param package_id:
+    @param identifier:
+    @return: True if inserted, False if the identifier is already used
+    '''
+    dialect = _get_dialect(executor)
+    if dialect.name == 'postgresql' and \
+       (dialect.server_version_info or ()) >= (9, 5):
+        row = executor.execute(sa.text(INSERT_IDENTIFIER_SQL),
+                               {'identifier': identifier,
+                                'package_id': package_id}).fetchone()
+        return row is not None
+
+    # Otherwise insert in a savepoint, so a duplicate only rolls back the
+    # insert
+    savepoint = executor.begin_nested()
+    try:
+        executor.execute(doi_table.insert().values(
+            identifier=identifier, package_id=package_id))
+    except sa.exc.IntegrityError as e:
+        savepoint.rollback()
+        existing = executor.execute(
+            sa.select([doi_table.c.identifier])
+              .where(doi_table.c.identifier == identifier)).first()
+        # Something else is wrong, eg. the package already has a DOI
+        if existing is None:
+            raise e
+        return False
+    savepoint.commit()
+    return True
+
+
+def create_unique_identifier(package_id, prefix):
+    '''
+    Create a DOI for the package with a new unique identifier. The identifier
+    is claimed with insert_identifier, so it's safe for concurrent requests.
+    This doesn't commit - the DOI is saved in the same transaction as the
+    dataset change.
+    @return: DOI
+    '''
+    with metrics.timer('create_unique_identifier'):
+        for attempt, identifier in enumerate(_new_identifiers(prefix), 1):
+            if insert_identifier(Session, package_id, identifier):
+                break
+        if attempt > 1:
+            log.info('Created identifier {0} after {1} attempts'
+                     .format(identifier, attempt))
+    metrics.incr('create_unique_identifier.retries', attempt - 1)
+
+    return get_doi(package_id)
 
 
 def publish_doi(package_id, **kwargs):
@@ -102,29 +243,78 @@ def publish_doi(package_id, **kwargs):
     '''
     identifier = kwargs.get('identifier')
 
-    doi_api = get_doi_api()
-
-    # The ID of a dataset never changes, so use that for the URL
-    url = os.path.join(get_site_url(), 'dataset', package_id)
-
     try:
-        r = doi_api.create(url=url, **kwargs)
+        r = create_at_provider(package_id, kwargs)
     except HTTPError as e:
         log.error('Publishing DOI for package {0} failed with error: {1}'
                   .format(package_id, e.message))
         raise e
 
-    # If we have created the DOI, save it to the database
-    if r.status_code == 201:
-        # Update status for this package and identifier
-        num_affected = Session.query(DOI) \
-                            .filter_by(package_id=package_id,
-                                       identifier=identifier) \
-                            .update({"published": datetime.datetime.now()})
-        # Raise an error if update has failed - should never happen unless
-        # DataCite and local db get out of sync - in which case requires
-        # investigating
-        assert num_affected == 1, 'Updating local DOI failed'
+    # If we have created the DOI, save it to the database. The DataCite REST
+    # API returns 200 if the DOI already existed and has been updated.
+    if r.status_code in (200, 201):
+        mark_published(package_id, identifier, metadata_hash(kwargs))
+
+
+def get_package_url(package_id):
+    '''The URL a package's DOI points to'''
+    # The ID of a dataset never changes, so use that for the URL
+    return os.path.join(get_site_url(), 'dataset', package_id)
+
+
+def create_at_provider(package_id, metadata_dict, doi_api=None):
+    '''
+    Mint the DOI at the provider. EZID refuses to create an identifier it
+    already has - if it points to the package it was minted by an earlier
+    attempt whose result wasn't recorded, so it's updated instead. Doesn't
+    touch the database, so it can be called from bulk.publish_all's threads.
+    @param metadata_dict: as returned from build_metadata
+    @param doi_api: provider API, defaults to get_doi_api()
+    @return: response
+    '''
+    doi_api = doi_api or get_doi_api()
+    try:
+        return doi_api.create(url=get_package_url(package_id),
+                              **metadata_dict)
+    except HTTPError as e:
+        if e.response is None or e.response.status_code not in (400, 409) \
+           or not is_package_doi(package_id, metadata_dict['identifier'],
+                                 doi_api):
+            raise e
+    log.info('DOI {0} already exists for package {1} - updating it'
+             .format(metadata_dict['identifier'], package_id))
+    return doi_api.update(**metadata_dict)
+
+
+def is_package_doi(package_id, identifier, doi_api=None):
+    '''
+    Does the provider's DOI point to the package. When the provider refuses
+    to create a DOI it already has, it's only safe to update it if it does -
+    otherwise it may belong to someone else (eg. a shared prefix, or a
+    restarted identifier sequence).
+    @param doi_api: provider API, defaults to get_doi_api()
+    @return: False if it points elsewhere or the provider doesn't have it
+    '''
+    try:
+        url = (doi_api or get_doi_api()).get_url(identifier)
+    except HTTPError:
+        return False
+    return bool(url) and \
+        url.rstrip('/') == get_package_url(package_id).rstrip('/')
+
+
+def mark_published(package_id, identifier, metadata_hash=None):
+    '''Record that the DOI has been published to the provider'''
+    # Update status for this package and identifier
+    num_affected = Session.query(DOI) \
+                        .filter_by(package_id=package_id,
+                                   identifier=identifier) \
+                        .update({"published": datetime.datetime.now(),
+                                 "metadata_hash": metadata_hash})
+    # Raise an error if update has failed - should never happen unless
+    # DataCite and local db get out of sync - in which case requires
+    # investigating
+    assert num_affected == 1, 'Updating local DOI failed'
 
 
 def update_doi(package_id, **kwargs):
@@ -135,9 +325,37 @@ def update_doi(package_id, **kwargs):
     try:
         doi_api.update(**kwargs)
     except HTTPError as e:
-        log.error('Could not update DOI for package {0}. ' +
+        log.error('Could not update DOI for package {0}. '
                   'Failed with error: {1}'.format(package_id, e.message))
         raise e
+    doi.metadata_hash = metadata_hash(kwargs)
+
+
+def metadata_to_json(metadata_dict):
+    '''
+    Serialize the metadata, for its hash and the outbox. IDoi plugins may add
+    values JSON can't represent (dates, decimals, sets), which are stored as
+    their unicode form.
+    @param metadata_dict: as returned from build_metadata
+    @return: JSON string, with sorted keys
+    '''
+    return json.dumps(metadata_dict, sort_keys=True, default=unicode)
+
+
+def metadata_hash(metadata_dict):
+    '''
+    Hash of the metadata, stored when it's sent to the provider so we can
+    tell if it has changed since
+    @param metadata_dict: as returned from build_metadata
+    @return: hex digest
+    '''
+    return unicode(hashlib.sha1(metadata_to_json(metadata_dict)).hexdigest())
+
+
+def metadata_changed(doi, metadata_dict):
+    '''Has the metadata changed since it was last sent to the provider. If
+    no hash has been stored for the DOI, assume it has.'''
+    return doi.metadata_hash != metadata_hash(metadata_dict)
 
 
 def get_doi(package_id):
@@ -146,11 +364,38 @@ def get_doi(package_id):
     return doi
 
 
+def get_dois(package_ids):
+    '''Returns the local DOI objects for a list of packages, in a single query
+    @return: dict of package_id: DOI, only for packages which have a DOI'''
+    if not package_ids:
+        return {}
+    dois = Session.query(DOI).filter(DOI.package_id.in_(package_ids))
+    return dict((doi.package_id, doi) for doi in dois)
+
+
 def delete_doi(package_id):
-    '''Delete the doi associated with a package_id'''
+    '''Delete the doi associated with a package_id. This doesn't commit, or
+    change the DOI at the provider - see operations.DELETE.'''
     doi = Session.query(DOI).filter(DOI.package_id==package_id).first()
     Session.delete(doi)
-    Session.commit()
+    Session.flush()
+
+
+def withdraw_doi(identifier, doi_api=None):
+    '''
+    Mark a DOI inactive at the provider. A DOI the provider doesn't have
+    counts as withdrawn.
+    @param identifier:
+    @param doi_api: provider API, defaults to get_doi_api()
+    '''
+    try:
+        (doi_api or get_doi_api()).delete(identifier)
+    except HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return
+        log.error('Withdrawing DOI {0} failed with error: {1}'
+                  .format(identifier, e.message))
+        raise e
 
 
 def get_site_url():
@@ -167,6 +412,52 @@ def get_site_url():
     return site_url.rstrip('/')
 
 
+def get_status_from_index():
+    '''
+    Should search results and cached package dicts use the DOI status stored
+    in the search index, rather than loading it from the doi table
+    '''
+    return asbool(config.get('ckanext.doi.status_from_index', False))
+
+
+def get_index_fields(doi):
+    '''
+    The DOI fields to store in the search index for a package
+    @param doi: DOI object
+    @return: dict of field name: value
+    '''
+    fields = {
+        'doi_identifier': doi.identifier,
+        'doi_status': True if doi.published else False,
+    }
+    if doi.published:
+        fields['doi_published'] = doi.published.isoformat() + 'Z'
+    return fields
+
+
+# License id -> title, and the license register it was built from
+_license_titles = (None, {})
+
+
+def get_license_title(license_id):
+    '''
+    Title of a license, from an index built once per process and rebuilt
+    when the license register is replaced
+    @param license_id:
+    @return: title, or None if the license isn't known
+    '''
+    global _license_titles
+    register = model.Package.get_license_register()
+    indexed_register, titles = _license_titles
+    if indexed_register is not register:
+        titles = {}
+        for license_title, option_id in model.Package.get_license_options():
+            titles.setdefault(option_id, license_title)
+        _license_titles = (register, titles)
+    return titles.get(license_id)
+
+
+@metrics.timed('build_metadata')
 def build_metadata(pkg_dict, doi):
     # Build the datacite metadata - all of these are core CKAN fields which
     # should be the same across all CKAN sites This builds a dictionary keyed
@@ -202,13 +493,9 @@ def build_metadata(pkg_dict, doi):
         metadata_dict['subject'] = list(set([tag['name'] if isinstance(tag, dict) else tag for tag in pkg_dict['tags']])).sort()
 
     if pkg_dict.get('license_id', 'notspecified') != 'notspecified':
-
-        licenses = model.Package.get_license_options()
-
-        for license_title, license_id in licenses:
-            if license_id == pkg_dict['license_id']:
-                metadata_dict['rights'] = license_title
-                break
+        license_title = get_license_title(pkg_dict['license_id'])
+        if license_title is not None:
+            metadata_dict['rights'] = license_title
 
     if pkg_dict.get('version', None):
         metadata_dict['version'] = pkg_dict['version']
@@ -227,8 +514,7 @@ def build_metadata(pkg_dict, doi):
     # Allow plugins to alter the datacite DOI metadata
     # So other CKAN instances can add their own custom fields - and we can
     # Add our data custom to NHM
-    for plugin in p.PluginImplementations(IDoi):
-        plugin.build_metadata(pkg_dict, metadata_dict)
+    plugin_timing.call_build_metadata(pkg_dict, metadata_dict)
 
     return metadata_dict
 
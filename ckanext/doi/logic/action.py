@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+DOI API actions.
+"""
+
+import datetime
+
+import ckan.plugins.toolkit as toolkit
+from ckan.model import Session
+
+from ckanext.doi import metrics
+from ckanext.doi import plugin_timing
+from ckanext.doi.api.breaker import breaker
+from ckanext.doi.model.operation import DOIOperation
+
+
+def _isoformat(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+
+
+@toolkit.side_effect_free
+def doi_provider_status(context, data_dict):
+    '''
+    Return the state of the DOI provider circuit breaker in the process
+    handling the request, and the number of queued DOI operations
+
+    :rtype: dictionary with ``state`` (closed, open or half-open),
+        ``failures`` (provider calls that have failed in a row),
+        ``last_error``, ``opened`` and ``retry_at`` (when the breaker opened
+        and when the next call will be tried, if it's open) and
+        ``pending_operations``
+    '''
+    toolkit.check_access('doi_provider_status', context, data_dict)
+    status = breaker.get_status()
+    status['opened'] = _isoformat(status['opened'])
+    status['retry_at'] = _isoformat(status['retry_at'])
+    status['pending_operations'] = Session.query(DOIOperation).count()
+    return status
+
+
+@toolkit.side_effect_free
+def doi_metrics(context, data_dict):
+    '''
+    Return the DOI metrics of the process handling the request, in the
+    Prometheus text format. Needs ckanext.doi.metrics = prometheus.
+
+    :rtype: string
+    '''
+    toolkit.check_access('doi_metrics', context, data_dict)
+    backend = metrics.get_backend()
+    if not isinstance(backend, metrics.PrometheusBackend):
+        raise toolkit.ValidationError(
+            {'ckanext.doi.metrics': ['Metrics are not kept in the process - '
+                                     'set ckanext.doi.metrics = prometheus']})
+    return backend.render()
+
+
+@toolkit.side_effect_free
+def doi_plugin_timings(context, data_dict):
+    '''
+    Return how long each IDoi plugin's build_metadata and metadata_to_xml
+    take in the process handling the request, slowest first
+
+    :rtype: list of dictionaries with ``plugin`` (class), ``hook``,
+        ``calls``, ``p50_ms``, ``p99_ms`` and ``max_ms``
+    '''
+    toolkit.check_access('doi_plugin_timings', context, data_dict)
+    return plugin_timing.get_report()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+DOI auth functions.
+"""
+
+
+def doi_provider_status(context, data_dict):
+    '''Only sysadmins can see the provider status'''
+    return {'success': False}
+
+
+def doi_metrics(context, data_dict):
+    '''Only sysadmins can see the metrics'''
+    return {'success': False}
+
+
+def doi_plugin_timings(context, data_dict):
+    '''Only sysadmins can see the plugin timings'''
+    return {'success': False}
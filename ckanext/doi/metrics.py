@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Timings and counters for the DOI hot paths.
+
+Set ckanext.doi.metrics to choose where they go:
+
+    log        - logged by the ckanext.doi.metrics logger
+    statsd     - sent over UDP to ckanext.doi.statsd_host:statsd_port
+    prometheus - kept in the process, and returned in the Prometheus text
+                 format by the doi_metrics action
+
+With no backend (the default) timers and counters do nothing.
+
+    with metrics.timer('provider.call', method='put') as t:
+        r = ...
+        t.tags['status'] = r.status_code
+
+    metrics.incr('identifier.retries', 2)
+
+    @metrics.timed('build_metadata')
+    def build_metadata(...):
+"""
+
+import time
+import socket
+import threading
+import functools
+from logging import getLogger
+
+from paste.deploy.converters import asint
+
+log = getLogger(__name__)
+
+TIMING = 'timing'
+COUNTER = 'counter'
+
+_backend = None
+
+
+class LogBackend(object):
+
+    def record(self, kind, name, value, tags):
+        if kind == TIMING:
+            log.info('%s %.2fms %s', name, value * 1000, tags)
+        else:
+            log.info('%s +%s %s', name, value, tags)
+
+
+class StatsdBackend(object):
+    '''
+    Send to statsd, with the tags in the metric name, eg.
+    ckanext.doi.provider.call.method_put.status_201:53.1|ms
+    '''
+
+    def __init__(self, host='localhost', port=8125, prefix='ckanext.doi'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def format(self, kind, name, value, tags):
+        parts = [self.prefix, name] if self.prefix else [name]
+        parts.extend('{0}_{1}'.format(k, tags[k]) for k in sorted(tags))
+        if kind == TIMING:
+            return '{0}:{1:.3f}|ms'.format('.'.join(parts), value * 1000)
+        return '{0}:{1}|c'.format('.'.join(parts), value)
+
+    def record(self, kind, name, value, tags):
+        try:
+            self.socket.sendto(self.format(kind, name, value, tags),
+                               self.address)
+        except socket.error:
+            # Metrics mustn't break requests
+            pass
+
+
+class PrometheusBackend(object):
+    '''
+    Counters, and timings as summaries (count and sum of seconds), kept in
+    the process
+    '''
+
+    def __init__(self, prefix='ckanext_doi'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # (kind, name) -> {labels: [count, sum]}
+        self._metrics = {}
+
+    def record(self, kind, name, value, tags):
+        labels = tuple(sorted((k, unicode(v)) for k, v in tags.items()))
+        with self._lock:
+            series = self._metrics.setdefault((kind, name), {})
+            totals = series.setdefault(labels, [0, 0])
+            totals[0] += 1
+            totals[1] += value
+
+    def _metric_name(self, name):
+        return '{0}_{1}'.format(self.prefix, name.replace('.', '_'))
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(u'{0}="{1}"'.format(
+            k, v.replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n')) for k, v in labels) + '}'
+
+    def render(self):
+        '''
+        @return: metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        with self._lock:
+            for (kind, name), series in sorted(self._metrics.items(),
+                                               key=lambda item: item[0][1]):
+                metric_name = self._metric_name(name)
+                if kind == TIMING:
+                    metric_name += '_seconds'
+                    lines.append('# TYPE {0} summary'.format(metric_name))
+                    for labels, (count, total) in sorted(series.items()):
+                        lines.append(u'{0}_count{1} {2}'.format(
+                            metric_name, self._labels(labels), count))
+                        lines.append(u'{0}_sum{1} {2!r}'.format(
+                            metric_name, self._labels(labels), total))
+                else:
+                    lines.append('# TYPE {0}_total counter'.format(
+                        metric_name))
+                    for labels, (count, total) in sorted(series.items()):
+                        lines.append(u'{0}_total{1} {2}'.format(
+                            metric_name, self._labels(labels), total))
+        return u'\n'.join(lines) + u'\n'
+
+
+BACKENDS = {
+    'log': LogBackend,
+    'statsd': StatsdBackend,
+    'prometheus': PrometheusBackend,
+}
+
+
+def configure(config):
+    '''
+    Set up the backend from the config
+    @param config: CKAN config
+    '''
+    global _backend
+    name = config.get('ckanext.doi.metrics')
+    if not name:
+        _backend = None
+    elif name == 'statsd':
+        _backend = StatsdBackend(
+            config.get('ckanext.doi.statsd_host', 'localhost'),
+            asint(config.get('ckanext.doi.statsd_port', 8125)),
+            config.get('ckanext.doi.statsd_prefix', 'ckanext.doi'))
+    elif name in BACKENDS:
+        _backend = BACKENDS[name]()
+    else:
+        log.error('Unknown ckanext.doi.metrics backend {0}'.format(name))
+        _backend = None
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(backend):
+    '''Use a backend directly, eg. in tests. None disables metrics.'''
+    global _backend
+    _backend = backend
+
+
+def incr(name, value=1, **tags):
+    '''Add to a counter'''
+    if _backend is not None:
+        _backend.record(COUNTER, name, value, tags)
+
+
+def timing(name, seconds, **tags):
+    '''Record a timing'''
+    if _backend is not None:
+        _backend.record(TIMING, name, seconds, tags)
+
+
+class _Timer(object):
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.tags.setdefault('error', exc_type.__name__)
+        timing(self.name, time.time() - self.start, **self.tags)
+
+
+class _NullTimer(object):
+
+    def __init__(self):
+        self.tags = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tags.clear()
+
+
+def timer(name, **tags):
+    '''
+    Context manager timing its block. Tags can be added to timer.tags in the
+    block.
+    '''
+    if _backend is None:
+        return _NullTimer()
+    return _Timer(name, tags)
+
+
+def timed(name):
+    '''Decorator timing each call of a function'''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _backend is None:
+                return f(*args, **kwargs)
+            with _Timer(name, {}):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
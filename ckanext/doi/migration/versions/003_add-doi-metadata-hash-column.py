@@ -0,0 +1,11 @@
+def upgrade(migrate_engine):
+    # Add a hash of the metadata last sent to the provider - populate it with
+    # paster doi backfill-hashes
+    migrate_engine.execute('''
+        ALTER TABLE doi
+            ADD COLUMN metadata_hash text;
+    '''
+    )
+
+def downgrade(migrate_engine):
+    raise NotImplementedError()
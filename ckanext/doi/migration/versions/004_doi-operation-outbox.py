@@ -0,0 +1,37 @@
+from sqlalchemy import text
+
+
+def _exists(migrate_engine, sql, name):
+    return migrate_engine.execute(text(sql), name=name).first() is not None
+
+
+def upgrade(migrate_engine):
+    # The doi_operation queue becomes the outbox of all provider operations:
+    # withdrawals outlive purged packages, so drop the foreign key, and
+    # publish operations are now called mint. A table created by the plugin
+    # already has the new schema, so check what's there rather than using IF
+    # EXISTS, which needs PostgreSQL 9.5.
+    if _exists(migrate_engine,
+               'SELECT 1 FROM pg_constraint WHERE conname = :name',
+               'doi_operation_package_id_fkey'):
+        migrate_engine.execute('''
+            ALTER TABLE doi_operation
+                DROP CONSTRAINT doi_operation_package_id_fkey;
+        '''
+        )
+    for column in ('package_id', 'identifier'):
+        name = 'ix_doi_operation_{0}'.format(column)
+        if not _exists(migrate_engine,
+                       'SELECT 1 FROM pg_indexes WHERE indexname = :name',
+                       name):
+            migrate_engine.execute(
+                'CREATE INDEX {0} ON doi_operation ({1});'.format(name, column)
+            )
+    migrate_engine.execute('''
+        UPDATE doi_operation SET operation = 'mint'
+            WHERE operation = 'publish';
+    '''
+    )
+
+def downgrade(migrate_engine):
+    raise NotImplementedError()
@@ -0,0 +1,23 @@
+from sqlalchemy import text
+
+
+def _index_exists(migrate_engine, name):
+    return migrate_engine.execute(
+        text('SELECT 1 FROM pg_indexes WHERE indexname = :name'),
+        name=name).first() is not None
+
+
+def upgrade(migrate_engine):
+    # Anchored prefix scans (identifier LIKE '10.5072/%') can't use the
+    # primary key index with a non-C collation. A table created by the plugin
+    # already has the index - check rather than use IF NOT EXISTS, which
+    # needs PostgreSQL 9.5.
+    if not _index_exists(migrate_engine, 'ix_doi_identifier_pattern'):
+        migrate_engine.execute('''
+            CREATE INDEX ix_doi_identifier_pattern
+                ON doi (identifier text_pattern_ops);
+        '''
+        )
+
+def downgrade(migrate_engine):
+    raise NotImplementedError()
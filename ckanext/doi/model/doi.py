@@ -1,7 +1,8 @@
 from logging import getLogger
 
 import sqlalchemy as sa
-from sqlalchemy import types, Table, ForeignKey, Column, DateTime
+from sqlalchemy import (types, Table, ForeignKey, Column, DateTime, Sequence,
+                        Index)
 from sqlalchemy.sql.expression import or_
 from sqlalchemy.orm import relation, backref
 from ckan import model
@@ -17,8 +18,17 @@ doi_table = Table('doi', meta.metadata,
                   Column('identifier', types.UnicodeText, primary_key=True),
                   Column('package_id', types.UnicodeText, ForeignKey('package.id', onupdate='CASCADE', ondelete='CASCADE'), nullable=False, unique=True),
                   Column('published', types.DateTime, nullable=True),  # Date DOI was published to DataCite
+                  Column('metadata_hash', types.UnicodeText, nullable=True),  # Hash of the metadata last sent to DataCite
 )
 
+# Prefix scans (identifier LIKE '10.5072/%') - the primary key index can't be
+# used for LIKE unless the database uses the C collation
+Index('ix_doi_identifier_pattern', doi_table.c.identifier,
+      postgresql_ops={'identifier': 'text_pattern_ops'})
+
+# Source of numbers for the sequence / base32 identifier generators
+doi_identifier_seq = Sequence('doi_identifier_seq', metadata=meta.metadata)
+
 
 class DOI(DomainObject):
     """
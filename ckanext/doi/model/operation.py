@@ -0,0 +1,31 @@
+from logging import getLogger
+from datetime import datetime
+
+from sqlalchemy import types, Table, Column
+from ckan.model import meta
+from ckan.model.domain_object import DomainObject
+
+log = getLogger(__name__)
+
+# No foreign key to the package, so a withdrawal outlives a purged package
+doi_operation_table = Table('doi_operation', meta.metadata,
+                            Column('id', types.Integer, primary_key=True),
+                            Column('package_id', types.UnicodeText, nullable=False, index=True),
+                            Column('identifier', types.UnicodeText, nullable=False, index=True),
+                            Column('operation', types.UnicodeText, nullable=False),  # mint, update or delete
+                            Column('payload', types.UnicodeText, nullable=False),  # JSON encoded metadata dict
+                            Column('created', types.DateTime, default=datetime.now),
+                            Column('attempts', types.Integer, nullable=False, default=0),
+                            Column('last_error', types.UnicodeText, nullable=True),
+)
+
+
+class DOIOperation(DomainObject):
+    """
+    A DOI provider operation in the outbox, written in the same transaction
+    as the dataset change and removed once the provider has applied it
+    """
+    pass
+
+
+meta.mapper(DOIOperation, doi_operation_table)
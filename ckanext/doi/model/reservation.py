@@ -0,0 +1,24 @@
+from logging import getLogger
+from datetime import datetime
+
+from sqlalchemy import types, Table, Column
+from ckan.model import meta
+from ckan.model.domain_object import DomainObject
+
+log = getLogger(__name__)
+
+doi_reservation_table = Table('doi_reservation', meta.metadata,
+                              Column('identifier', types.UnicodeText, primary_key=True),
+                              Column('prefix', types.UnicodeText, nullable=False, index=True),  # prefix and shoulder the identifier was made for
+                              Column('created', types.DateTime, default=datetime.now),
+)
+
+
+class DOIReservation(DomainObject):
+    """
+    An identifier checked as free and held for a new dataset
+    """
+    pass
+
+
+meta.mapper(DOIReservation, doi_reservation_table)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Outbox of DOI provider operations.
+
+Every change that has to reach the provider - minting a DOI, updating its
+metadata, or withdrawing it - is written to the doi_operation table in the
+same transaction as the dataset change. An operation is removed in the
+transaction that records its result (mark_published etc.), so the local
+tables and the outbox always agree, and anything the provider hasn't
+confirmed is replayed.
+
+By default after_update applies the operation straight away, and it stays
+in the outbox if the provider call fails. With ckanext.doi.async_publish
+the request only writes the outbox, and paster doi process-queue drains it.
+
+Applying an operation is idempotent: a mint of a DOI the provider already
+has pointing to the same package (from an attempt whose result wasn't
+recorded) becomes an update, and withdrawing a DOI the provider doesn't have
+succeeds.
+"""
+
+import json
+import datetime
+from logging import getLogger
+
+import sqlalchemy as sa
+from pylons import config
+from paste.deploy.converters import asbool, asint
+
+from ckan.model import Session
+from ckan.lib import search
+
+from ckanext.doi.model.operation import DOIOperation
+from ckanext.doi.lib import (get_doi, publish_doi, update_doi, withdraw_doi,
+                             metadata_to_json, supports_skip_locked)
+from ckanext.doi.exc import DOIProviderUnavailableError
+
+log = getLogger(__name__)
+
+MINT = u'mint'
+UPDATE = u'update'
+DELETE = u'delete'
+
+# Claim a batch of operations, skipping any another drainer has claimed
+CLAIM_SQL = '''
+    SELECT id FROM doi_operation
+    WHERE attempts < :max_attempts AND id > :after
+    ORDER BY id
+    LIMIT :limit
+    {lock}
+'''
+
+
+def get_async_publish():
+    '''Should DOI operations only be written to the outbox during the
+    request, for paster doi process-queue to apply'''
+    return asbool(config.get('ckanext.doi.async_publish', False))
+
+
+def get_withdraw_cleared():
+    '''Should a published DOI be withdrawn from the provider when
+    auto_doi_identifier is turned off. By default only the local DOI is
+    deleted, as the DOI may still be cited, or now be managed by hand.'''
+    return asbool(config.get('ckanext.doi.withdraw_cleared_dois', False))
+
+
+def get_max_attempts():
+    '''Number of times an operation is tried before giving up'''
+    return asint(config.get('ckanext.doi.queue_max_attempts', 5))
+
+
+def enqueue_operation(package_id, operation, metadata_dict=None,
+                      identifier=None):
+    '''
+    Write an operation to the outbox. This doesn't commit - the operation is
+    saved in the same transaction as the dataset change.
+
+    Only one operation is kept per identifier: a newer one replaces the
+    pending metadata, a pending mint stays a mint, and a delete replaces
+    anything pending.
+    @param package_id:
+    @param operation: MINT, UPDATE or DELETE
+    @param metadata_dict: metadata as returned from lib.build_metadata, for
+        MINT and UPDATE
+    @param identifier: the DOI, defaults to metadata_dict['identifier']
+    @return: DOIOperation
+    '''
+    if identifier is None:
+        identifier = metadata_dict['identifier']
+    op = Session.query(DOIOperation) \
+                .filter(DOIOperation.identifier == identifier).first()
+    if op is None:
+        op = DOIOperation(package_id=package_id, identifier=identifier,
+                          operation=operation)
+        Session.add(op)
+    elif operation == DELETE or op.operation != MINT:
+        op.operation = operation
+
+    op.payload = metadata_to_json(metadata_dict or {})
+    op.created = datetime.datetime.now()
+    op.attempts = 0
+    op.last_error = None
+    Session.flush()
+    return op
+
+
+def get_pending_operations(limit=None):
+    '''Operations still to be tried, oldest first'''
+    q = Session.query(DOIOperation) \
+               .filter(DOIOperation.attempts < get_max_attempts()) \
+               .order_by(DOIOperation.id)
+    if limit:
+        q = q.limit(limit)
+    return q.all()
+
+
+def _load_payload(op):
+    # Keyword arguments must be str, not unicode
+    return dict((str(k), v) for k, v in json.loads(op.payload).items())
+
+
+def process_operation(op):
+    '''
+    Apply an operation at the provider, record the result and remove the
+    operation. This doesn't commit. Raises on provider errors - the
+    operation is left in the outbox.
+    @param op: DOIOperation
+    @return: True if the provider was called, False if the operation was stale
+    '''
+    doi = get_doi(op.package_id)
+
+    if op.operation == DELETE:
+        # The identifier has been given back to the package since
+        if doi is not None and doi.identifier == op.identifier:
+            log.info('Discarding stale DOI withdrawal of {0}'
+                     .format(op.identifier))
+            Session.delete(op)
+            return False
+        withdraw_doi(op.identifier)
+        Session.delete(op)
+        return True
+
+    # The DOI has been deleted or replaced since the operation was queued
+    if doi is None or doi.identifier != op.identifier:
+        log.info('Discarding stale DOI operation for package {0}'
+                 .format(op.package_id))
+        Session.delete(op)
+        return False
+
+    metadata_dict = _load_payload(op)
+
+    # Already published (a previous attempt succeeded after all), so update
+    if doi.published:
+        update_doi(op.package_id, **metadata_dict)
+    else:
+        # A DOI the provider already has is updated - see
+        # lib.create_at_provider
+        publish_doi(op.package_id, **metadata_dict)
+
+    Session.delete(op)
+    return True
+
+
+def try_operation(op):
+    '''
+    Apply an operation in a savepoint, so a provider error only undoes this
+    operation - it stays in the outbox with the error recorded
+    @param op: DOIOperation
+    @return: True if applied (or stale), False if it failed
+    '''
+    savepoint = Session.begin_nested()
+    try:
+        process_operation(op)
+        savepoint.commit()
+        return True
+    except DOIProviderUnavailableError:
+        savepoint.rollback()
+        raise
+    except Exception as e:
+        savepoint.rollback()
+        log.error('DOI {0} of {1} for package {2} failed: {3}'.format(
+            op.operation, op.identifier, op.package_id, e))
+        op.attempts += 1
+        op.last_error = unicode(e)
+        return False
+
+
+def claim_operations(limit, after=0):
+    '''
+    Lock a batch of operations for this transaction, oldest first. On
+    PostgreSQL 9.5+ operations other drainers have claimed are skipped, so
+    several drainers can run at once.
+    @param limit: maximum number of operations
+    @param after: only operations with a greater ID
+    @return: list of DOIOperation
+    '''
+    bind = Session.get_bind()
+    if bind.dialect.name == 'postgresql':
+        lock = 'FOR UPDATE SKIP LOCKED' if supports_skip_locked() \
+            else 'FOR UPDATE'
+    else:
+        lock = ''
+    ids = [row[0] for row in Session.execute(
+        sa.text(CLAIM_SQL.format(lock=lock)),
+        {'max_attempts': get_max_attempts(), 'after': after,
+         'limit': limit})]
+    if not ids:
+        return []
+    return Session.query(DOIOperation).filter(DOIOperation.id.in_(ids)) \
+                  .order_by(DOIOperation.id).all()
+
+
+def process_queue(limit=None, batch_size=100):
+    '''
+    Drain the outbox in batches, committing once per batch
+    @param limit: maximum number of operations to process
+    @param batch_size: operations per batch
+    @return: tuple of (number succeeded, number failed)
+    '''
+    succeeded = failed = 0
+    # Each operation is tried once per run - failures keep their place
+    last_id = 0
+    while limit is None or succeeded + failed < limit:
+        size = batch_size if limit is None \
+            else min(batch_size, limit - succeeded - failed)
+        ops = claim_operations(size, last_id)
+        if not ops:
+            break
+        last_id = ops[-1].id
+        applied = []
+        try:
+            for op in ops:
+                if try_operation(op):
+                    applied.append(op.package_id)
+                    succeeded += 1
+                else:
+                    failed += 1
+        except DOIProviderUnavailableError as e:
+            # The circuit breaker is open - keep what's been applied, and
+            # leave the rest for the next run without using up attempts
+            log.warning('Stopping: {0}'.format(e))
+            Session.commit()
+            _reindex(applied)
+            break
+        Session.commit()
+        _reindex(applied)
+    return succeeded, failed
+
+
+def _reindex(package_ids):
+    # Search results hold doi_status from when the package was indexed
+    for package_id in set(package_ids):
+        search.rebuild(package_id)
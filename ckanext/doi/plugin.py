@@ -7,16 +7,29 @@ import ckan.plugins as p
 import ckan.logic as logic
 from ckan import model
 from ckanext.doi.model import doi as doi_model
-from ckanext.doi.lib import (get_doi, delete_doi, publish_doi,
-                             update_doi, create_unique_identifier,
-                             get_site_url, build_metadata, validate_metadata)
+from ckanext.doi.model import operation as operation_model
+from ckanext.doi.model import reservation as reservation_model
+from ckanext.doi.lib import (get_doi, get_dois, delete_doi,
+                             get_site_url, build_metadata, validate_metadata,
+                             get_status_from_index, get_index_fields,
+                             metadata_changed)
+from ckanext.doi.reservations import create_reserved_identifier
+from ckanext.doi.operations import (get_async_publish, get_withdraw_cleared,
+                                    enqueue_operation, try_operation, MINT,
+                                    UPDATE, DELETE)
 from ckanext.doi.helpers import (package_get_year,
                                  now,
                                  get_site_title,
                                  can_request_doi,
-                                 get_prefixes
+                                 get_prefixes,
+                                 doi_citation,
+                                 listen_for_permission_changes
                                  )
 from ckanext.doi.validators import doi_requester, doi_prefix
+from ckanext.doi.exc import DOIProviderUnavailableError
+from ckanext.doi.logic import action, auth
+from ckanext.doi import metrics
+from ckanext.doi import plugin_timing
 
 get_action = logic.get_action
 
@@ -31,6 +44,8 @@ class DOIPlugin(p.SingletonPlugin):
     p.implements(p.IConfigurer)
     p.implements(p.IPackageController, inherit=True)
     p.implements(p.ITemplateHelpers, inherit=True)
+    p.implements(p.IActions)
+    p.implements(p.IAuthFunctions)
 
     def _load_json_module_path(self, json_path):
         '''
@@ -52,10 +67,19 @@ class DOIPlugin(p.SingletonPlugin):
     def configure(self, config):
         '''
         Called at the end of CKAN setup.
-        Create DOI table
+        Create DOI tables, clear cached DOI request permissions when
+        memberships change, and set up the metrics backend and IDoi plugin
+        timings
         '''
         if model.package_table.exists():
             doi_model.doi_table.create(checkfirst=True)
+            doi_model.doi_identifier_seq.create(bind=model.meta.engine,
+                                                checkfirst=True)
+            operation_model.doi_operation_table.create(checkfirst=True)
+            reservation_model.doi_reservation_table.create(checkfirst=True)
+        listen_for_permission_changes()
+        metrics.configure(config)
+        plugin_timing.reset()
 
     # IConfigurer
 
@@ -89,6 +113,33 @@ class DOIPlugin(p.SingletonPlugin):
                                     {'id': pkg_id,
                                      'doi_identifier': doi_identifier})
 
+    def _send_to_provider(self, package_id, operation, metadata_dict=None,
+                          identifier=None):
+        '''Write the DOI operation to the outbox, and unless
+        ckanext.doi.async_publish is set, apply it now. If that fails it stays
+        in the outbox for paster doi process-queue.'''
+        op = enqueue_operation(package_id, operation, metadata_dict,
+                               identifier)
+        if get_async_publish():
+            return
+        try:
+            try_operation(op)
+        except DOIProviderUnavailableError as e:
+            log.warning('Queueing DOI {0} for package {1}: {2}'.format(
+                operation, package_id, e))
+
+    def _create_doi(self, package_id, prefix):
+        '''Create a DOI for the package. New identifiers are checked with
+        the provider, so if the circuit breaker is open no DOI is made, and
+        the next save of the dataset tries again.
+        @return: DOI, or None if the provider is unavailable'''
+        try:
+            return create_reserved_identifier(package_id, prefix)
+        except DOIProviderUnavailableError as e:
+            log.warning('Not creating a DOI for package {0}: {1}'.format(
+                package_id, e))
+
+    @metrics.timed('after_create')
     def after_create(self, context, pkg_dict):
         '''
         A new dataset has been created, so we need to create a new DOI. NB:
@@ -101,9 +152,12 @@ class DOIPlugin(p.SingletonPlugin):
         if pkg_dict.get('auto_doi_identifier'):
             # create a doi and populate pkg.doi_identifier with it.
             prefix = pkg_dict.get('doi_prefix')
-            doi = create_unique_identifier(pkg_dict['id'], prefix)
-            self._update_pkg_doi(context, pkg_dict['id'], doi.identifier)
+            doi = self._create_doi(pkg_dict['id'], prefix)
+            if doi:
+                self._update_pkg_doi(context, pkg_dict['id'],
+                                     doi.identifier)
 
+    @metrics.timed('after_update')
     def after_update(self, context, pkg_dict):
         '''
         Dataset has been created / updated. Check status of the dataset to
@@ -118,9 +172,17 @@ class DOIPlugin(p.SingletonPlugin):
         doi = get_doi(package_id)
 
         # If we're not auto managing the doi, but there is a DOI object
-        # associated with the package, delete it.
+        # associated with the package, delete it. With
+        # ckanext.doi.withdraw_cleared_dois also withdraw it from the provider
+        # if it was published.
         if not pkg_dict.get('auto_doi_identifier') and doi:
+            identifier, published = doi.identifier, doi.published
+            # Delete first - a withdrawal is skipped while the package still
+            # has the DOI
             delete_doi(package_id)
+            if published and get_withdraw_cleared():
+                self._send_to_provider(package_id, DELETE,
+                                       identifier=identifier)
             doi = None
 
         # We might be short circuiting the after_update
@@ -134,7 +196,9 @@ class DOIPlugin(p.SingletonPlugin):
         # creation, but subsequently deleted it.
         if not doi:
             prefix = pkg_dict.get('doi_prefix')
-            doi = create_unique_identifier(package_id, prefix)
+            doi = self._create_doi(package_id, prefix)
+            if not doi:
+                return pkg_dict
 
         # ensure doi.identifier and pkg['doi_identifier'] are the same
         if doi.identifier != pkg_dict['doi_identifier']:
@@ -145,14 +209,10 @@ class DOIPlugin(p.SingletonPlugin):
         if pkg_dict.get('state', 'active') == 'active' \
            and not pkg_dict.get('private', False):
 
-            # Load the original package, so we can determine if user has
-            # changed any fields
-            orig_pkg_dict = get_action('package_show')(context,
-                                                       {'id': package_id})
-
             # Metadata created isn't populated in pkg_dict - so copy from the
-            # original
-            pkg_dict['metadata_created'] = orig_pkg_dict['metadata_created']
+            # package
+            pkg_dict['metadata_created'] = \
+                model.Package.get(package_id).metadata_created
 
             # Build the metadata dict to pass to DataCite service
             metadata_dict = build_metadata(pkg_dict, doi)
@@ -166,29 +226,76 @@ class DOIPlugin(p.SingletonPlugin):
             # Is this an existing DOI? Update it
             if doi.published:
                 # Before updating, check if any of the metadata has been
-                # changed - otherwise we end up sending loads of revisions to
-                # DataCite for minor edits Load the current version
-                orig_metadata_dict = build_metadata(orig_pkg_dict, doi)
-                # Check if the two dictionaries are the same
-                if cmp(orig_metadata_dict, metadata_dict) != 0:
+                # changed since it was last sent - otherwise we end up
+                # sending loads of revisions to DataCite for minor edits
+                if metadata_changed(doi, metadata_dict):
                     # Not the same, so we want to update the metadata
-                    update_doi(package_id, **metadata_dict)
+                    self._send_to_provider(package_id, UPDATE, metadata_dict)
 
                 # TODO: If editing a dataset older than 5 days, create DOI
                 # revision
 
             # New DOI - publish to datacite
             else:
-                publish_doi(package_id, **metadata_dict)
+                self._send_to_provider(package_id, MINT, metadata_dict)
 
         return pkg_dict
 
-    def after_show(self, context, pkg_dict):
-        # Load the DOI ready to display
-        doi = get_doi(pkg_dict['id'])
+    def _add_doi_status(self, pkg_dict, doi):
+        '''Add the DOI display fields to a package dict'''
         if doi:
             pkg_dict['doi_status'] = True if doi.published else False
             pkg_dict['domain'] = get_site_url().replace('http://', '')
+        else:
+            # Search results may hold a status from when they were indexed
+            pkg_dict.pop('doi_status', None)
+
+    @metrics.timed('after_show')
+    def after_show(self, context, pkg_dict):
+        # A package dict cached in the search index already has the status
+        if get_status_from_index() and 'doi_status' in pkg_dict:
+            pkg_dict['domain'] = get_site_url().replace('http://', '')
+            return
+        # Load the DOI ready to display
+        self._add_doi_status(pkg_dict, get_doi(pkg_dict['id']))
+
+    def after_search(self, search_results, search_params):
+        '''
+        Add the DOI status to every result, loading all the DOIs for the page
+        in one query rather than one per dataset
+        '''
+        results = search_results.get('results', [])
+        if get_status_from_index():
+            # Results are the package dicts stored by before_index
+            for pkg_dict in results:
+                if 'doi_status' in pkg_dict:
+                    pkg_dict['domain'] = get_site_url().replace('http://', '')
+            return search_results
+        # Results only have the fields asked for with fl
+        results = [pkg_dict for pkg_dict in results if pkg_dict.get('id')]
+        dois = get_dois([pkg_dict['id'] for pkg_dict in results])
+        for pkg_dict in results:
+            self._add_doi_status(pkg_dict, dois.get(pkg_dict['id']))
+        return search_results
+
+    def before_index(self, pkg_dict):
+        '''
+        Add the DOI identifier, status and published date to the search index,
+        so they can be used in filters and facets (eg. fq=doi_status:true)
+        '''
+        doi = get_doi(pkg_dict['id'])
+        if not doi:
+            return pkg_dict
+        fields = get_index_fields(doi)
+        pkg_dict.update(fields)
+        # Also add them to the package dicts stored in the index, which are
+        # returned as search results and used by package_show's cache
+        for key in ('validated_data_dict', 'data_dict'):
+            if pkg_dict.get(key):
+                data_dict = json.loads(pkg_dict[key])
+                data_dict.update(fields)
+                pkg_dict[key] = json.dumps(data_dict)
+        return pkg_dict
 
     # ITemplateHelpers
 
@@ -198,7 +305,26 @@ class DOIPlugin(p.SingletonPlugin):
             'now': now,
             'get_site_title': get_site_title,
             'can_request_doi': can_request_doi,
-            'get_doi_prefixes': get_prefixes
+            'get_doi_prefixes': get_prefixes,
+            'doi_citation': doi_citation,
+        }
+
+    # IActions
+
+    def get_actions(self):
+        return {
+            'doi_provider_status': action.doi_provider_status,
+            'doi_metrics': action.doi_metrics,
+            'doi_plugin_timings': action.doi_plugin_timings,
+        }
+
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        return {
+            'doi_provider_status': auth.doi_provider_status,
+            'doi_metrics': auth.doi_metrics,
+            'doi_plugin_timings': auth.doi_plugin_timings,
         }
 
 
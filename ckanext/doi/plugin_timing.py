@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Calls to IDoi plugins, timed per plugin.
+
+build_metadata and metadata_to_xml call every IDoi implementation for each
+dataset, so a slow plugin slows all publishing. The time of each call is
+kept (the most recent ckanext.doi.plugin_timing_samples per plugin and
+hook) for the doi_plugin_timings action's report, sent to the metrics
+backend, and logged if it's over ckanext.doi.slow_plugin_threshold
+milliseconds.
+
+With ckanext.doi.cache_idoi_plugins the list of implementations is looked
+up once, rather than on every call.
+"""
+
+import math
+import time
+import threading
+from collections import deque
+from logging import getLogger
+
+from pylons import config
+from paste.deploy.converters import asbool, asint
+
+import ckan.plugins as p
+
+from ckanext.doi import metrics
+from ckanext.doi.interfaces import IDoi
+
+log = getLogger(__name__)
+
+_implementations = None
+_samples = {}
+_lock = threading.Lock()
+
+
+def get_implementations():
+    '''
+    The IDoi plugins
+    @return: list of plugins
+    '''
+    global _implementations
+    if not asbool(config.get('ckanext.doi.cache_idoi_plugins', False)):
+        return list(p.PluginImplementations(IDoi))
+    if _implementations is None:
+        _implementations = list(p.PluginImplementations(IDoi))
+    return _implementations
+
+
+def reset():
+    '''Forget the cached implementations and the timings'''
+    global _implementations
+    with _lock:
+        _implementations = None
+        _samples.clear()
+
+
+def _plugin_name(plugin):
+    cls = type(plugin)
+    return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
+
+def _record(plugin, hook, seconds):
+    name = _plugin_name(plugin)
+    with _lock:
+        samples = _samples.get((name, hook))
+        if samples is None:
+            samples = _samples[(name, hook)] = deque(
+                maxlen=asint(config.get('ckanext.doi.plugin_timing_samples',
+                                        1000)))
+        samples.append(seconds)
+    metrics.timing('idoi.' + hook, seconds, plugin=name)
+    threshold = asint(config.get('ckanext.doi.slow_plugin_threshold', 0))
+    if threshold and seconds * 1000 > threshold:
+        log.warning('Slow IDoi plugin: {0}.{1} took {2:.0f}ms'.format(
+            name, hook, seconds * 1000))
+
+
+def call_build_metadata(pkg_dict, metadata_dict):
+    '''Pass the metadata through each IDoi plugin's build_metadata'''
+    for plugin in get_implementations():
+        start = time.time()
+        plugin.build_metadata(pkg_dict, metadata_dict)
+        _record(plugin, 'build_metadata', time.time() - start)
+
+
+def call_metadata_to_xml(xml_dict, metadata):
+    '''
+    Pass the XML dict through each IDoi plugin's metadata_to_xml
+    @return: XML dict
+    '''
+    for plugin in get_implementations():
+        start = time.time()
+        xml_dict = plugin.metadata_to_xml(xml_dict, metadata)
+        _record(plugin, 'metadata_to_xml', time.time() - start)
+    return xml_dict
+
+
+def _percentile(sorted_samples, percent):
+    '''Nearest rank percentile'''
+    rank = int(math.ceil(percent / 100.0 * len(sorted_samples)))
+    return sorted_samples[max(rank, 1) - 1]
+
+
+def get_report():
+    '''
+    Timings of each IDoi plugin hook in this process, slowest (by p99)
+    first
+    @return: list of dicts with plugin, hook, calls, p50_ms, p99_ms and
+        max_ms - calls and the times are for the recent samples kept
+    '''
+    with _lock:
+        timings = [(key, sorted(samples)) for key, samples in
+                   _samples.items()]
+    report = []
+    for (name, hook), samples in timings:
+        if not samples:
+            continue
+        report.append({
+            'plugin': name,
+            'hook': hook,
+            'calls': len(samples),
+            'p50_ms': _percentile(samples, 50) * 1000,
+            'p99_ms': _percentile(samples, 99) * 1000,
+            'max_ms': samples[-1] * 1000,
+        })
+    report.sort(key=lambda row: row['p99_ms'], reverse=True)
+    return report
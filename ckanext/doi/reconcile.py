@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Reconciliation of the doi table with the DOIs the provider has, for
+paster doi reconcile.
+
+Neither side is loaded into memory: the provider listing is read a page at
+a time from the DataCite REST API, and the local rows are read with a
+server-side cursor. The provider doesn't list DOIs in any order, so each
+stream is sorted with an external merge sort - sorted runs of
+ckanext.doi.reconcile_chunk_size identifiers are spilled to temporary files
+and merged - and the two sorted streams are then merge joined. Memory use
+depends on the chunk size, not the number of DOIs.
+
+DOIs are compared case insensitively, as DataCite lowercases them.
+"""
+
+import heapq
+import tempfile
+from logging import getLogger
+
+from pylons import config
+from paste.deploy.converters import asint
+
+from ckan.model import Session
+from ckan.lib import search
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.doi.api import get_doi_api
+from ckanext.doi.model.doi import DOI
+from ckanext.doi.lib import build_metadata, get_doi, mark_published
+from ckanext.doi.operations import enqueue_operation, MINT
+
+log = getLogger(__name__)
+
+# Published locally, but the provider doesn't have it
+MISSING = 'missing'
+# The provider has it, but it isn't marked published locally
+UNPUBLISHED = 'unpublished'
+# The provider has it, but there's no local DOI
+ORPHANED = 'orphaned'
+
+
+def get_chunk_size():
+    '''Number of identifiers sorted in memory at once'''
+    return asint(config.get('ckanext.doi.reconcile_chunk_size', 100000))
+
+
+def _write_run(lines):
+    run = tempfile.TemporaryFile()
+    for line in sorted(lines):
+        run.write(line.encode('utf-8') + '\n')
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    for line in run:
+        yield line[:-1].decode('utf-8')
+
+
+def external_sort(lines, chunk_size):
+    '''
+    Sort lines with bounded memory
+    @param lines: iterable of unicode strings, without newlines
+    @param chunk_size: lines held in memory at once
+    @return: iterator of the sorted lines
+    '''
+    runs = []
+    chunk = []
+    try:
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                runs.append(_write_run(chunk))
+                chunk = []
+        if not runs:
+            for line in sorted(chunk):
+                yield line
+            return
+        if chunk:
+            runs.append(_write_run(chunk))
+            chunk = []
+        for line in heapq.merge(*[_read_run(run) for run in runs]):
+            yield line
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _key(identifier):
+    return identifier.strip().upper()
+
+
+def iter_local_dois(batch_size=1000):
+    '''
+    Local DOIs as sortable lines: key, identifier, package id and whether
+    it's published, tab separated. Read with a server-side cursor.
+    '''
+    q = Session.query(DOI.identifier, DOI.package_id, DOI.published) \
+               .execution_options(stream_results=True) \
+               .yield_per(batch_size)
+    for identifier, package_id, published in q:
+        yield u'\t'.join([_key(identifier), identifier, package_id,
+                          u'1' if published else u'0'])
+
+
+def provider_supports_listing():
+    '''Whether the provider API can list its DOIs, which reconciling needs'''
+    return getattr(get_doi_api(), 'supports_listing', False)
+
+
+def iter_provider_dois():
+    '''Provider DOIs as sortable lines: key and identifier, tab separated'''
+    for identifier in get_doi_api().iter_dois():
+        yield u'\t'.join([_key(identifier), identifier])
+
+
+def merge_join(local, remote):
+    '''
+    Join two sorted streams of lines on their first field
+    @return: iterator of (local fields or None, remote fields or None)
+    '''
+    local = iter(local)
+    remote = iter(remote)
+    l = next(local, None)
+    r = next(remote, None)
+    while l is not None or r is not None:
+        l_fields = l.split(u'\t') if l is not None else None
+        r_fields = r.split(u'\t') if r is not None else None
+        if r_fields is None or \
+           (l_fields is not None and l_fields[0] < r_fields[0]):
+            yield l_fields, None
+            l = next(local, None)
+        elif l_fields is None or r_fields[0] < l_fields[0]:
+            yield None, r_fields
+            r = next(remote, None)
+            # The provider may list a DOI twice
+            while r is not None and r.split(u'\t')[0] == r_fields[0]:
+                r = next(remote, None)
+        else:
+            yield l_fields, r_fields
+            l = next(local, None)
+            r = next(remote, None)
+            while r is not None and r.split(u'\t')[0] == r_fields[0]:
+                r = next(remote, None)
+
+
+def iter_mismatches(chunk_size=None):
+    '''
+    Compare the doi table with the provider
+    @return: iterator of (problem, identifier, package_id) - package_id is
+        None for orphaned DOIs
+    '''
+    chunk_size = chunk_size or get_chunk_size()
+    local = external_sort(iter_local_dois(), chunk_size)
+    remote = external_sort(iter_provider_dois(), chunk_size)
+    for l_fields, r_fields in merge_join(local, remote):
+        if r_fields is None:
+            if l_fields[3] == u'1':
+                yield MISSING, l_fields[1], l_fields[2]
+        elif l_fields is None:
+            yield ORPHANED, r_fields[1], None
+        elif l_fields[3] == u'0':
+            yield UNPUBLISHED, l_fields[1], l_fields[2]
+
+
+def fix(problem, identifier, package_id):
+    '''
+    Fix a mismatch: DOIs missing from the provider are queued to be minted
+    again, and DOIs the provider has are marked published. Orphaned DOIs
+    aren't changed, as they may have been made outside this site. Doesn't
+    commit.
+    @return: True if fixed
+    '''
+    if problem == UNPUBLISHED:
+        # The hash isn't known, so the next save sends the metadata
+        mark_published(package_id, identifier)
+        return True
+    if problem == MISSING:
+        doi = get_doi(package_id)
+        pkg_dict = toolkit.get_action('package_show')(
+            {'ignore_auth': True}, {'id': package_id})
+        doi.published = None
+        enqueue_operation(package_id, MINT, build_metadata(pkg_dict, doi))
+        return True
+    return False
+
+
+def reconcile(apply_fixes=False, chunk_size=None, report=None):
+    '''
+    Compare the doi table with the provider, optionally fixing mismatches
+    @param apply_fixes: fix missing and unpublished DOIs
+    @param chunk_size: identifiers sorted in memory at once
+    @param report: called with (problem, identifier, package_id) for each
+        mismatch
+    @return: dict of the number of each problem, and the number fixed
+    '''
+    counts = {MISSING: 0, UNPUBLISHED: 0, ORPHANED: 0, 'fixed': 0}
+    # Sorting reads all the local rows before the first mismatch, so fixes
+    # can be committed as we go
+    fixes = []
+    for problem, identifier, package_id in iter_mismatches(chunk_size):
+        counts[problem] += 1
+        if report:
+            report(problem, identifier, package_id)
+        if apply_fixes and problem != ORPHANED:
+            fixes.append((problem, identifier, package_id))
+            if len(fixes) >= 1000:
+                counts['fixed'] += _apply(fixes)
+                fixes = []
+    if fixes:
+        counts['fixed'] += _apply(fixes)
+    return counts
+
+
+def _apply(fixes):
+    fixed = []
+    for problem, identifier, package_id in fixes:
+        savepoint = Session.begin_nested()
+        try:
+            if fix(problem, identifier, package_id):
+                fixed.append(package_id)
+            savepoint.commit()
+        except Exception as e:
+            savepoint.rollback()
+            log.error('Fixing {0} DOI {1} failed: {2}'.format(
+                problem, identifier, e))
+    Session.commit()
+    # Search results hold doi_status from when the package was indexed
+    for package_id in fixed:
+        search.rebuild(package_id)
+    return len(fixed)
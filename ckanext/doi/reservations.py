@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Pool of reserved identifiers.
+
+Identifiers are made and checked with the provider ahead of time by
+paster doi reserve, so creating a dataset only has to claim one from the
+doi_reservation table, rather than waiting for the provider.
+"""
+
+from logging import getLogger
+
+import sqlalchemy as sa
+from pylons import config
+from paste.deploy.converters import asint
+
+from ckan.model import Session
+
+from ckanext.doi.model.reservation import DOIReservation
+from ckanext.doi.lib import (_prepare_prefix, make_unique_identifier,
+                             create_doi_from_identifier,
+                             create_unique_identifier, supports_skip_locked)
+
+log = getLogger(__name__)
+
+# Take the oldest reserved identifier for the prefix, skipping rows other
+# transactions are claiming
+CLAIM_SQL = '''
+    DELETE FROM doi_reservation
+    WHERE identifier = (
+        SELECT identifier FROM doi_reservation
+        WHERE prefix = :prefix
+        ORDER BY created
+        LIMIT 1
+        FOR UPDATE {skip_locked}
+    )
+    RETURNING identifier
+'''
+
+
+def get_pool_size():
+    '''Number of identifiers to keep reserved for each prefix. 0 disables the
+    pool.'''
+    return asint(config.get('ckanext.doi.reservation_pool_size', 0))
+
+
+def count_reserved(prefix):
+    return Session.query(DOIReservation) \
+                  .filter(DOIReservation.prefix == _prepare_prefix(prefix)) \
+                  .count()
+
+
+def top_up(prefix, size=None):
+    '''
+    Reserve new identifiers until the pool for the prefix has `size`
+    @param prefix:
+    @param size: defaults to ckanext.doi.reservation_pool_size
+    @return: number of identifiers added
+    '''
+    if size is None:
+        size = get_pool_size()
+    prefix = _prepare_prefix(prefix)
+    added = 0
+    for i in range(size - count_reserved(prefix)):
+        Session.add(DOIReservation(prefix=prefix,
+                                   identifier=make_unique_identifier(prefix)))
+        # Commit as we go, so they're available straight away
+        Session.commit()
+        added += 1
+    return added
+
+
+def claim_identifier(prefix):
+    '''
+    Remove the oldest reserved identifier for the prefix from the pool. This
+    is part of the current transaction, so the identifier goes back in the
+    pool if the transaction is rolled back.
+    @param prefix:
+    @return: identifier, or None if the pool is empty
+    '''
+    prefix = _prepare_prefix(prefix)
+    if Session.get_bind().dialect.name == 'postgresql':
+        sql = CLAIM_SQL.format(
+            skip_locked='SKIP LOCKED' if supports_skip_locked() else '')
+        # Without SKIP LOCKED, another transaction may have claimed the row
+        # we waited for, so try again
+        for attempt in range(3):
+            row = Session.execute(sa.text(sql), {'prefix': prefix}).fetchone()
+            if row is not None:
+                return row[0]
+            if not count_reserved(prefix):
+                return None
+        return None
+
+    reservation = Session.query(DOIReservation) \
+                         .filter(DOIReservation.prefix == prefix) \
+                         .order_by(DOIReservation.created).first()
+    if reservation is None:
+        return None
+    Session.delete(reservation)
+    Session.flush()
+    return reservation.identifier
+
+
+def create_reserved_identifier(package_id, prefix):
+    '''
+    Create a DOI for the package using an identifier from the pool, or a
+    new one if the pool is disabled or empty
+    @return: DOI
+    '''
+    if get_pool_size():
+        identifier = claim_identifier(prefix)
+        if identifier is not None:
+            return create_doi_from_identifier(package_id, identifier)
+        log.warning('No reserved identifiers for prefix {0} - run paster '
+                    'doi reserve'.format(prefix))
+    return create_unique_identifier(package_id, prefix)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+A local stand-in for the DOI provider HTTP APIs, for tests and benchmarks.
+
+    with StandInServer() as server:
+        requests.get(server.url + '/id/doi:10.5072/FK2000001')
+
+By default GET returns 200, PUT and POST return 201 and DELETE returns 200.
+Pass a handler to return something else:
+
+    def handler(method, path, body):
+        return 404, {}, 'not found'
+"""
+
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+def default_handler(method, path, body):
+    status = 201 if method in ('PUT', 'POST') else 200
+    return status, {'Content-Type': 'text/plain'}, 'success: {0}'.format(path)
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep-alive, so clients with a connection pool can reuse connections
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        self.server.requests.append((self.command, self.path, body))
+        status, headers, response_body = self.server.handler(self.command,
+                                                             self.path, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer(object):
+    '''
+    Local HTTP server running in a background thread
+    '''
+
+    def __init__(self, handler=default_handler, port=0):
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', port),
+                                          _RequestHandler)
+        self.httpd.handler = handler
+        self.httpd.requests = []
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.httpd.server_address[1])
+
+    @property
+    def requests(self):
+        '''List of (method, path, body) received'''
+        return self.httpd.requests
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,136 @@
+from nose.tools import assert_equal, assert_true, assert_raises
+import mock
+
+from ckan.tests import helpers
+from ckan.tests import factories
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.doi.api import transport
+from ckanext.doi.api.breaker import breaker, CLOSED, OPEN, HALF_OPEN
+from ckanext.doi.exc import DOIProviderUnavailableError
+import ckanext.doi.operations as doi_operations
+from ckanext.doi.tests.stand_in import StandInServer
+
+
+def _unavailable_handler(method, path, body):
+    return 503, {}, 'Service unavailable'
+
+
+class TestCircuitBreaker(object):
+
+    def setup(self):
+        breaker.reset()
+
+    def teardown(self):
+        breaker.reset()
+        transport.reset_session()
+
+    @helpers.change_config('ckanext.doi.breaker_threshold', '3')
+    def test_opens_after_failures(self):
+        '''After threshold failures, calls fail without reaching the
+        provider.'''
+        with StandInServer(_unavailable_handler) as server:
+            for i in range(3):
+                r = transport.request('get', server.url)
+                assert_equal(r.status_code, 503)
+            assert_equal(breaker.state, OPEN)
+            assert_raises(DOIProviderUnavailableError, transport.request,
+                          'get', server.url)
+            assert_equal(len(server.requests), 3)
+
+    @helpers.change_config('ckanext.doi.breaker_threshold', '3')
+    def test_success_resets_failures(self):
+        breaker.record_failure('error')
+        breaker.record_failure('error')
+        with StandInServer() as server:
+            transport.request('get', server.url)
+        assert_equal(breaker.failures, 0)
+        breaker.record_failure('error')
+        assert_equal(breaker.state, CLOSED)
+
+    @helpers.change_config('ckanext.doi.breaker_threshold', '1')
+    @helpers.change_config('ckanext.doi.breaker_cooldown', '60')
+    @mock.patch('ckanext.doi.api.breaker.time')
+    def test_trial_call_after_cooldown(self, mock_time):
+        mock_time.time.return_value = 1000
+        breaker.record_failure('error')
+        assert_raises(DOIProviderUnavailableError, breaker.before_call)
+
+        mock_time.time.return_value = 1061
+        breaker.before_call()
+        assert_equal(breaker.state, HALF_OPEN)
+        # Only one trial at a time
+        assert_raises(DOIProviderUnavailableError, breaker.before_call)
+        # The trial failed, so open for another cool-down
+        breaker.record_failure('error')
+        assert_equal(breaker.state, OPEN)
+        assert_raises(DOIProviderUnavailableError, breaker.before_call)
+
+        mock_time.time.return_value = 1122
+        breaker.before_call()
+        breaker.record_success()
+        assert_equal(breaker.state, CLOSED)
+
+    @helpers.change_config('ckanext.doi.breaker_threshold', '1')
+    @helpers.change_config('ckanext.doi.breaker_cooldown', '60')
+    @mock.patch('ckanext.doi.api.transport.rate_limit')
+    @mock.patch('ckanext.doi.api.breaker.time')
+    def test_trial_released_if_call_not_made(self, mock_time,
+                                             mock_rate_limit):
+        '''An error before the trial call is sent lets another call be the
+        trial.'''
+        mock_time.time.return_value = 1000
+        breaker.record_failure('error')
+
+        mock_time.time.return_value = 1061
+        mock_rate_limit.wait.side_effect = ValueError('Rate limit error')
+        assert_raises(ValueError, transport.request, 'get',
+                      'http://localhost')
+        assert_equal(breaker.state, OPEN)
+        breaker.before_call()
+        assert_equal(breaker.state, HALF_OPEN)
+
+    @helpers.change_config('ckanext.doi.breaker_threshold', '0')
+    def test_disabled(self):
+        for i in range(10):
+            breaker.record_failure('error')
+        breaker.before_call()
+
+
+class TestCircuitBreakerPlugin(helpers.FunctionalTestBase):
+
+    def setup(self):
+        super(TestCircuitBreakerPlugin, self).setup()
+        breaker.reset()
+
+    def teardown(self):
+        breaker.reset()
+
+    @helpers.change_config('ckanext.doi.breaker_threshold', '1')
+    def test_update_queued_when_breaker_open(self):
+        '''Saving a dataset while the provider is unavailable queues the DOI
+        operation rather than failing the save.'''
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        pkg = helpers.call_action('package_show', id=pkg['id'])
+        breaker.record_failure('Connection refused')
+
+        helpers.call_action('package_update', **pkg)
+
+        ops = doi_operations.get_pending_operations()
+        assert_equal(len(ops), 1)
+        assert_equal(ops[0].operation, doi_operations.MINT)
+
+    @helpers.change_config('ckanext.doi.breaker_threshold', '1')
+    def test_provider_status(self):
+        breaker.record_failure('Connection refused')
+        status = helpers.call_action('doi_provider_status')
+        assert_equal(status['state'], OPEN)
+        assert_equal(status['last_error'], 'Connection refused')
+        assert_true(status['retry_at'] > status['opened'])
+        assert_equal(status['pending_operations'], 0)
+
+    def test_provider_status_sysadmin_only(self):
+        user = factories.User()
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+                      'doi_provider_status', {'user': user['name']})
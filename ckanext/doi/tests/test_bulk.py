@@ -0,0 +1,215 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_true, assert_false
+import mock
+from requests.exceptions import ConnectionError, HTTPError
+
+from ckan.tests import helpers
+from ckan.tests import factories
+import ckan.model as model
+
+import ckanext.doi.lib as doi_lib
+from ckanext.doi import bulk
+from ckanext.doi.exc import DOIProviderUnavailableError
+
+
+class TestPublishAll(helpers.FunctionalTestBase):
+
+    def _create_datasets(self, n):
+        return [factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                  doi_identifier=None,
+                                  doi_prefix='10.5072/FK2')
+                for i in range(n)]
+
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_publish_all(self, mock_api):
+        '''Unpublished DOIs are published, in batches.'''
+        datasets = self._create_datasets(5)
+        factories.Dataset(author='Ben', auto_doi_identifier=False)
+
+        counts = bulk.publish_all(batch_size=2, concurrency=3)
+
+        assert_equal(counts['packages'], 5)
+        assert_equal(counts[bulk.PUBLISHED], 5)
+        assert_equal(mock_api.return_value.create.call_count, 5)
+        for pkg in datasets:
+            assert_true(doi_lib.get_doi(pkg['id']).published is not None)
+
+        # Nothing left to publish
+        assert_equal(bulk.publish_all()['packages'], 0)
+
+    @helpers.change_config('ckanext.doi.status_from_index', True)
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_published_packages_reindexed(self, mock_api):
+        '''The indexed DOI status of published packages is updated.'''
+        pkg = self._create_datasets(1)[0]
+
+        bulk.publish_all()
+
+        result = helpers.call_action('package_search',
+                                     fq='id:{0}'.format(pkg['id']))
+        assert_true(result['results'][0]['doi_status'])
+
+    @helpers.change_config('ckanext.doi.doi_request_only_in_orgs', 'true')
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_new_identifier_saved_to_package(self, mock_api):
+        '''A DOI created by publish-all is saved to the package, even when
+        only organization members can request DOIs.'''
+        pkg = self._create_datasets(1)[0]
+        doi_lib.delete_doi(pkg['id'])
+        model.Session.commit()
+
+        bulk.publish_all()
+
+        doi = doi_lib.get_doi(pkg['id'])
+        assert_true(doi.published is not None)
+        pkg = helpers.call_action('package_show', id=pkg['id'])
+        assert_equal(pkg['doi_identifier'], doi.identifier)
+
+    @mock.patch('ckanext.doi.bulk.create_reserved_identifier')
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_identifier_failure_skips_package(self, mock_api, mock_create):
+        '''A package whose DOI can't be created is counted as failed, and the
+        rest are still published.'''
+        mock_create.side_effect = DOIProviderUnavailableError(
+            'Circuit breaker open')
+        without_doi, with_doi = self._create_datasets(2)
+        doi_lib.delete_doi(without_doi['id'])
+        model.Session.commit()
+
+        counts = bulk.publish_all()
+
+        assert_equal((counts[bulk.PUBLISHED], counts[bulk.FAILED]), (1, 1))
+        assert_true(doi_lib.get_doi(with_doi['id']).published is not None)
+        assert_true(doi_lib.get_doi(without_doi['id']) is None)
+
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_unrecorded_mint_updates(self, mock_api):
+        '''A DOI the provider already has for the package, from a run which
+        didn't record it, is updated and marked published.'''
+        pkg = self._create_datasets(1)[0]
+        api = mock_api.return_value
+        api.create.side_effect = HTTPError(
+            '400 error', response=mock.Mock(status_code=400))
+        api.get_url.return_value = doi_lib.get_package_url(pkg['id'])
+
+        counts = bulk.publish_all()
+
+        assert_equal(counts[bulk.PUBLISHED], 1)
+        assert_true(api.update.called)
+        assert_true(doi_lib.get_doi(pkg['id']).published is not None)
+
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_sync_updates_published(self, mock_api):
+        self._create_datasets(2)
+        bulk.publish_all()
+
+        counts = bulk.publish_all(include_published=True)
+
+        assert_equal(counts[bulk.UPDATED], 2)
+        assert_equal(mock_api.return_value.update.call_count, 2)
+
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_checkpoint(self, mock_api):
+        '''A run with a checkpoint carries on after the last package.'''
+        datasets = sorted(pkg['id'] for pkg in self._create_datasets(3))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(tmp_dir, 'checkpoint')
+            bulk.write_checkpoint(checkpoint, datasets[1])
+
+            counts = bulk.publish_all(checkpoint=checkpoint,
+                                      include_published=True)
+
+            assert_equal(counts['packages'], 1)
+            assert_equal(bulk.read_checkpoint(checkpoint), datasets[2])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_checkpoint_held_at_failure(self, mock_api):
+        '''The checkpoint doesn't move past a package which failed, so a
+        rerun retries it.'''
+        datasets = sorted(pkg['id'] for pkg in self._create_datasets(3))
+        tmp_dir = tempfile.mkdtemp()
+
+        def create(url, identifier, **kwargs):
+            if url.endswith(datasets[1]):
+                raise ConnectionError('Connection refused')
+        mock_api.return_value.create.side_effect = create
+        try:
+            checkpoint = os.path.join(tmp_dir, 'checkpoint')
+
+            counts = bulk.publish_all(batch_size=1, checkpoint=checkpoint)
+
+            assert_equal((counts[bulk.PUBLISHED], counts[bulk.FAILED]),
+                         (2, 1))
+            assert_equal(bulk.read_checkpoint(checkpoint), datasets[0])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestDeleteTestDOIs(helpers.FunctionalTestBase):
+
+    def _create_dois(self):
+        published = []
+        for i in range(3):
+            pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                    doi_identifier=None,
+                                    doi_prefix='10.5072/FK2')
+            if i:
+                doi = doi_lib.get_doi(pkg['id'])
+                doi_lib.mark_published(pkg['id'], doi.identifier)
+                published.append(doi.identifier)
+        other = factories.Dataset(author='Ben')
+        doi_lib.create_doi_from_identifier(other['id'], u'10.9999/FK2000001')
+        model.Session.commit()
+        return other, published
+
+    def test_dry_run(self):
+        self._create_dois()
+
+        counts = bulk.delete_test_dois(dry_run=True)
+
+        assert_equal((counts['total'], counts['published'],
+                      counts['deleted']), (3, 2, 0))
+        assert_equal(doi_lib.get_prefix_stats('10.5072')['total'], 3)
+
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_delete_in_batches(self, mock_api):
+        '''Test DOIs are deleted a batch at a time, leaving other DOIs and
+        the provider alone.'''
+        other, published = self._create_dois()
+
+        counts = bulk.delete_test_dois(batch_size=2)
+
+        assert_equal(counts['deleted'], 3)
+        assert_equal(doi_lib.get_prefix_stats('10.5072')['total'], 0)
+        assert_true(doi_lib.get_doi(other['id']) is not None)
+        assert_false(mock_api.return_value.delete.called)
+
+    @mock.patch('ckanext.doi.bulk.get_doi_api')
+    def test_withdraw_from_provider(self, mock_api):
+        '''With provider, published test DOIs are withdrawn, and kept
+        locally if that fails.'''
+        other, published = self._create_dois()
+        failing = published[0]
+
+        def delete(identifier):
+            if identifier == failing:
+                raise ConnectionError('Connection refused')
+        mock_api.return_value.delete.side_effect = delete
+
+        counts = bulk.delete_test_dois(provider=True, concurrency=2)
+
+        assert_equal((counts['deleted'], counts['withdrawn'],
+                      counts['failed']), (2, 1, 1))
+        assert_equal(sorted(call[0][0] for call in
+                            mock_api.return_value.delete.call_args_list),
+                     sorted(published))
+        assert_equal(model.Session.query(doi_lib.DOI.identifier)
+                     .filter(doi_lib.with_prefix(doi_lib.DOI.identifier,
+                                                 '10.5072')).all(),
+                     [(failing,)])
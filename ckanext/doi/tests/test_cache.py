@@ -0,0 +1,46 @@
+from nose.tools import assert_equal, assert_true
+import mock
+
+from ckanext.doi.cache import LRUCache, MISSING
+
+
+class TestLRUCache(object):
+
+    def test_get_set(self):
+        cache = LRUCache(10)
+        assert_true(cache.get('a') is MISSING)
+        cache.set('a', None)
+        assert_true(cache.get('a') is None)
+        assert_equal(cache.get('b', 'default'), 'default')
+
+    def test_least_recently_used_dropped(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert_equal(cache.get('a'), 1)
+        assert_true(cache.get('b') is MISSING)
+        assert_equal(cache.get('c'), 3)
+        assert_equal(len(cache), 2)
+
+    @mock.patch('ckanext.doi.cache.time')
+    def test_expiry(self, mock_time):
+        mock_time.time.return_value = 1000
+        cache = LRUCache(10, ttl=60)
+        cache.set('a', 1)
+        mock_time.time.return_value = 1059
+        assert_equal(cache.get('a'), 1)
+        mock_time.time.return_value = 1061
+        assert_true(cache.get('a') is MISSING)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        assert_true(cache.get('a') is MISSING)
+
+    def test_clear(self):
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        cache.clear()
+        assert_equal(len(cache), 0)
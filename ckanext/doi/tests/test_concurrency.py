@@ -0,0 +1,101 @@
+'''
+Stress test for claiming identifiers from many processes at once.
+
+Workers mint identifiers from a deliberately small random space, so they
+collide often, against a scratch database - SQLite by default, or set
+CKANEXT_DOI_STRESS_DB to a PostgreSQL URL (the database should be empty -
+a doi table is created in it).
+'''
+import os
+import random
+import shutil
+import tempfile
+import multiprocessing
+
+import sqlalchemy as sa
+from nose.tools import assert_equal, assert_true
+
+from ckanext.doi.lib import insert_identifier
+
+WORKERS = 8
+IDENTIFIERS_PER_WORKER = 50
+# Small enough that workers regularly pick the same identifier
+IDENTIFIER_SPACE = 1000
+MAX_ATTEMPTS = 100
+
+
+def _create_engine(db_url):
+    if db_url.startswith('sqlite'):
+        # Wait for other writers rather than failing with database is locked
+        return sa.create_engine(db_url, connect_args={'timeout': 60})
+    return sa.create_engine(db_url)
+
+
+def _mint(db_url, worker, results):
+    '''Worker process - claim IDENTIFIERS_PER_WORKER identifiers'''
+    random.seed()
+    connection = _create_engine(db_url).connect()
+    claimed = []
+    most_attempts = 0
+    for i in range(IDENTIFIERS_PER_WORKER):
+        package_id = u'package-{0}-{1}'.format(worker, i)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            identifier = u'10.5072/FK2{0:07}'.format(
+                random.randint(1, IDENTIFIER_SPACE))
+            if insert_identifier(connection, package_id, identifier):
+                break
+        else:
+            identifier = None
+        claimed.append(identifier)
+        most_attempts = max(most_attempts, attempt)
+    results.put((claimed, most_attempts))
+
+
+class TestConcurrentClaims(object):
+
+    def setup(self):
+        self.tmp_dir = None
+        self.db_url = os.environ.get('CKANEXT_DOI_STRESS_DB')
+        if not self.db_url:
+            self.tmp_dir = tempfile.mkdtemp()
+            self.db_url = 'sqlite:///{0}'.format(
+                os.path.join(self.tmp_dir, 'doi.db'))
+        # Just the columns and constraints of the doi table - no packages
+        self.engine = _create_engine(self.db_url)
+        self.table = sa.Table(
+            'doi', sa.MetaData(),
+            sa.Column('identifier', sa.UnicodeText, primary_key=True),
+            sa.Column('package_id', sa.UnicodeText, nullable=False,
+                      unique=True))
+        self.table.create(self.engine)
+
+    def teardown(self):
+        self.table.drop(self.engine)
+        if self.tmp_dir:
+            shutil.rmtree(self.tmp_dir)
+
+    def test_concurrent_claims_are_unique(self):
+        '''Workers claiming identifiers at the same time never get the same
+        one, and need a bounded number of attempts.'''
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_mint,
+                                           args=(self.db_url, i, results))
+                   for i in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        worker_results = [results.get(timeout=300) for worker in workers]
+        for worker in workers:
+            worker.join()
+
+        claimed = [identifier for identifiers, attempts in worker_results
+                   for identifier in identifiers]
+        most_attempts = max(attempts for identifiers, attempts
+                            in worker_results)
+
+        # Every worker got all its identifiers, in fewer than MAX_ATTEMPTS
+        assert_true(None not in claimed)
+        assert_true(most_attempts < MAX_ATTEMPTS)
+        # No identifier was claimed twice
+        assert_equal(len(set(claimed)), WORKERS * IDENTIFIERS_PER_WORKER)
+        rows = self.engine.execute(sa.select([self.table.c.identifier]))
+        assert_equal(sorted(row[0] for row in rows), sorted(claimed))
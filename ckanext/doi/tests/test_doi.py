@@ -1,21 +1,42 @@
+import json
+import base64
+import datetime
 from logging import getLogger
 from pylons import config
 from nose.tools import (assert_equal, assert_true,
                         assert_false, assert_raises, assert_not_equal)
 import mock
+from requests.exceptions import HTTPError
 
 from ckan.tests import helpers
 from ckan.tests import factories
+import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
 from ckanext.doi.api import get_doi_api
 from ckanext.doi.api import ezid_api
+from ckanext.doi.api import datacite_rest_api
+from ckanext.doi.api import transport
 import ckanext.doi.lib as doi_lib
-from ckanext.doi.exc import DOIAPITypeNotKnownError, DOIMetadataException
+import ckanext.doi.helpers as doi_helpers
+import ckanext.doi.operations as doi_operations
+from ckanext.doi.exc import (DOIAPITypeNotKnownError, DOIMetadataException,
+                             DOIProviderUnavailableError)
+from ckanext.doi.tests.stand_in import StandInServer
 
 log = getLogger(__name__)
 
 
+class _DatePlugin(object):
+    '''IDoi plugin adding a value JSON can't represent'''
+
+    def build_metadata(self, pkg_dict, metadata_dict):
+        metadata_dict['available'] = datetime.datetime(2020, 1, 2)
+
+    def metadata_to_xml(self, xml_dict, metadata):
+        return xml_dict
+
+
 class TestDOICreate(helpers.FunctionalTestBase):
 
     def test_doi_config(self):
@@ -96,7 +117,7 @@ class TestDOICreate(helpers.FunctionalTestBase):
 
         assert_true(doi is None)
 
-    @mock.patch('ckanext.doi.plugin.publish_doi')
+    @mock.patch('ckanext.doi.operations.publish_doi')
     def test_manually_entered_then_auto_create_doi(self, mock_publish):
         '''On package creation, DOI object should not be created if
         doi_identifier is manually entered and auto_doi_identifier is False.
@@ -278,6 +299,137 @@ class TestDOICreate(helpers.FunctionalTestBase):
         assert_true('10.5072' in doi.identifier)
 
 
+class TestDOIRequesterValidator(helpers.FunctionalTestBase):
+
+    '''doi_requester runs for several fields, but checks once per save'''
+
+    @helpers.change_config('ckanext.doi.doi_request_only_in_orgs', True)
+    @helpers.change_config('ckanext.doi.doi_request_roles_in_orgs', 'admin')
+    def test_checks_once_per_save(self):
+        my_user = factories.User()
+        editor = factories.User()
+        org = factories.Organization(
+            user=my_user, users=[{'name': editor['id'], 'capacity': 'editor'}])
+        pkg = factories.Dataset(author='My Author', user=my_user,
+                                owner_org=org['id'])
+        pkg['title'] = 'A new title'
+        pkg['auto_doi_identifier'] = True
+
+        with mock.patch('ckanext.doi.validators.can_request_doi',
+                        wraps=doi_helpers.can_request_doi) as mock_can, \
+                mock.patch.object(toolkit, 'get_action',
+                                  wraps=toolkit.get_action) as mock_action:
+            helpers.call_action('package_update',
+                                context={'user': editor['name']}, **pkg)
+
+        actions = [call[0][0] for call in mock_action.call_args_list]
+        assert_equal(mock_can.call_count, 1)
+        assert_true('user_show' not in actions)
+        assert_equal(actions.count('package_show'), 1)
+        # The editor can't request a DOI, so the original value is kept
+        pkg = helpers.call_action('package_show', id=pkg['id'])
+        assert_false(pkg.get('auto_doi_identifier'))
+
+
+class TestDOIPermissionCache(helpers.FunctionalTestBase):
+
+    @helpers.change_config('ckanext.doi.doi_request_only_in_orgs', True)
+    @helpers.change_config('ckanext.doi.doi_request_roles_in_orgs', 'admin')
+    def test_permission_cached(self):
+        user = factories.User()
+        org = factories.Organization(user=user)
+        data = {'owner_org': org['id']}
+        assert_true(doi_helpers.can_request_doi(user['name'], data))
+        with mock.patch('ckanext.doi.helpers.authz') as mock_authz:
+            assert_true(doi_helpers.can_request_doi(user['name'], data))
+        assert_false(mock_authz.users_role_for_group_or_org.called)
+
+    @helpers.change_config('ckanext.doi.doi_request_only_in_orgs', True)
+    @helpers.change_config('ckanext.doi.doi_request_roles_in_orgs', 'admin')
+    def test_cache_cleared_when_membership_changes(self):
+        owner = factories.User()
+        user = factories.User()
+        org = factories.Organization(
+            user=owner, users=[{'name': user['id'], 'capacity': 'admin'}])
+        data = {'owner_org': org['id']}
+        assert_true(doi_helpers.can_request_doi(user['name'], data))
+
+        helpers.call_action('organization_member_create',
+                            context={'user': owner['name']}, id=org['id'],
+                            username=user['name'], role='editor')
+
+        assert_false(doi_helpers.can_request_doi(user['name'], data))
+
+
+class TestDOISearch(helpers.FunctionalTestBase):
+
+    def test_get_dois(self):
+        '''get_dois returns the DOIs for several packages at once.'''
+        with_doi = [factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                      doi_identifier=None,
+                                      doi_prefix='10.5072/FK2')
+                    for i in range(3)]
+        without_doi = factories.Dataset(author='Ben',
+                                        auto_doi_identifier=False)
+
+        dois = doi_lib.get_dois([pkg['id'] for pkg in with_doi] +
+                                [without_doi['id']])
+
+        assert_equal(sorted(dois.keys()),
+                     sorted(pkg['id'] for pkg in with_doi))
+        for pkg in with_doi:
+            assert_equal(dois[pkg['id']].identifier,
+                         doi_lib.get_doi(pkg['id']).identifier)
+
+    def test_search_results_have_doi_status(self):
+        '''DOI status is added to package_search results.'''
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        other = factories.Dataset(author='Ben', auto_doi_identifier=False)
+
+        results = dict((r['id'], r) for r in
+                       helpers.call_action('package_search')['results'])
+
+        assert_equal(results[pkg['id']]['doi_status'], False)
+        assert_true('doi_status' not in results[other['id']])
+
+    def test_search_results_without_id(self):
+        '''Results without an id, from fl, are left as they are.'''
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+
+        results = helpers.call_action('package_search', fl='name')['results']
+
+        assert_equal(results, [{'name': pkg['name']}])
+
+    def test_doi_status_indexed(self):
+        '''DOI status can be used to filter searches.'''
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        factories.Dataset(author='Ben', auto_doi_identifier=False)
+
+        results = helpers.call_action('package_search',
+                                      fq='doi_status:false')['results']
+
+        assert_equal([r['id'] for r in results], [pkg['id']])
+
+    @helpers.change_config('ckanext.doi.status_from_index', True)
+    def test_search_results_status_from_index(self):
+        '''With status_from_index, search results use the indexed status
+        without querying the doi table.'''
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+
+        with mock.patch('ckanext.doi.plugin.get_dois') as mock_get_dois:
+            results = helpers.call_action('package_search')['results']
+
+        assert_false(mock_get_dois.called)
+        assert_equal(results[0]['id'], pkg['id'])
+        assert_equal(results[0]['doi_status'], False)
+        assert_equal(results[0]['doi_identifier'],
+                     doi_lib.get_doi(pkg['id']).identifier)
+
+
 class TestDOIDelete(helpers.FunctionalTestBase):
 
     def test_auto_then_clear(self):
@@ -320,6 +472,385 @@ class TestDOIDelete(helpers.FunctionalTestBase):
         assert_true(doi is None)
 
 
+class TestDOIAsyncPublish(helpers.FunctionalTestBase):
+
+    '''Tests for queueing DOI operations with ckanext.doi.async_publish'''
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    @mock.patch('ckanext.doi.operations.publish_doi')
+    def test_update_queues_publish(self, mock_publish):
+        '''Updating a public dataset queues the publish rather than calling
+        the provider.'''
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        pkg = helpers.call_action('package_show', id=pkg['id'])
+        helpers.call_action('package_update', **pkg)
+
+        assert_false(mock_publish.called)
+
+        ops = doi_operations.get_pending_operations()
+        assert_equal(len(ops), 1)
+        assert_equal(ops[0].package_id, pkg['id'])
+        assert_equal(ops[0].operation, doi_operations.MINT)
+        assert_equal(ops[0].identifier, pkg['doi_identifier'])
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    def test_repeated_updates_coalesce(self):
+        '''Only one operation is queued per package.'''
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        pkg = helpers.call_action('package_show', id=pkg['id'])
+        helpers.call_action('package_update', **pkg)
+        pkg['title'] = 'A new title'
+        helpers.call_action('package_update', **pkg)
+
+        ops = doi_operations.get_pending_operations()
+        assert_equal(len(ops), 1)
+        assert_true('A new title' in ops[0].payload)
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    @mock.patch('ckanext.doi.operations.publish_doi')
+    def test_process_queue(self, mock_publish):
+        '''The worker sends queued operations and removes them.'''
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        pkg = helpers.call_action('package_show', id=pkg['id'])
+        helpers.call_action('package_update', **pkg)
+
+        assert_equal(doi_operations.process_queue(), (1, 0))
+        assert_true(mock_publish.called)
+        assert_equal(mock_publish.call_args[0][0], pkg['id'])
+        assert_equal(doi_operations.get_pending_operations(), [])
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    @mock.patch('ckanext.doi.operations.publish_doi')
+    def test_failed_operation_stays_queued(self, mock_publish):
+        '''A provider error leaves the operation queued for retry.'''
+        mock_publish.side_effect = Exception('Provider unavailable')
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        pkg = helpers.call_action('package_show', id=pkg['id'])
+        helpers.call_action('package_update', **pkg)
+
+        assert_equal(doi_operations.process_queue(), (0, 1))
+
+        ops = doi_operations.get_pending_operations()
+        assert_equal(len(ops), 1)
+        assert_equal(ops[0].attempts, 1)
+        assert_equal(ops[0].last_error, 'Provider unavailable')
+
+
+class TestDOIOutbox(helpers.FunctionalTestBase):
+
+    '''Tests for the outbox of DOI provider operations'''
+
+    def _dataset(self):
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        return helpers.call_action('package_show', id=pkg['id'])
+
+    def _http_error(self, status_code):
+        response = mock.Mock(status_code=status_code)
+        return HTTPError('{0} error'.format(status_code), response=response)
+
+    @mock.patch('ckanext.doi.operations.publish_doi')
+    def test_sync_failure_stays_queued(self, mock_publish):
+        '''If the provider call fails during a save, the save succeeds and
+        the operation is left for the worker.'''
+        mock_publish.side_effect = self._http_error(500)
+        pkg = self._dataset()
+        helpers.call_action('package_update', **pkg)
+
+        ops = doi_operations.get_pending_operations()
+        assert_equal(len(ops), 1)
+        assert_equal(ops[0].attempts, 1)
+        assert_true(doi_lib.get_doi(pkg['id']) is not None)
+
+    @mock.patch('ckanext.doi.lib.get_doi_api')
+    def test_create_while_provider_unavailable(self, mock_api):
+        '''If the provider can't check a new identifier, the dataset is saved
+        without a DOI, and gets one when it's next saved.'''
+        mock_api.return_value.get.side_effect = \
+            DOIProviderUnavailableError('Circuit breaker open')
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        assert_true(doi_lib.get_doi(pkg['id']) is None)
+
+        mock_api.return_value.get.side_effect = self._http_error(404)
+        pkg = helpers.call_action('package_show', id=pkg['id'])
+        helpers.call_action('package_update', **pkg)
+        assert_true(doi_lib.get_doi(pkg['id']) is not None)
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    @mock.patch('ckanext.doi.plugin_timing.get_implementations',
+                return_value=[_DatePlugin()])
+    def test_payload_with_plugin_values(self, mock_implementations):
+        '''Values an IDoi plugin adds which JSON can't represent are queued
+        as text, with the same hash as the metadata sent.'''
+        pkg = self._dataset()
+        helpers.call_action('package_update', **pkg)
+
+        op = doi_operations.get_pending_operations()[0]
+        payload = doi_operations._load_payload(op)
+        assert_equal(payload['available'], u'2020-01-02 00:00:00')
+        metadata_dict = {'available': datetime.datetime(2020, 1, 2)}
+        stored = json.loads(doi_lib.metadata_to_json(metadata_dict))
+        assert_equal(doi_lib.metadata_hash(stored),
+                     doi_lib.metadata_hash(metadata_dict))
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    def test_mint_then_update_stays_mint(self):
+        '''An update of a DOI waiting to be minted is coalesced into the
+        mint.'''
+        pkg = self._dataset()
+        doi_operations.enqueue_operation(pkg['id'], doi_operations.MINT,
+                                         {'identifier': pkg['doi_identifier'],
+                                          'title': 'Old'})
+        doi_operations.enqueue_operation(pkg['id'], doi_operations.UPDATE,
+                                         {'identifier': pkg['doi_identifier'],
+                                          'title': 'New'})
+
+        ops = doi_operations.get_pending_operations()
+        assert_equal(len(ops), 1)
+        assert_equal(ops[0].operation, doi_operations.MINT)
+        assert_true('New' in ops[0].payload)
+
+    @mock.patch('ckanext.doi.operations.withdraw_doi')
+    def test_clearing_published_doi_keeps_it(self, mock_withdraw):
+        '''By default turning off auto_doi_identifier only deletes the local
+        DOI - the published DOI is left at the provider.'''
+        pkg = self._dataset()
+        doi_lib.mark_published(pkg['id'], pkg['doi_identifier'])
+        model.Session.commit()
+        pkg['auto_doi_identifier'] = False
+        pkg['doi_identifier'] = ''
+        helpers.call_action('package_update', **pkg)
+
+        assert_true(doi_lib.get_doi(pkg['id']) is None)
+        assert_false(mock_withdraw.called)
+        assert_equal(doi_operations.get_pending_operations(), [])
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    @helpers.change_config('ckanext.doi.withdraw_cleared_dois', True)
+    @mock.patch('ckanext.doi.operations.withdraw_doi')
+    def test_clearing_published_doi_withdraws_it(self, mock_withdraw):
+        '''With withdraw_cleared_dois, turning off auto_doi_identifier for a
+        published DOI queues its withdrawal.'''
+        pkg = self._dataset()
+        doi_lib.mark_published(pkg['id'], pkg['doi_identifier'])
+        model.Session.commit()
+        pkg['auto_doi_identifier'] = False
+        pkg['doi_identifier'] = ''
+        helpers.call_action('package_update', **pkg)
+
+        ops = doi_operations.get_pending_operations()
+        assert_equal(len(ops), 1)
+        assert_equal(ops[0].operation, doi_operations.DELETE)
+
+        assert_equal(doi_operations.process_queue(), (1, 0))
+        mock_withdraw.assert_called_once_with(ops[0].identifier)
+
+    @helpers.change_config('ckanext.doi.withdraw_cleared_dois', True)
+    @mock.patch('ckanext.doi.operations.withdraw_doi')
+    def test_clearing_published_doi_withdraws_it_now(self, mock_withdraw):
+        '''Without async_publish the withdrawal is applied during the
+        save.'''
+        pkg = self._dataset()
+        identifier = pkg['doi_identifier']
+        doi_lib.mark_published(pkg['id'], identifier)
+        model.Session.commit()
+        pkg['auto_doi_identifier'] = False
+        pkg['doi_identifier'] = ''
+        helpers.call_action('package_update', **pkg)
+
+        mock_withdraw.assert_called_once_with(identifier)
+        assert_equal(doi_operations.get_pending_operations(), [])
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    @mock.patch('ckanext.doi.lib.get_doi_api')
+    def test_mint_of_existing_doi_updates(self, mock_api):
+        '''Replaying a mint the provider already has updates it instead.'''
+        mock_api.return_value.create.side_effect = self._http_error(400)
+        mock_api.return_value.update.return_value.status_code = 200
+        pkg = self._dataset()
+        mock_api.return_value.get_url.return_value = \
+            doi_lib.get_package_url(pkg['id'])
+        helpers.call_action('package_update', **pkg)
+
+        assert_equal(doi_operations.process_queue(), (1, 0))
+        assert_true(mock_api.return_value.update.called)
+        assert_true(doi_lib.get_doi(pkg['id']).published is not None)
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    @mock.patch('ckanext.doi.lib.get_doi_api')
+    def test_mint_of_someone_elses_doi_fails(self, mock_api):
+        '''A DOI the provider already has pointing somewhere else isn't
+        overwritten.'''
+        mock_api.return_value.create.side_effect = self._http_error(400)
+        mock_api.return_value.get_url.return_value = \
+            'http://example.com/dataset/other'
+        pkg = self._dataset()
+        helpers.call_action('package_update', **pkg)
+
+        assert_equal(doi_operations.process_queue(), (0, 1))
+        assert_false(mock_api.return_value.update.called)
+        assert_true(doi_lib.get_doi(pkg['id']).published is None)
+
+    @helpers.change_config('ckanext.doi.async_publish', True)
+    @mock.patch('ckanext.doi.operations.publish_doi')
+    def test_process_queue_in_batches(self, mock_publish):
+        '''Every operation is processed once per run, whatever the batch
+        size.'''
+        mock_publish.side_effect = [None, self._http_error(500), None]
+        for i in range(3):
+            helpers.call_action('package_update', **self._dataset())
+
+        assert_equal(doi_operations.process_queue(batch_size=2), (2, 1))
+        assert_equal(mock_publish.call_count, 3)
+        assert_equal(len(doi_operations.get_pending_operations()), 1)
+
+
+class TestDOIMetadataHash(helpers.FunctionalTestBase):
+
+    '''Tests for skipping provider updates when the metadata is unchanged'''
+
+    def _published_dataset(self):
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        doi = doi_lib.get_doi(pkg['id'])
+        pkg = helpers.call_action('package_show', id=pkg['id'])
+        metadata_dict = doi_lib.build_metadata(pkg, doi)
+        doi_lib.mark_published(pkg['id'], doi.identifier,
+                               doi_lib.metadata_hash(metadata_dict))
+        model.Session.commit()
+        return pkg
+
+    @mock.patch('ckanext.doi.operations.update_doi')
+    def test_unchanged_metadata_not_sent(self, mock_update):
+        '''Saving a dataset without changing its DOI metadata doesn't call
+        the provider.'''
+        pkg = self._published_dataset()
+        pkg['notes'] = pkg['notes']
+        helpers.call_action('package_update', **pkg)
+
+        assert_false(mock_update.called)
+
+    @mock.patch('ckanext.doi.operations.update_doi')
+    def test_changed_metadata_sent(self, mock_update):
+        '''Changing the DOI metadata of a dataset updates the provider.'''
+        pkg = self._published_dataset()
+        pkg['title'] = 'A new title'
+        helpers.call_action('package_update', **pkg)
+
+        assert_true(mock_update.called)
+        assert_equal(mock_update.call_args[1]['title'], 'A new title')
+
+
+class TestDOIPrefixQueries(helpers.FunctionalTestBase):
+
+    '''Tests for anchored prefix queries on the doi table'''
+
+    def test_with_prefix_anchored(self):
+        '''Only identifiers starting with the prefix match.'''
+        for identifier in (u'10.5072/FK2000001', u'10.5072/FK3000001',
+                           u'10.9999/10.5072/FK2'):
+            doi_lib.create_doi_from_identifier(
+                factories.Dataset(author='Ben')['id'], identifier)
+
+        matches = model.Session.query(doi_lib.DOI.identifier) \
+            .filter(doi_lib.with_prefix(doi_lib.DOI.identifier, '10.5072'))
+        assert_equal(sorted(row[0] for row in matches),
+                     [u'10.5072/FK2000001', u'10.5072/FK3000001'])
+
+    def test_with_prefix_escapes_wildcards(self):
+        doi_lib.create_doi_from_identifier(
+            factories.Dataset(author='Ben')['id'], u'10.5072/AB1')
+
+        assert_equal(model.Session.query(doi_lib.DOI).filter(
+            doi_lib.with_prefix(doi_lib.DOI.identifier, '10.5072/A_')
+        ).count(), 0)
+
+    def test_prefix_stats(self):
+        pkg = factories.Dataset(author='Ben')
+        doi_lib.create_doi_from_identifier(pkg['id'], u'10.5072/FK2000001')
+        doi_lib.mark_published(pkg['id'], u'10.5072/FK2000001')
+        doi_lib.create_doi_from_identifier(
+            factories.Dataset(author='Ben')['id'], u'10.5072/FK2000002')
+
+        assert_equal(doi_lib.get_prefix_stats('10.5072/FK2'), {
+            'prefix': '10.5072/FK2', 'total': 2, 'published': 1,
+            'unpublished': 1})
+
+
+class TestDOICitation(object):
+
+    '''Tests for the cached citation helper'''
+
+    def setup(self):
+        doi_helpers._citation_cache = None
+
+    def teardown(self):
+        doi_helpers._citation_cache = None
+
+    def _pkg_dict(self, **kwargs):
+        pkg_dict = {'id': 'pkg-1', 'author': 'Ben', 'title': 'Birds',
+                    'metadata_created': '2016-03-01T10:00:00',
+                    'metadata_modified': '2016-03-02T10:00:00',
+                    'doi_status': True}
+        pkg_dict.update(kwargs)
+        return pkg_dict
+
+    @helpers.change_config('ckanext.doi.site_title', 'Data Portal')
+    def test_citation(self):
+        assert_equal(doi_helpers.doi_citation(self._pkg_dict()),
+                     u'Ben (2016). Dataset: Birds. Data Portal.')
+        assert_equal(doi_helpers.doi_citation(self._pkg_dict(),
+                                              {'id': 'res-1',
+                                               'name': 'Sightings'}),
+                     u'Ben (2016). Dataset: Birds. Resource: Sightings. '
+                     u'Data Portal.')
+
+    def test_citation_cached(self):
+        '''The dates are only parsed again when the package changes.'''
+        with mock.patch('ckanext.doi.helpers.package_get_year',
+                        return_value=2016) as mock_year:
+            doi_helpers.doi_citation(self._pkg_dict())
+            doi_helpers.doi_citation(self._pkg_dict())
+            assert_equal(mock_year.call_count, 1)
+
+            citation = doi_helpers.doi_citation(
+                self._pkg_dict(title='Bats',
+                               metadata_modified='2016-03-03T10:00:00'))
+            assert_equal(mock_year.call_count, 2)
+            assert_equal(citation, u'Ben (2016). Dataset: Bats.')
+
+    @helpers.change_config('ckanext.doi.citation_cache_size', '0')
+    def test_cache_disabled(self):
+        with mock.patch('ckanext.doi.helpers.package_get_year',
+                        return_value=2016) as mock_year:
+            doi_helpers.doi_citation(self._pkg_dict())
+            doi_helpers.doi_citation(self._pkg_dict())
+            assert_equal(mock_year.call_count, 2)
+
+
+class TestLicenseTitle(object):
+
+    def test_license_title(self):
+        for license_title, license_id in model.Package.get_license_options():
+            assert_equal(doi_lib.get_license_title(license_id), license_title)
+        assert_true(doi_lib.get_license_title('not-a-license') is None)
+
+    def test_index_rebuilt_for_new_register(self):
+        '''Replacing the license register rebuilds the index.'''
+        doi_lib.get_license_title('cc-by')
+        with mock.patch.object(model.Package, 'get_license_register',
+                               return_value=object()), \
+                mock.patch.object(model.Package, 'get_license_options',
+                                  return_value=[('Local license', 'local')]):
+            assert_equal(doi_lib.get_license_title('local'), 'Local license')
+            assert_true(doi_lib.get_license_title('cc-by') is None)
+
+
 class TestDOIFieldsDisplay(helpers.FunctionalTestBase):
 
     '''Tests for when to display the DOI fields in the dataset form'''
@@ -403,6 +934,12 @@ class TestDOIAPIInterface(object):
 
         assert_raises(DOIAPITypeNotKnownError, get_doi_api)
 
+    @helpers.change_config('ckanext.doi.api_provider', 'datacite')
+    def test_get_doi_api_returns_datacite_rest_api_interface(self):
+        doi_api = get_doi_api()
+        assert_true(isinstance(doi_api,
+                               datacite_rest_api.DOIDataCiteRESTAPI))
+
 
     # def test_doi_publish_datacite(self):
 
@@ -422,3 +959,109 @@ class TestDOIAPIInterface(object):
     #     doi_lib.validate_metadata(metadata_dict)
 
     #     doi_lib.publish_doi(self.package_dict['id'], **metadata_dict)
+
+
+class TestANVL(object):
+
+    def test_escape(self):
+        assert_equal(ezid_api.escape(u'100%: a\r\nb'), u'100%25%3A a%0D%0Ab')
+
+    def test_to_anvl(self):
+        anvl = ezid_api.to_anvl({'datacite': u'<r>caf\xe9</r>\n'})
+        assert_equal(anvl, 'datacite: <r>caf\xc3\xa9</r>%0A')
+
+    def test_from_anvl(self):
+        data = {u'_target': u'http://example.com/dataset/1',
+                u'datacite': u'<r>caf\xe9</r>\n'}
+        assert_equal(ezid_api.from_anvl(ezid_api.to_anvl(data)), data)
+
+
+class TestDOITransport(object):
+
+    def teardown(self):
+        transport.reset_session()
+
+    def test_session_reused(self):
+        '''Provider calls share one session per process.'''
+        assert_true(transport.get_session() is transport.get_session())
+
+    @helpers.change_config('ckanext.doi.api_connect_timeout', '2')
+    @helpers.change_config('ckanext.doi.api_read_timeout', '7')
+    def test_timeout_from_config(self):
+        assert_equal(transport.get_timeout(), (2.0, 7.0))
+
+    def test_ezid_call_uses_transport(self):
+        '''EZID calls are sent through the shared session.'''
+        with StandInServer() as server:
+            with mock.patch('ckanext.doi.api.ezid_api.ENDPOINT', server.url):
+                api = ezid_api.DOIEzidAPI()
+                api.get('10.5072/FK2000001')
+                api.get('10.5072/FK2000002')
+            transport.reset_session()
+
+        assert_equal([r[1] for r in server.requests],
+                     ['/id/doi:10.5072/FK2000001',
+                      '/id/doi:10.5072/FK2000002'])
+
+
+class TestDataCiteRESTAPI(object):
+
+    metadata = {
+        'identifier': '10.5072/FK2000001',
+        'title': 'A dataset',
+        'creator': 'Ben',
+        'publisher': 'A publisher',
+        'publisher_year': 2016,
+        'description': 'About the dataset',
+    }
+
+    def teardown(self):
+        transport.reset_session()
+
+    def _call(self, method, **kwargs):
+        def handler(method, path, body):
+            return 201, {'Content-Type': datacite_rest_api.CONTENT_TYPE}, '{}'
+        with StandInServer(handler) as server:
+            with mock.patch('ckanext.doi.api.datacite_rest_api.get_endpoint',
+                            return_value=server.url):
+                getattr(datacite_rest_api.DOIDataCiteRESTAPI(), method)(
+                    **kwargs)
+            transport.reset_session()
+        return server.requests
+
+    def test_create_is_one_call(self):
+        '''Minting a DOI sends the URL and metadata in a single call.'''
+        requests = self._call('create', url='http://example.com/dataset/1',
+                              **self.metadata)
+
+        assert_equal(len(requests), 1)
+        method, path, body = requests[0]
+        assert_equal((method, path), ('PUT', '/dois/10.5072/FK2000001'))
+        attributes = json.loads(body)['data']['attributes']
+        assert_equal(attributes['event'], 'publish')
+        assert_equal(attributes['url'], 'http://example.com/dataset/1')
+        xml = base64.b64decode(attributes['xml'])
+        assert_true('10.5072/FK2000001' in xml)
+        assert_true('A dataset' in xml)
+
+    def test_update(self):
+        '''Updating sends the metadata without publishing again.'''
+        requests = self._call('update', **self.metadata)
+
+        method, path, body = requests[0]
+        assert_equal((method, path), ('PUT', '/dois/10.5072/FK2000001'))
+        attributes = json.loads(body)['data']['attributes']
+        assert_true('event' not in attributes)
+        assert_true('xml' in attributes)
+
+    def test_delete_hides(self):
+        requests = self._call('delete', doi='10.5072/FK2000001')
+
+        attributes = json.loads(requests[0][2])['data']['attributes']
+        assert_equal(attributes, {'event': 'hide'})
+
+    @helpers.change_config('ckanext.doi.datacite_endpoint',
+                           'http://localhost:9999/')
+    def test_endpoint_from_config(self):
+        assert_equal(datacite_rest_api.get_endpoint(),
+                     'http://localhost:9999')
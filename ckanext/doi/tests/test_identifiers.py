@@ -0,0 +1,97 @@
+from nose.tools import assert_equal, assert_true, assert_false, assert_raises
+import mock
+
+from ckan.tests import helpers
+from ckan.tests import factories
+
+import ckanext.doi.lib as doi_lib
+from ckanext.doi import identifiers
+from ckanext.doi.exc import DOIIdentifierError
+
+
+class TestPermute(object):
+
+    def test_permute_is_bijective(self):
+        '''Every value in the domain maps to a different value in the
+        domain.'''
+        for domain_size in (1, 2, 900, 1024, 9000):
+            permuted = [identifiers.permute(i, domain_size, 'key')
+                        for i in range(domain_size)]
+            assert_equal(sorted(permuted), range(domain_size))
+
+    def test_permute_depends_on_key(self):
+        one = [identifiers.permute(i, 9000, 'one') for i in range(20)]
+        two = [identifiers.permute(i, 9000, 'two') for i in range(20)]
+        assert_true(one != two)
+
+
+class TestBase32(object):
+
+    def test_check_character(self):
+        identifier_id = '3WQ8K0ZH'
+        check = identifiers.base32_check_character(identifier_id)
+        assert_true(identifiers.is_valid_base32_identifier(
+            identifier_id + check))
+
+    def test_substitution_detected(self):
+        '''Changing any one character makes the identifier invalid.'''
+        identifier_id = '3WQ8K0ZH'
+        check = identifiers.base32_check_character(identifier_id)
+        for i in range(len(identifier_id)):
+            for c in identifiers.BASE32_ALPHABET:
+                changed = identifier_id[:i] + c + identifier_id[i + 1:]
+                if changed != identifier_id:
+                    assert_false(identifiers.is_valid_base32_identifier(
+                        changed + check))
+
+
+class TestIdentifierGenerators(helpers.FunctionalTestBase):
+
+    def test_default_generator(self):
+        generator = identifiers.get_identifier_generator('10.5072/FK2')
+        assert_true(isinstance(generator,
+                               identifiers.RandomIdentifierGenerator))
+        assert_false(generator.collision_free)
+
+    @helpers.change_config('ckanext.doi.identifier_generator', 'unknown')
+    def test_unknown_generator(self):
+        assert_raises(DOIIdentifierError,
+                      identifiers.get_identifier_generator, '10.5072/FK2')
+
+    @helpers.change_config('ckanext.doi.identifier_generator', 'sequence')
+    @helpers.change_config('ckanext.doi.identifier_max_attempts', '0')
+    def test_max_attempts_at_least_one(self):
+        pkg = factories.Dataset(author='Ben')
+        doi = doi_lib.create_unique_identifier(pkg['id'], '10.5072/FK2')
+        assert_equal(doi.package_id, pkg['id'])
+
+    @helpers.change_config('ckanext.doi.identifier_generator', 'sequence')
+    def test_sequence_generator(self):
+        generator = identifiers.get_identifier_generator('10.5072/FK2')
+        ids = [generator.make_identifier_id() for i in range(100)]
+        assert_equal(len(set(ids)), 100)
+        for identifier_id in ids:
+            assert_equal(len(identifier_id), 7)
+            assert_true(identifier_id[0] != '0')
+
+    @helpers.change_config('ckanext.doi.identifier_generator', 'base32')
+    @helpers.change_config('ckanext.doi.identifier_length', '6')
+    def test_base32_generator(self):
+        generator = identifiers.get_identifier_generator('10.5072/FK2')
+        ids = [generator.make_identifier_id() for i in range(100)]
+        assert_equal(len(set(ids)), 100)
+        for identifier_id in ids:
+            assert_equal(len(identifier_id), 7)
+            assert_true(identifiers.is_valid_base32_identifier(identifier_id))
+
+    @helpers.change_config('ckanext.doi.identifier_generator', 'base32')
+    def test_create_unique_identifier_no_provider_check(self):
+        '''Identifiers from collision free generators aren't checked against
+        the provider.'''
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=False)
+        with mock.patch('ckanext.doi.lib.get_doi_api') as mock_api:
+            doi = doi_lib.create_unique_identifier(pkg['id'], '10.5072/FK2')
+        assert_false(mock_api.return_value.get.called)
+        assert_true(doi.identifier.startswith('10.5072/FK2'))
+        assert_true(identifiers.is_valid_base32_identifier(
+            doi.identifier[len('10.5072/FK2'):]))
@@ -0,0 +1,103 @@
+from nose.tools import assert_equal, assert_true, assert_raises
+import mock
+
+from ckan.tests import helpers
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.doi import metrics
+from ckanext.doi.api import transport
+from ckanext.doi.tests.stand_in import StandInServer
+
+
+class _ListBackend(object):
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, kind, name, value, tags):
+        self.records.append((kind, name, value, tags))
+
+
+class TestMetrics(object):
+
+    def setup(self):
+        self.backend = _ListBackend()
+        metrics.set_backend(self.backend)
+
+    def teardown(self):
+        metrics.set_backend(None)
+        transport.reset_session()
+
+    def test_disabled(self):
+        metrics.set_backend(None)
+        with metrics.timer('name') as timer:
+            timer.tags['status'] = 200
+        metrics.incr('name')
+
+        @metrics.timed('name')
+        def f(x):
+            return x * 2
+
+        assert_equal(f(2), 4)
+        assert_equal(self.backend.records, [])
+
+    def test_timer(self):
+        with metrics.timer('name', method='PUT') as timer:
+            timer.tags['status'] = 201
+        ((kind, name, value, tags),) = self.backend.records
+        assert_equal((kind, name, tags),
+                     (metrics.TIMING, 'name', {'method': 'PUT', 'status': 201}))
+        assert_true(value >= 0)
+
+    def test_timed_records_errors(self):
+        @metrics.timed('name')
+        def f():
+            raise ValueError()
+
+        assert_raises(ValueError, f)
+        assert_equal(self.backend.records[0][3], {'error': 'ValueError'})
+
+    def test_provider_calls(self):
+        '''Provider calls are timed by method and status.'''
+        with StandInServer() as server:
+            transport.request('put', server.url + '/id/doi:10.5072/FK2000001')
+        ((kind, name, value, tags),) = self.backend.records
+        assert_equal(name, 'provider.call')
+        assert_equal(tags, {'method': 'PUT', 'status': 201})
+
+    def test_statsd_format(self):
+        backend = metrics.StatsdBackend()
+        assert_equal(backend.format(metrics.TIMING, 'provider.call', 0.0125,
+                                    {'method': 'PUT', 'status': 201}),
+                     'ckanext.doi.provider.call.method_PUT.status_201:12.500|ms')
+        assert_equal(backend.format(metrics.COUNTER, 'retries', 2, {}),
+                     'ckanext.doi.retries:2|c')
+
+    def test_prometheus_render(self):
+        backend = metrics.PrometheusBackend()
+        backend.record(metrics.TIMING, 'provider.call', 0.5, {'status': 201})
+        backend.record(metrics.TIMING, 'provider.call', 0.25, {'status': 201})
+        backend.record(metrics.COUNTER, 'retries', 2, {})
+        assert_equal(backend.render(), '\n'.join([
+            '# TYPE ckanext_doi_provider_call_seconds summary',
+            'ckanext_doi_provider_call_seconds_count{status="201"} 2',
+            'ckanext_doi_provider_call_seconds_sum{status="201"} 0.75',
+            '# TYPE ckanext_doi_retries_total counter',
+            'ckanext_doi_retries_total 2',
+        ]) + '\n')
+
+
+class TestMetricsAction(helpers.FunctionalTestBase):
+
+    def teardown(self):
+        metrics.set_backend(None)
+
+    def test_doi_metrics(self):
+        metrics.set_backend(metrics.PrometheusBackend())
+        metrics.incr('retries', 3)
+        assert_true('ckanext_doi_retries_total 3' in
+                    helpers.call_action('doi_metrics'))
+
+    def test_doi_metrics_needs_prometheus(self):
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+                      'doi_metrics')
@@ -0,0 +1,82 @@
+from nose.tools import assert_equal, assert_true
+import mock
+
+from ckan.tests import helpers
+
+from ckanext.doi import plugin_timing
+
+
+class _FastPlugin(object):
+
+    def build_metadata(self, pkg_dict, metadata_dict):
+        metadata_dict['fast'] = True
+
+    def metadata_to_xml(self, xml_dict, metadata):
+        xml_dict['resource']['fast'] = True
+        return xml_dict
+
+
+class _SlowPlugin(object):
+
+    def build_metadata(self, pkg_dict, metadata_dict):
+        metadata_dict['slow'] = True
+
+
+class TestPluginTiming(object):
+
+    def setup(self):
+        plugin_timing.reset()
+
+    def teardown(self):
+        plugin_timing.reset()
+
+    @mock.patch('ckanext.doi.plugin_timing.get_implementations',
+                return_value=[_FastPlugin(), _SlowPlugin()])
+    @mock.patch('ckanext.doi.plugin_timing.time')
+    def test_report(self, mock_time, mock_implementations):
+        # Fast calls take 1ms, slow calls 100ms
+        times = []
+        for i in range(10):
+            times.extend([0, 0.001, 0, 0.1])
+        mock_time.time.side_effect = times
+        for i in range(10):
+            metadata_dict = {}
+            plugin_timing.call_build_metadata({}, metadata_dict)
+        assert_equal(metadata_dict, {'fast': True, 'slow': True})
+
+        report = plugin_timing.get_report()
+        assert_equal([(row['plugin'], row['hook'], row['calls'])
+                      for row in report],
+                     [(__name__ + '._SlowPlugin', 'build_metadata', 10),
+                      (__name__ + '._FastPlugin', 'build_metadata', 10)])
+        assert_true(abs(report[0]['p99_ms'] - 100) < 1e-6)
+        assert_true(abs(report[1]['p50_ms'] - 1) < 1e-6)
+
+    @mock.patch('ckanext.doi.plugin_timing.get_implementations',
+                return_value=[_FastPlugin()])
+    def test_metadata_to_xml(self, mock_implementations):
+        xml_dict = plugin_timing.call_metadata_to_xml({'resource': {}}, {})
+        assert_equal(xml_dict, {'resource': {'fast': True}})
+        assert_equal(plugin_timing.get_report()[0]['hook'], 'metadata_to_xml')
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        assert_equal(plugin_timing._percentile(samples, 50), 50)
+        assert_equal(plugin_timing._percentile(samples, 99), 99)
+        assert_equal(plugin_timing._percentile([5], 99), 5)
+
+    @helpers.change_config('ckanext.doi.cache_idoi_plugins', True)
+    @mock.patch('ckanext.doi.plugin_timing.p.PluginImplementations',
+                return_value=[_FastPlugin()])
+    def test_cached_implementations(self, mock_implementations):
+        plugin_timing.get_implementations()
+        plugin_timing.get_implementations()
+        assert_equal(mock_implementations.call_count, 1)
+
+    @mock.patch('ckanext.doi.plugin_timing.p.PluginImplementations',
+                return_value=[_FastPlugin()])
+    def test_implementations_not_cached_by_default(self,
+                                                   mock_implementations):
+        plugin_timing.get_implementations()
+        plugin_timing.get_implementations()
+        assert_equal(mock_implementations.call_count, 2)
@@ -0,0 +1,86 @@
+import time
+import threading
+
+from nose.tools import assert_equal, assert_true, assert_raises
+from requests.exceptions import ConnectionError, Timeout
+
+from ckanext.doi.api import transport
+from ckanext.doi.api.pool import ConcurrentDOIAPI
+from ckanext.doi.tests.stand_in import StandInServer
+
+
+class _SlowAPI(object):
+    '''Provider API whose calls take a while, recording how many run at
+    once'''
+
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def create(self, identifier, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        if identifier == 'bad':
+            raise ConnectionError('Connection refused')
+        if identifier == 'broken':
+            raise ValueError('Broken metadata')
+        return identifier
+
+
+def _create(api, identifier):
+    return api.create(identifier)
+
+
+class TestConcurrentDOIAPI(object):
+
+    def teardown(self):
+        transport.reset_session()
+
+    def test_imap_unordered(self):
+        '''Every item is sent, and errors are returned rather than
+        raised.'''
+        with ConcurrentDOIAPI(_SlowAPI(), concurrency=4) as api:
+            results = sorted(api.imap_unordered(_create,
+                                                ['a', 'b', 'bad', 'c']))
+        assert_equal([(item, result) for item, result, error in results],
+                     [('a', 'a'), ('b', 'b'), ('bad', None), ('c', 'c')])
+        assert_true(isinstance(results[2][2], ConnectionError))
+
+    def test_imap_unordered_other_errors(self):
+        '''Errors other than provider errors are returned too, so the
+        other items still finish.'''
+        with ConcurrentDOIAPI(_SlowAPI(), concurrency=2) as api:
+            results = sorted(api.imap_unordered(_create,
+                                                ['a', 'broken', 'c']))
+        assert_equal([(item, result) for item, result, error in results],
+                     [('a', 'a'), ('broken', None), ('c', 'c')])
+        assert_true(isinstance(results[1][2], ValueError))
+
+    def test_concurrency_bounded(self):
+        slow_api = _SlowAPI()
+        with ConcurrentDOIAPI(slow_api, concurrency=3) as api:
+            list(api.imap_unordered(_create, [str(i) for i in range(12)]))
+        assert_equal(slow_api.max_running, 3)
+
+    def test_sync_facade(self):
+        '''The API methods wait for their call and raise its errors.'''
+        with ConcurrentDOIAPI(_SlowAPI(), concurrency=2) as api:
+            assert_equal(api.create('a'), 'a')
+            assert_raises(ConnectionError, api.create, 'bad')
+
+    def test_request_timeout(self):
+        '''Each call made by the pool has the pool's timeout.'''
+        def handler(method, path, body):
+            time.sleep(0.5)
+            return 200, {}, ''
+
+        with StandInServer(handler) as server:
+            with ConcurrentDOIAPI(transport, concurrency=1,
+                                  timeout=0.1) as api:
+                result = api.submit('request', 'get', server.url)
+                assert_raises(Timeout, result.get)
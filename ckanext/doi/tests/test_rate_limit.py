@@ -0,0 +1,86 @@
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+from nose.tools import assert_equal, assert_true
+import mock
+
+from ckan.tests import helpers
+
+from ckanext.doi.api import rate_limit, transport
+from ckanext.doi.tests.stand_in import StandInServer
+
+RATE = 50
+CALLS_PER_WORKER = 5
+WORKERS = 4
+
+
+def _take_tokens(directory, results):
+    '''Worker process - make CALLS_PER_WORKER rate limited calls'''
+    for i in range(CALLS_PER_WORKER):
+        time.sleep(rate_limit.take_token('account', RATE, 1, directory))
+    results.put(time.time())
+
+
+class TestRateLimit(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    @mock.patch('ckanext.doi.api.rate_limit.time')
+    def test_burst_then_wait(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        delays = [rate_limit.take_token('account', 10, 2, self.directory)
+                  for i in range(4)]
+        assert_equal(delays[:2], [0, 0])
+        # Each call after the burst waits another 1/rate seconds
+        assert_true(abs(delays[2] - 0.1) < 1e-6)
+        assert_true(abs(delays[3] - 0.2) < 1e-6)
+
+    @mock.patch('ckanext.doi.api.rate_limit.time')
+    def test_refill(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        for i in range(2):
+            rate_limit.take_token('account', 10, 2, self.directory)
+        mock_time.time.return_value = 1000.1
+        assert_equal(rate_limit.take_token('account', 10, 2, self.directory),
+                     0)
+
+    @mock.patch('ckanext.doi.api.rate_limit.time')
+    def test_buckets_per_account(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        rate_limit.take_token('one', 10, 1, self.directory)
+        assert_equal(rate_limit.take_token('two', 10, 1, self.directory), 0)
+
+    def test_shared_between_processes(self):
+        '''Processes calling at once are limited to the rate between them.'''
+        results = multiprocessing.Queue()
+        start = time.time()
+        workers = [multiprocessing.Process(target=_take_tokens,
+                                           args=(self.directory, results))
+                   for i in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        finished = max(results.get(timeout=60) for worker in workers)
+        for worker in workers:
+            worker.join()
+        calls = WORKERS * CALLS_PER_WORKER
+        assert_true(finished - start >= (calls - 1) / float(RATE))
+
+    @helpers.change_config('ckanext.doi.rate_limit', '10')
+    @mock.patch('ckanext.doi.api.rate_limit.time')
+    def test_transport_rate_limited(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        with mock.patch('ckanext.doi.api.rate_limit.get_directory',
+                        return_value=self.directory):
+            with StandInServer() as server:
+                for i in range(12):
+                    transport.request('get', server.url,
+                                      auth=('account', 'password'))
+            transport.reset_session()
+        # Burst of 10, then a wait before each of the last 2 calls
+        assert_equal(mock_time.sleep.call_count, 2)
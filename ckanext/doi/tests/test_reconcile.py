@@ -0,0 +1,102 @@
+from nose.tools import assert_equal, assert_true, assert_false
+import mock
+
+from ckan.tests import helpers
+from ckan.tests import factories
+import ckan.model as model
+
+import ckanext.doi.lib as doi_lib
+import ckanext.doi.operations as doi_operations
+from ckanext.doi import reconcile
+
+
+class TestExternalSort(object):
+
+    def test_sorts_in_memory(self):
+        assert_equal(list(reconcile.external_sort([u'b', u'c', u'a'], 10)),
+                     [u'a', u'b', u'c'])
+
+    def test_sorts_across_runs(self):
+        '''Lines spilled to several runs are merged in order.'''
+        lines = [u'{0:04}'.format((i * 37) % 100) for i in range(100)]
+        assert_equal(list(reconcile.external_sort(lines, 7)), sorted(lines))
+
+    def test_unicode(self):
+        assert_equal(list(reconcile.external_sort([u'\xe9', u'e'], 1)),
+                     [u'e', u'\xe9'])
+
+
+class TestMergeJoin(object):
+
+    def test_merge_join(self):
+        local = [u'A\t1', u'B\t2', u'D\t4']
+        remote = [u'B\tb', u'C\tc', u'C\tc', u'D\td']
+        assert_equal(list(reconcile.merge_join(local, remote)), [
+            ([u'A', u'1'], None),
+            ([u'B', u'2'], [u'B', u'b']),
+            (None, [u'C', u'c']),
+            ([u'D', u'4'], [u'D', u'd']),
+        ])
+
+
+class TestProviderSupportsListing(object):
+
+    @helpers.change_config('ckanext.doi.api_provider', 'ezid')
+    def test_ezid(self):
+        assert_false(reconcile.provider_supports_listing())
+
+    @helpers.change_config('ckanext.doi.api_provider', 'datacite')
+    def test_datacite(self):
+        assert_true(reconcile.provider_supports_listing())
+
+
+class TestReconcile(helpers.FunctionalTestBase):
+
+    def _dataset(self, published):
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+        doi = doi_lib.get_doi(pkg['id'])
+        if published:
+            doi_lib.mark_published(pkg['id'], doi.identifier)
+            model.Session.commit()
+        return pkg, doi.identifier
+
+    def _provider(self, identifiers):
+        api = mock.Mock()
+        api.iter_dois.return_value = iter(identifiers)
+        return mock.patch('ckanext.doi.reconcile.get_doi_api',
+                          return_value=api)
+
+    def test_report(self):
+        '''Mismatches are found, comparing DOIs case insensitively.'''
+        ok_pkg, ok = self._dataset(published=True)
+        missing_pkg, missing = self._dataset(published=True)
+        unpublished_pkg, unpublished = self._dataset(published=False)
+
+        with self._provider([ok.lower(), unpublished, u'10.5072/OTHER']):
+            mismatches = sorted(reconcile.iter_mismatches(chunk_size=2))
+
+        assert_equal(mismatches, sorted([
+            (reconcile.MISSING, missing, missing_pkg['id']),
+            (reconcile.UNPUBLISHED, unpublished, unpublished_pkg['id']),
+            (reconcile.ORPHANED, u'10.5072/OTHER', None),
+        ]))
+
+    def test_fix(self):
+        '''Fixing marks DOIs the provider has published, and queues DOIs it
+        doesn't have to be minted again.'''
+        missing_pkg, missing = self._dataset(published=True)
+        unpublished_pkg, unpublished = self._dataset(published=False)
+
+        with self._provider([unpublished]):
+            counts = reconcile.reconcile(apply_fixes=True)
+
+        assert_equal(counts['fixed'], 2)
+        assert_true(doi_lib.get_doi(unpublished_pkg['id']).published)
+        result = helpers.call_action(
+            'package_search', fq='id:{0}'.format(unpublished_pkg['id']))
+        assert_true(result['results'][0]['doi_status'])
+        assert_true(doi_lib.get_doi(missing_pkg['id']).published is None)
+        ops = doi_operations.get_pending_operations()
+        assert_equal([(op.identifier, op.operation) for op in ops],
+                     [(missing, doi_operations.MINT)])
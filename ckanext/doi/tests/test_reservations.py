@@ -0,0 +1,57 @@
+from nose.tools import assert_equal, assert_true, assert_false
+import mock
+from requests.exceptions import HTTPError
+
+from ckan.tests import helpers
+from ckan.tests import factories
+
+import ckanext.doi.lib as doi_lib
+from ckanext.doi import reservations
+
+
+def _not_found(identifier):
+    raise HTTPError('404 Not Found')
+
+
+class TestReservations(helpers.FunctionalTestBase):
+
+    @mock.patch('ckanext.doi.lib.get_doi_api')
+    def test_top_up(self, mock_api):
+        '''Topping up reserves identifiers checked with the provider.'''
+        mock_api.return_value.get.side_effect = _not_found
+
+        assert_equal(reservations.top_up('10.5072/FK2', 5), 5)
+        assert_equal(reservations.count_reserved('10.5072/FK2'), 5)
+        assert_equal(mock_api.return_value.get.call_count, 5)
+
+        # Already full
+        assert_equal(reservations.top_up('10.5072/FK2', 5), 0)
+
+    @mock.patch('ckanext.doi.lib.get_doi_api')
+    def test_claim_identifier(self, mock_api):
+        mock_api.return_value.get.side_effect = _not_found
+        reservations.top_up('10.5072/FK2', 2)
+
+        claimed = [reservations.claim_identifier('10.5072/FK2')
+                   for i in range(3)]
+
+        assert_equal(len(set(claimed[:2])), 2)
+        assert_true(claimed[2] is None)
+        assert_equal(reservations.count_reserved('10.5072/FK2'), 0)
+
+    @helpers.change_config('ckanext.doi.reservation_pool_size', '2')
+    @mock.patch('ckanext.doi.lib.get_doi_api')
+    def test_dataset_create_claims_reserved(self, mock_api):
+        '''New datasets get an identifier from the pool, without calling the
+        provider.'''
+        mock_api.return_value.get.side_effect = _not_found
+        reservations.top_up('10.5072/FK2')
+        mock_api.reset_mock()
+
+        pkg = factories.Dataset(author='Ben', auto_doi_identifier=True,
+                                doi_identifier=None, doi_prefix='10.5072/FK2')
+
+        assert_false(mock_api.return_value.get.called)
+        assert_equal(reservations.count_reserved('10.5072/FK2'), 1)
+        assert_true(doi_lib.get_doi(pkg['id']).identifier
+                    .startswith('10.5072/FK2'))
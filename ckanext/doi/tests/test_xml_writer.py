@@ -0,0 +1,49 @@
+# encoding: utf-8
+from collections import OrderedDict
+
+from nose.tools import assert_equal, assert_raises
+import xmltodict
+
+from ckanext.doi.api import xml_writer
+from ckanext.doi.api.mixins import MetadataToDataCiteXmlMixin
+
+
+def _assert_same_as_xmltodict(xml_dict):
+    assert_equal(xml_writer.unparse(xml_dict),
+                 xmltodict.unparse(xml_dict, full_document=False))
+
+
+class TestXMLWriter(object):
+
+    def test_datacite_metadata(self):
+        '''The DataCite XML dict serializes the same as with xmltodict.'''
+        xml_dict = MetadataToDataCiteXmlMixin.metadata_to_xml_dict(
+            '10.5072/FK2000001', u'Caf\xe9 <data> & more',
+            ['Ben', u'Zo\xe9 "Z" O\'Brien'], 'Natural History Museum', 2015,
+            description=u'Line one\nline two ☃', subject=['a', 'b'],
+            format='CSV, JSON', version='1.0', rights='CC-BY',
+            geo_point='51.5 -0.17')
+        _assert_same_as_xmltodict(xml_dict)
+
+    def test_escaping(self):
+        _assert_same_as_xmltodict({'r': {
+            '@plain': 'value',
+            '@double': 'say "hi"',
+            '@both': 'it\'s "hi"',
+            '@whitespace': 'a\nb\tc\rd',
+            '#text': '<&>',
+        }})
+
+    def test_values(self):
+        _assert_same_as_xmltodict({'r': OrderedDict([
+            ('number', 2015),
+            ('none', None),
+            ('empty', ''),
+            ('repeated', ['one', None, {'#text': 'three'}]),
+            ('no_items', []),
+            ('bytes', {'#text': 'caf\xc3\xa9'}),
+            ('unicode', u'caf\xe9'),
+        ])})
+
+    def test_multiple_roots(self):
+        assert_raises(ValueError, xml_writer.unparse, {'r': ['one', 'two']})
@@ -1,24 +1,55 @@
 import ckan.plugins.toolkit as toolkit
-from ckanext.doi.helpers import can_request_doi
+from ckanext.doi.helpers import can_request_doi, get_request_org_id
 
 import logging
 log = logging.getLogger(__name__)
 
 _ = toolkit._
 
+# Key in the context for results cached while validating a package, as
+# doi_requester runs for several fields
+CACHE_KEY = 'doi_validator_cache'
+
+
+def _get_cache(context):
+    return context.setdefault(CACHE_KEY, {})
+
+
+def _can_request_doi(user, data, context):
+    '''can_request_doi, once per user and organization in a context'''
+    cache = _get_cache(context)
+    key = ('can_request_doi', user, get_request_org_id(data))
+    if key not in cache:
+        cache[key] = can_request_doi(user, data)
+    return cache[key]
+
+
+def _get_original_package(package_id, context):
+    '''
+    The package as it was before this save, once per context
+    @return: package dict, or None if it doesn't exist yet
+    '''
+    cache = _get_cache(context)
+    key = ('original_package', package_id)
+    if key not in cache:
+        try:
+            cache[key] = toolkit.get_action('package_show')(
+                data_dict={'id': package_id})
+        except toolkit.ValidationError:
+            cache[key] = None
+    return cache[key]
+
 
 def doi_requester(key, data, errors, context):
     '''Requester must be authorized to request DOIs.'''
 
     user = context.get('user')
     # check whether user can request doi
-    if not can_request_doi(user, data):
+    if not _can_request_doi(user, data, context):
         log.info('User not able to request doi')
         # get the original pkg
-        try:
-            pkg = toolkit.get_action('package_show')(
-                data_dict={'id': data[('id',)]})
-        except toolkit.ValidationError:
+        pkg = _get_original_package(data[('id',)], context)
+        if pkg is None:
             data[key] = None
         else:
             # pass the original value to the data dict so it remains the same.